@@ -0,0 +1,499 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# @File  : AsyncKafka.py
+# @Author: Liaop
+# @Date  : 2018-10-24
+# @Desc  : 基于asyncio的Kafka封装类，一个事件循环内可以同时挂起大量请求，不需要为每个请求占用一个线程
+
+import asyncio
+from concurrent.futures import CancelledError as FutureCancelledError
+from concurrent.futures import TimeoutError as FutureTimeoutError
+import inspect
+import json
+import threading
+import time
+
+from BaseClass import Chunking
+from BaseClass.Compression import CompressionPolicy, make_policy
+from BaseClass.Envelope import Envelope
+from BaseClass import Codec
+from BaseClass.Log import Loger
+from BaseClass.Offsets import OffsetTracker
+from BaseClass.Transport import PykafkaTransport
+
+
+class AsyncKafka(object):
+    '''
+    Kafka类的asyncio版本
+
+    pykafka只提供阻塞接口，这里用一个后台线程读取consumer，
+    通过run_coroutine_threadsafe把消息交给事件循环，请求按sessionid由Future等待回复；
+    producer的produce本身只是放入发送队列，直接在事件循环中调用。
+    '''
+    # 为True时command/handler收到的是Envelope对象，否则是解码后的字符串
+    use_envelope = False
+
+    def __init__(self, hosts, loger=None, encoding='utf-8', max_buf=999950, max_queued=1000, codec='json',
+                 compression='gzip', on_expired='drop', transport=None, chunking=True,
+                 max_chunk_bytes=256 * 1024 * 1024, chunk_timeout=60):
+        '''
+        初始化
+
+        :param hosts: kafka主机地址，多个主机用逗号隔开
+        :param loger: 日志记录对象
+        :param encoding: 编码格式
+        :param max_buf: 最大收发数据大小
+        :param max_queued: 消息流缓存的最大消息数，超过后读取线程阻塞等待
+        :param codec: 发送消息对象（dict/list）时的编码方式，'json'、'fastjson'、'msgpack'或者Codec对象
+        :param compression: 压缩方式，'none'、'snappy'、'lz4'、'gzip'、'adaptive'或者CompressionPolicy对象，与Kafka相同
+        :param on_expired: serve收到已超过截止时间（deadline）的请求时的处理方式，
+                           'drop'为不执行handler直接丢弃，'fail'为不执行handler并回复code为-5的失败信息
+        :param transport: 传输层（Transport对象），默认为连接hosts的PykafkaTransport
+        :param chunking: 编码后超过max_buf的消息是否拆成多块发送，接收时自动重组
+        :param max_chunk_bytes: 重组未收齐的大消息最多占用的内存（字节）
+        :param chunk_timeout: 大消息的块最长等待时间（秒），超过时丢弃未收齐的消息
+        '''
+        if loger:
+            self.loger = loger
+        else:
+            self.loger = Loger('AsyncKafka', 'debug')
+        self.__run = False
+        if not hosts and transport is None:
+            self.loger.error('Kafka服务器地址为空.')
+        self.__hosts = hosts
+        self.__transport = transport or PykafkaTransport(hosts)
+        self.__encoding = encoding
+        self.__max_buf = max_buf
+        self.__max_queued = max_queued
+        self.__codec = Codec.get_codec(codec)
+        self.__policy = make_policy(compression, self.loger)
+        self.__on_expired = on_expired
+        self.__deadline = False
+        self.__deadline_skew = 0
+        self.__loop = None
+        self.__producers = dict()
+        self.__consumer = None
+        self.__reader = None
+        self.__queue = None
+        self.__streaming = False
+        self.__pending = dict()
+        self.__tracker = OffsetTracker()
+        self.__committing = False
+        self.__commit_again = False
+        self.__committed = dict()   # 分区号 -> 已提交的offset
+        self.__current = None       # async for最近返回的消息(分区, offset)，取下一条时标记完成
+        self.__chunking = chunking
+        self.__reassembler = Chunking.Reassembler(max_chunk_bytes, chunk_timeout, self.loger)
+
+    async def start(self, in_topic=None, out_topic=None, consumer_group=None, **kwargs):
+        '''
+        初始化kafka实例，设置相应参数
+
+        :param in_topic: 输入主题
+        :param out_topic: 输出主题
+        :param consumer_group: 群组名
+        :param kwargs: consumer_timeout: consumer超时时间（毫秒），用于读取线程检查退出标志
+                       balance: 是否进行负载均衡
+                       stream: 是否从启动开始缓存消息流（使用async for或serve时设置为True），
+                               否则只分发有请求在等待的回复
+                       deadline: 是否给request发送的请求（dict）加上截止时间（按request的timeout计算），
+                                 服务端不再执行超过截止时间的请求
+                       deadline_skew: 截止时间比timeout多出的秒数，容忍客户端和服务端的时钟偏差，默认1
+        :return: 如果成功返回True
+        '''
+        if self.__run:
+            self.loger.error('Kafka实例已经启动中.')
+            return False
+        if in_topic is None and out_topic is None:
+            self.loger.error('输入与输出主题不能都为空')
+            return False
+        if in_topic == out_topic:
+            self.loger.error('输入与输出主题不能一样')
+            return False
+        self.__loop = asyncio.get_event_loop()
+        self.__queue = asyncio.Queue(self.__max_queued)
+        consumer_timeout = kwargs.get('consumer_timeout', 1000)
+        balance = kwargs.get('balance', False)
+        self.__streaming = kwargs.get('stream', False)
+        self.__deadline = kwargs.get('deadline', False)
+        self.__deadline_skew = kwargs.get('deadline_skew', 1)
+        if isinstance(self.__transport, PykafkaTransport) and not self.__hosts:
+            self.loger.error('Kafka服务器地址为空，初始化失败.')
+            return False
+        try:
+            await self.__loop.run_in_executor(None, self.__init_kafka, in_topic, out_topic, consumer_group,
+                                              consumer_timeout, balance)
+        except Exception as e:
+            self.loger.error('初始化Kafka异常：{}'.format(e))
+            await self.__loop.run_in_executor(None, self.__stop_kafka)
+            return False
+        self.__run = True
+        if self.__consumer is not None:
+            self.__reader = threading.Thread(target=self.__read_loop, name='AsyncKafkaReader')
+            self.__reader.daemon = True
+            self.__reader.start()
+        self.loger.info("****START**** AsyncKafka启动成功.")
+        return True
+
+    async def stop(self):
+        '''
+        提交已经处理完成的offset，关闭producer和consumer，所有等待中的请求将收到异常
+
+        :return: 如果成功返回True
+        '''
+        self.__run = False
+        for _future in self.__pending.values():
+            if not _future.done():
+                _future.set_exception(RuntimeError('Kafka实例已停止'))
+        self.__pending.clear()
+        if self.__queue is not None:
+            # 唤醒正在等待消息流的协程
+            try:
+                self.__queue.put_nowait(None)
+            except asyncio.QueueFull:
+                pass
+        try:
+            await self.commit()
+            await self.__loop.run_in_executor(None, self.__stop_kafka)
+            self.loger.info('****STOP**** AsyncKafka实例停止运行.')
+            return True
+        except Exception as e:
+            self.loger.error('停止失败，原因：{}'.format(e))
+            return False
+
+    def __init_kafka(self, in_topic, out_topic, consumer_group, consumer_timeout, balance):
+        if out_topic is not None:
+            if not isinstance(out_topic, bytes):
+                out_topic = out_topic.encode(self.__encoding)
+            # 每种可能用到的压缩方式各建一个producer，发送时按压缩策略选择
+            for _codec in self.__policy.codecs:
+                self.__producers[_codec] = self.__transport.producer(
+                    out_topic, max_request_size=self.__max_buf,
+                    compression=CompressionPolicy.compression_type(_codec), linger_ms=0,
+                    partitioner=Chunking.key_partitioner)
+        if in_topic is not None:
+            if not consumer_group:
+                raise ValueError('消费者组名不能为空.')
+            if not isinstance(in_topic, bytes):
+                in_topic = in_topic.encode(self.__encoding)
+            if not isinstance(consumer_group, bytes):
+                consumer_group = consumer_group.encode(self.__encoding)
+            self.__consumer = self.__transport.consumer(in_topic, consumer_group, consumer_timeout_ms=consumer_timeout,
+                                                        balance=balance)
+
+    def __stop_kafka(self):
+        if self.__reader is not None:
+            self.__reader.join(2)
+            self.__reader = None
+        for _producer in self.__producers.values():
+            _producer.stop()
+        self.__producers = dict()
+        if self.__consumer:
+            self.__consumer.stop()
+            self.__consumer = None
+        self.__tracker.clear()
+        self.__committed = dict()
+        self.__current = None
+
+    def __read_loop(self):
+        '''
+        后台读取线程，把消息交给事件循环
+        '''
+        while self.__run:
+            try:
+                _msg = self.__consumer.consume()
+            except Exception as e:
+                if self.__run:
+                    self.loger.error('接收信息出错：{}'.format(e))
+                continue
+            if _msg is None or not _msg.value:
+                continue
+            try:
+                _future = asyncio.run_coroutine_threadsafe(self.__deliver(_msg), self.__loop)
+            except RuntimeError:
+                # 事件循环已关闭
+                break
+            # 消息流缓存满时在这里等待，形成背压；每秒检查一次退出标志，停止时取消分发
+            while True:
+                try:
+                    _future.result(1)
+                    break
+                except FutureTimeoutError:
+                    if not self.__run:
+                        _future.cancel()
+                        break
+                except FutureCancelledError:
+                    break
+                except Exception as e:
+                    self.loger.error('分发信息出错：{}'.format(e))
+                    break
+
+    async def __deliver(self, msg):
+        '''
+        在事件循环中分发消息：有请求在等待的回复交给对应的Future，否则放入消息流；
+        分块的大消息收齐后再分发，分区、offset取最后一块的值
+        '''
+        if Chunking.is_chunk(msg.value):
+            _value = self.__reassembler.add(msg.value, (msg.partition_id, msg.offset))
+            if _value is None:
+                return
+            msg = Chunking.Assembled(_value, msg)
+        if self.__pending:
+            # 在原始bytes上取sessionid，不属于等待中请求的回复不解码
+            _future = self.__pending.pop(self.__get_session(msg.value), None)
+            if _future is not None:
+                if not _future.done():
+                    _future.set_result(Envelope(msg.value, self.__encoding, self.__codec).legacy_text)
+                return
+        if self.__streaming:
+            await self.__queue.put(msg)
+        else:
+            self.loger.debug('丢弃无人等待的信息，offset:%s', msg.offset)
+
+    def __get_session(self, message):
+        '''
+        从json消息串中解析出sessionid
+        :param message: json消息串或者原始bytes
+        :return: 解析出的sessionid, 如果没有则返回None
+        '''
+        if isinstance(message, dict):
+            return message.get('sessionid', None)
+        return Envelope.peek_session(message, self.__encoding, self.__codec)
+
+    def send(self, message):
+        '''
+        信息推送，只是放入producer的发送队列，不会阻塞事件循环
+        :param message: 信息内容
+        :return: 正确执行返回true
+        '''
+        if not self.__run or not self.__producers:
+            self.loger.error('Kafka实例未启动.')
+            return False
+        try:
+            if isinstance(message, (dict, list)):
+                if self.__transport.objects:
+                    # 内存传输层直接传递对象，不编码、不压缩
+                    self.__producers[self.__policy.codecs[0]].produce(message)
+                    return True
+                message = Codec.encode(message, self.__codec)
+            elif not isinstance(message, bytes):
+                message = message.encode(self.__encoding)
+            _codec = self.__policy.choose(len(message))
+            _producer = self.__producers[_codec]
+            if not Chunking.fits(len(message), self.__max_buf):
+                if not self.__chunking:
+                    self.loger.error('消息大小为：{},已超过系统显示{}字节'.format(len(message), self.__max_buf))
+                    return False
+                # 所有块使用同一个partition_key和producer，进入同一分区并保持顺序
+                _key, _chunks = Chunking.split(message, self.__max_buf)
+                for _chunk in _chunks:
+                    _producer.produce(_chunk, partition_key=_key)
+                    self.__policy.record(_codec, _chunk)
+                self.loger.debug('消息大小为：%s字节，分块发送', len(message))
+                return True
+            _producer.produce(message)
+            self.__policy.record(_codec, message)
+            return True
+        except Exception as e:
+            self.loger.error('发送消息出错：{}'.format(e))
+            return False
+
+    async def request(self, message, timeout=10):
+        '''
+        发送远程请求指令，并等待指令结果
+        :param message: 发送给远程的指令，json字符串，格式：{'action':'command', 'sessionid':'****', 'data':{...}}
+        :param timeout: 等待回复的超时时间（秒）
+        :return: 指令结果，json字符串，格式：{'code':0, 'err':'info', 'sessionid':'****', 'data':{...}}
+        '''
+        sessionid = self.__get_session(message)
+        if sessionid is None:
+            self.loger.error('待发送的信息没有sessionid,发送失败')
+            return json.dumps({'code': -1, 'err': '没有session值', 'sessionid': None, 'data': None})
+        if sessionid in self.__pending:
+            return json.dumps({'code': -4, 'err': 'sessionid重复', 'sessionid': sessionid, 'data': None})
+        if self.__deadline:
+            message = self.__with_deadline(message, timeout)
+        _future = self.__loop.create_future()
+        self.__pending[sessionid] = _future
+        if not self.send(message):
+            self.__pending.pop(sessionid, None)
+            return json.dumps({'code': -2, 'err': '发送远程请求失败', 'sessionid': sessionid, 'data': None})
+        try:
+            return await asyncio.wait_for(_future, timeout)
+        except asyncio.TimeoutError:
+            self.loger.error('sessionid:{} 获取回复超时'.format(sessionid))
+            return json.dumps({'code': -3, 'err': '获取回复超时', 'sessionid': sessionid, 'data': None})
+        except Exception as e:
+            self.loger.error('发生异常：{}'.format(e))
+            return json.dumps({'code': -7, 'err': '其他异常：{}'.format(e), 'sessionid': sessionid, 'data': None})
+        finally:
+            self.__pending.pop(sessionid, None)
+
+    def __with_deadline(self, message, timeout):
+        '''
+        按等待回复的超时时间加上时钟偏差的余量给请求加上截止时间（deadline，毫秒时间戳），
+        请求不是dict或者已经有deadline时原样返回
+        :param message: 发送给远程的指令
+        :param timeout: 等待回复的超时时间（秒）
+        :return: 加上deadline的指令
+        '''
+        if not isinstance(message, dict) or 'deadline' in message:
+            return message
+        message = dict(message)
+        message['deadline'] = int((time.time() + timeout + self.__deadline_skew) * 1000)
+        return message
+
+    def compression_stats(self):
+        '''
+        各压缩方式的发送统计，见CompressionPolicy.stats
+        '''
+        return self.__policy.stats()
+
+    async def __next_message(self):
+        self.__streaming = True
+        _msg = await self.__queue.get()
+        if _msg is None or not self.__run:
+            return None
+        return _msg
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        '''
+        async for 逐条获取信息，返回解码后的字符串
+        取下一条时上一条视为处理完成，与Kafka的waitForAction一样提交处理完成的offset，
+        循环中途break时最后一条不提交，重启后重新投递
+        '''
+        if self.__current is not None:
+            self.__tracker.done(*self.__current)
+            self.__current = None
+            self.__schedule_commit()
+        _msg = await self.__next_message()
+        if _msg is None:
+            raise StopAsyncIteration
+        self.__tracker.add(_msg.partition, _msg.offset)
+        self.__current = (_msg.partition, _msg.offset)
+        return Envelope(_msg.value, self.__encoding, self.__codec).text
+
+    async def command(self, message):
+        '''
+        处理远程请求命令，在具体应用中重载该协程进行具体业务逻辑处理
+
+        :param message: 远程请求消息，json字符串，格式：{'action':'command', 'sessionid':'****', 'data':{...}}
+        :return: 业务处理后的反馈信息，json字符串，格式：{'code':0, 'err':'info', 'sessionid':'****', 'data':{...}}
+        '''
+        if not isinstance(message, Envelope):
+            message = Envelope(message, self.__encoding, self.__codec)
+        _json_msg = message.json
+        _action = _json_msg.get('action')
+        _sessionid = _json_msg.get('sessionid')
+        _data = _json_msg.get('data')
+        if _action is None:
+            _rt = {'code': -1, 'err': '没有明确的指令', 'sessionid': _sessionid, 'data': _data}
+        elif _action == 'resp':
+            _rt = {'code': 0, 'err': '{} 执行成功'.format(_action), 'sessionid': _sessionid, 'data': _data}
+        else:
+            _rt = {'code': -2, 'err': '未知指令 {}'.format(_action), 'sessionid': _sessionid, 'data': _data}
+        return Codec.encode(_rt, self.__codec)
+
+    async def serve(self, handler=None, concurrency=100):
+        '''
+        等待处理远程请求命令，最多同时处理concurrency条，
+        只提交连续处理完成的offset；处理出错或者回复发送失败的消息记录日志后跳过，不会阻塞之后的offset提交；
+        已经超过截止时间的请求按on_expired丢弃或者回复失败，不执行handler
+
+        :param handler: 处理函数，可以是协程函数或普通函数，默认使用command
+        :param concurrency: 最多同时处理的消息数
+        :return:
+        '''
+        if handler is None:
+            handler = self.command
+        _slots = asyncio.Semaphore(concurrency)
+        _tasks = set()
+        try:
+            while self.__run:
+                await _slots.acquire()
+                _msg = await self.__next_message()
+                if _msg is None:
+                    _slots.release()
+                    break
+                self.__tracker.add(_msg.partition, _msg.offset)
+                _task = self.__loop.create_task(self.__handle(handler, _msg, _slots))
+                _tasks.add(_task)
+                _task.add_done_callback(_tasks.discard)
+        finally:
+            if _tasks:
+                await asyncio.gather(*_tasks, return_exceptions=True)
+            await self.commit()
+
+    async def __handle(self, handler, msg, slots):
+        try:
+            _value = Envelope(msg.value, self.__encoding, self.__codec)
+            if _value.expired():
+                resp_msg = self.__expire(_value)
+            else:
+                if not self.use_envelope:
+                    _value = _value.text
+                resp_msg = handler(_value)
+                if inspect.isawaitable(resp_msg):
+                    resp_msg = await resp_msg
+            if resp_msg is not None and not self.send(resp_msg):
+                self.loger.error('回复发送失败，跳过该消息，offset:{}'.format(msg.offset))
+        except Exception as e:
+            self.loger.error('处理消息出错，跳过该消息，offset:{}，原因：{}'.format(msg.offset, e))
+        finally:
+            # 失败的消息也标记完成，否则之后处理完成的offset都无法提交
+            self.__tracker.done(msg.partition, msg.offset)
+            self.__schedule_commit()
+            slots.release()
+
+    def __schedule_commit(self):
+        '''
+        在事件循环中提交offset，上一次提交还没有完成时等它完成后再提交一次
+        '''
+        if self.__committing:
+            self.__commit_again = True
+            return
+        self.__committing = True
+        self.__loop.create_task(self.commit())
+
+    def __expire(self, envelope):
+        '''
+        处理已经超过截止时间的请求
+        :param envelope: 请求消息
+        :return: on_expired为'fail'时返回失败回复，否则返回None（丢弃）
+        '''
+        _sessionid = envelope.sessionid
+        self.loger.debug('请求%s已超过截止时间', _sessionid)
+        if self.__on_expired == 'fail':
+            return Codec.encode({'code': -5, 'err': '请求已过期', 'sessionid': _sessionid, 'data': None}, self.__codec)
+        return None
+
+    async def commit(self):
+        '''
+        提交连续处理完成的offset，不越过未收齐的大消息的第一块，在线程池中执行，不阻塞事件循环
+        :return:
+        '''
+        try:
+            _offsets = list()
+            for _partition, _offset in self.__tracker.committable():
+                _id = getattr(_partition, 'id', _partition)
+                # pykafka提交的是下一条待读取的offset
+                _next = _offset + 1
+                _floor = self.__reassembler.floor(_id)
+                if _floor is not None:
+                    _next = min(_next, _floor)
+                if _next <= self.__committed.get(_id, -1):
+                    continue
+                self.__committed[_id] = _next
+                _offsets.append((_partition, _next))
+            if _offsets and self.__consumer is not None:
+                await self.__loop.run_in_executor(None, self.__consumer.commit_offsets, _offsets)
+        except Exception as e:
+            self.loger.error('提交offset出错：{}'.format(e))
+        finally:
+            self.__committing = False
+            if self.__commit_again and self.__run:
+                self.__commit_again = False
+                self.__schedule_commit()
@@ -0,0 +1,230 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# @File  : Chunking.py
+# @Author: Liaop
+# @Date  : 2018-11-23
+# @Desc  : 大消息分块：超过max_buf的消息拆成带序号的块发送到同一分区，接收方重组或者按块流式读取
+
+from collections import OrderedDict
+import random
+import struct
+import time
+import uuid
+import zlib
+
+# 分块消息头：MAGIC + 消息编号(16字节) + 块序号 + 块数 + 原消息字节数，与Codec的b'\x00KC'区分
+MAGIC = b'\x00KS'
+_HEADER = struct.Struct('>16sIIQ')
+HEADER_SIZE = len(MAGIC) + _HEADER.size
+# pykafka按消息的完整大小与max_request_size比较：crc、magic、attributes、key和value的长度共14字节，
+# 新版消息格式另有8字节时间戳，再加上key和value本身
+MESSAGE_OVERHEAD = 14 + 8
+# 分块消息的partition_key是16字节的消息编号
+KEY_SIZE = 16
+
+
+def fits(size, max_size):
+    '''
+    不带partition_key、value为size字节的消息能否整条发送
+    :param size: 编码后的消息字节数
+    :param max_size: producer的max_request_size
+    '''
+    return size + MESSAGE_OVERHEAD <= max_size
+
+
+def is_chunk(data):
+    '''
+    是否是分块消息
+    '''
+    return isinstance(data, bytes) and data[:len(MAGIC)] == MAGIC
+
+
+def parse(data):
+    '''
+    解析分块消息
+    :return: (消息编号, 块序号, 块数, 原消息字节数, 块内容)
+    '''
+    _id, _index, _count, _total = _HEADER.unpack_from(data, len(MAGIC))
+    return _id, _index, _count, _total, data[HEADER_SIZE:]
+
+
+def split(data, max_size):
+    '''
+    把消息拆成发送时不超过max_size字节的块
+    :param data: 编码后的消息（bytes）
+    :param max_size: producer的max_request_size，每块加上块头、partition_key和消息开销后不超过该值
+    :return: (消息编号，作为partition_key使所有块进入同一分区, 逐块生成的迭代器)
+    '''
+    _id = uuid.uuid4().bytes
+    _step = max_size - MESSAGE_OVERHEAD - KEY_SIZE - HEADER_SIZE
+    _count = (len(data) + _step - 1) // _step
+    _view = memoryview(data)
+
+    def _chunks():
+        for i in range(_count):
+            yield MAGIC + _HEADER.pack(_id, i, _count, len(data)) + _view[i * _step:(i + 1) * _step]
+
+    return _id, _chunks()
+
+
+def key_partitioner(partitions, key=None):
+    '''
+    pykafka的partitioner：有partition_key时按键的哈希选择分区（同一大消息的块进入同一分区），否则随机
+    '''
+    if key is None:
+        return random.choice(partitions)
+    _partitions = sorted(partitions, key=lambda p: p.id)
+    return _partitions[zlib.crc32(key) % len(_partitions)]
+
+
+class Assembled(object):
+    '''
+    重组后的消息，分区、offset等取最后一块的值，提交offset时覆盖所有的块
+    '''
+    __slots__ = ('value', 'offset', 'partition', 'partition_id', 'partition_key', 'timestamp')
+
+    def __init__(self, value, last):
+        self.value = value
+        self.offset = last.offset
+        self.partition = last.partition
+        self.partition_id = last.partition_id
+        self.partition_key = getattr(last, 'partition_key', None)
+        self.timestamp = getattr(last, 'timestamp', None)
+
+
+class Reassembler(object):
+    '''
+    分块消息重组
+
+    按消息编号收集各块，收齐后返回完整消息。未收齐的消息按原消息大小预先计入内存占用，
+    超过max_bytes时丢弃最早的未收齐消息，超过timeout秒未收齐的消息也被丢弃。
+    '''
+
+    def __init__(self, max_bytes=256 * 1024 * 1024, timeout=60, loger=None):
+        '''
+        初始化
+
+        :param max_bytes: 未收齐消息最多占用的字节数，单条超过该值的消息直接丢弃
+        :param timeout: 未收齐消息的最长等待时间（秒）
+        :param loger: 日志记录对象
+        '''
+        self.loger = loger
+        self.__max_bytes = max_bytes
+        self.__timeout = timeout
+        self.__pending = OrderedDict()      # 消息编号 -> [开始时间, 块数, 原消息字节数, 已收到的块, 第一块的位置]
+        self.__bytes = 0
+        self.__origin = None
+
+    @property
+    def pending(self):
+        '''
+        未收齐的消息数
+        '''
+        return len(self.__pending)
+
+    @property
+    def origin(self):
+        '''
+        最近一条重组完成的消息第一块的位置（add时传入的position）
+        '''
+        return self.__origin
+
+    def floor(self, partition_id):
+        '''
+        分区中未收齐的消息第一块的最小offset，提交offset时不能越过该位置
+        :param partition_id: 分区号
+        :return: offset，没有未收齐的消息时返回None
+        '''
+        _offsets = [e[4][1] for e in self.__pending.values() if e[4] is not None and e[4][0] == partition_id]
+        return min(_offsets) if _offsets else None
+
+    def add(self, data, position=None):
+        '''
+        加入一块
+        :param data: 分块消息
+        :param position: 该块的(分区号, offset)，用于floor
+        :return: 收齐时返回完整消息（bytes），否则返回None
+        '''
+        _id, _index, _count, _total, _payload = parse(data)
+        self.expire()
+        _entry = self.__pending.get(_id)
+        if _entry is None:
+            if _index != 0:
+                # 第一块已经被丢弃或者之前已经重组过（重新投递）
+                return None
+            if _total > self.__max_bytes:
+                self.__error('大消息{}共{}字节，超过重组内存上限{}字节，丢弃'.format(_id.hex(), _total, self.__max_bytes))
+                return None
+            while self.__pending and self.__bytes + _total > self.__max_bytes:
+                _old_id, _old = self.__pending.popitem(last=False)
+                self.__bytes -= _old[2]
+                self.__error('重组内存不足，丢弃未收齐的大消息{}'.format(_old_id.hex()))
+            _entry = self.__pending[_id] = [time.time(), _count, _total, list(), position]
+            self.__bytes += _total
+        _parts = _entry[3]
+        if _index < len(_parts):
+            return None
+        if _index > len(_parts):
+            self.__drop(_id, '大消息{}缺少第{}块，丢弃'.format(_id.hex(), len(_parts)))
+            return None
+        _parts.append(_payload)
+        if len(_parts) < _entry[1]:
+            return None
+        del self.__pending[_id]
+        self.__bytes -= _entry[2]
+        self.__origin = _entry[4]
+        return b''.join(_parts)
+
+    def expire(self):
+        '''
+        丢弃超过timeout秒未收齐的消息
+        '''
+        _limit = time.time() - self.__timeout
+        while self.__pending:
+            _id, _entry = next(iter(self.__pending.items()))
+            if _entry[0] >= _limit:
+                break
+            self.__drop(_id, '大消息{}超过{}秒未收齐，丢弃'.format(_id.hex(), self.__timeout))
+
+    def __drop(self, chunk_id, reason):
+        _entry = self.__pending.pop(chunk_id)
+        self.__bytes -= _entry[2]
+        self.__error(reason)
+
+    def __error(self, msg):
+        if self.loger:
+            self.loger.error(msg)
+
+
+class ChunkStream(object):
+    '''
+    大消息的流式读取
+
+    迭代时按顺序逐块返回消息内容（bytes），后面的块在读取时才从kafka接收，已经返回的块不保留，
+    整条消息不需要同时放在内存中。块没有按时到达时抛出IOError。
+    '''
+
+    def __init__(self, first, pull):
+        '''
+        :param first: 第一块分块消息
+        :param pull: 接收后续块的函数，参数为(消息编号, 块序号)，返回分块消息，超时返回None
+        '''
+        self.id, _index, self.count, self.total_size, self.__first = parse(first)
+        self.__pull = pull
+
+    def __iter__(self):
+        _first, self.__first = self.__first, None
+        if _first is None:
+            raise IOError('大消息{}已经读取过'.format(self.id.hex()))
+        yield _first
+        for _index in range(1, self.count):
+            _data = self.__pull(self.id, _index)
+            if _data is None:
+                raise IOError('大消息{}的第{}块接收超时'.format(self.id.hex(), _index))
+            yield parse(_data)[4]
+
+    def read(self):
+        '''
+        读取整条消息
+        '''
+        return b''.join(self)
@@ -0,0 +1,171 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# @File  : Codec.py
+# @Author: Liaop
+# @Date  : 2018-11-01
+# @Desc  : 消息编解码注册表，支持json、快速json和msgpack，二进制编码的消息带有标明编码方式的头部
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# 带编码标识的消息头：MAGIC + 1字节编码编号，json文本以'{'或'['开头，不会与之冲突
+MAGIC = b'\x00KC'
+HEADER_SIZE = len(MAGIC) + 1
+
+
+class Codec(object):
+    '''
+    编解码基类
+
+    codec_id为写入消息头的编号，tagged为False的编码（json文本）不写消息头，保持与旧程序兼容。
+    '''
+    name = None
+    codec_id = None
+    tagged = True
+    text = False
+
+    def encode(self, obj):
+        raise NotImplementedError
+
+    def decode(self, data):
+        raise NotImplementedError
+
+
+class JsonCodec(Codec):
+    '''
+    标准库json，输出不带消息头的json文本，旧程序可以直接读取
+    '''
+    name = 'json'
+    codec_id = 1
+    tagged = False
+    text = True
+
+    def encode(self, obj):
+        return json.dumps(obj).encode('utf-8')
+
+    def decode(self, data):
+        return json.loads(data)
+
+
+class FastJsonCodec(Codec):
+    '''
+    快速json，优先使用orjson，其次ujson，都没有安装时退回标准库json
+    输出仍然是不带消息头的json文本
+    '''
+    name = 'fastjson'
+    codec_id = 2
+    tagged = False
+    text = True
+
+    def __init__(self):
+        if orjson is not None:
+            self.encode = orjson.dumps
+            self.decode = orjson.loads
+        elif ujson is not None:
+            self.encode = lambda obj: ujson.dumps(obj).encode('utf-8')
+            self.decode = ujson.loads
+        else:
+            self.encode = JsonCodec().encode
+            self.decode = json.loads
+
+
+class MsgpackCodec(Codec):
+    '''
+    msgpack二进制编码，需要安装msgpack包
+    '''
+    name = 'msgpack'
+    codec_id = 3
+
+    def encode(self, obj):
+        if msgpack is None:
+            raise RuntimeError('未安装msgpack包')
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def decode(self, data):
+        if msgpack is None:
+            raise RuntimeError('未安装msgpack包')
+        return msgpack.unpackb(data, raw=False)
+
+
+_BY_NAME = dict()
+_BY_ID = dict()
+
+
+def register(codec):
+    '''
+    注册编解码器，编号和名称都不能重复
+
+    :param codec: Codec对象
+    :return:
+    '''
+    if codec.codec_id in _BY_ID and _BY_ID[codec.codec_id].name != codec.name:
+        raise ValueError('编码编号{}已被{}使用'.format(codec.codec_id, _BY_ID[codec.codec_id].name))
+    _BY_NAME[codec.name] = codec
+    _BY_ID[codec.codec_id] = codec
+
+
+def get_codec(codec):
+    '''
+    按名称获取编解码器
+
+    :param codec: 编码名称或者Codec对象，None表示json
+    :return: Codec对象
+    '''
+    if codec is None:
+        return _BY_NAME['json']
+    if isinstance(codec, Codec):
+        return codec
+    if codec not in _BY_NAME:
+        raise ValueError('未知的编码方式：{}'.format(codec))
+    return _BY_NAME[codec]
+
+
+def is_tagged(data):
+    '''
+    是否是带编码标识头的消息
+    '''
+    return isinstance(data, bytes) and data[:len(MAGIC)] == MAGIC
+
+
+def encode(obj, codec=None):
+    '''
+    编码消息对象，二进制编码加上消息头
+
+    :param obj: 消息对象（dict/list等）
+    :param codec: 编码名称或者Codec对象
+    :return: bytes
+    '''
+    codec = get_codec(codec)
+    if codec.tagged:
+        return MAGIC + bytes((codec.codec_id,)) + codec.encode(obj)
+    return codec.encode(obj)
+
+
+def decode_tagged(data):
+    '''
+    解码带消息头的消息
+
+    :param data: 带消息头的bytes
+    :return: 消息对象
+    '''
+    codec = _BY_ID.get(data[len(MAGIC)])
+    if codec is None:
+        raise ValueError('未知的编码编号：{}'.format(data[len(MAGIC)]))
+    return codec.decode(data[HEADER_SIZE:])
+
+
+register(JsonCodec())
+register(FastJsonCodec())
+register(MsgpackCodec())
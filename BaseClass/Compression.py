@@ -0,0 +1,188 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# @File  : Compression.py
+# @Author: Liaop
+# @Date  : 2018-10-26
+# @Desc  : producer压缩策略，按消息大小和实际压缩率选择压缩方式，并统计各压缩方式的数据量和CPU耗时
+
+import gzip
+import threading
+import time
+
+from pykafka.common import CompressionType
+
+try:
+    import snappy
+except ImportError:
+    snappy = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+# 各压缩方式的python实现，用于抽样估算压缩率和CPU耗时
+_COMPRESSORS = {
+    'none': None,
+    'gzip': gzip.compress,
+    'snappy': snappy.compress if snappy else None,
+    'lz4': lz4.frame.compress if lz4 else None,
+}
+
+# 抽样压缩的CPU耗时只计当前线程，time.thread_time需要Python 3.7，3.6上退回到进程CPU时间
+_cpu_time = getattr(time, 'thread_time', None) or time.process_time
+
+_COMPRESSION_TYPES = {
+    'none': CompressionType.NONE,
+    'gzip': CompressionType.GZIP,
+    'snappy': CompressionType.SNAPPY,
+    'lz4': CompressionType.LZ4,
+}
+
+
+class CompressionPolicy(object):
+    '''
+    压缩策略
+
+    固定策略（none/snappy/lz4/gzip）所有消息使用同一种压缩方式；
+    自适应策略（adaptive）小于small_size的消息使用fast压缩方式（默认不压缩），大消息使用bulk压缩方式，
+    如果抽样得到的压缩率（压缩后/压缩前）高于min_ratio，说明压缩收益不大，改为使用fast压缩方式。
+    '''
+
+    def __init__(self, codec='gzip', small_size=1024, fast='none', bulk='gzip', min_ratio=0.8, sample_every=100,
+                 loger=None):
+        '''
+        初始化
+
+        :param codec: 压缩方式，'none'、'snappy'、'lz4'、'gzip'、'zstd'或者'adaptive'
+        :param small_size: 自适应策略下，小于该字节数的消息使用fast压缩方式
+        :param fast: 自适应策略下小消息和压缩收益不大时使用的压缩方式
+        :param bulk: 自适应策略下大消息使用的压缩方式
+        :param min_ratio: 自适应策略下，bulk压缩率高于该值时改用fast压缩方式
+        :param sample_every: 每多少条消息抽样一次，估算压缩率和CPU耗时
+        :param loger: 日志记录对象
+        '''
+        self.loger = loger
+        self.__codec = self.__check(codec) if codec != 'adaptive' else codec
+        self.__small_size = small_size
+        self.__fast = self.__check(fast)
+        self.__bulk = self.__check(bulk)
+        self.__min_ratio = min_ratio
+        self.__sample_every = max(1, sample_every)
+        self.__lock = threading.Lock()
+        self.__stats = dict()
+        self.__ratio = dict()       # codec -> 抽样压缩率
+        self.__cpu = dict()         # codec -> 抽样每字节CPU耗时
+
+    def __check(self, codec):
+        '''
+        检查压缩方式是否可用，不可用时退回到可用的压缩方式
+        '''
+        if codec == 'zstd':
+            # pykafka不支持zstd，使用压缩率最高的gzip代替
+            self.__warning('pykafka不支持zstd压缩，改用gzip.')
+            return 'gzip'
+        if codec not in _COMPRESSION_TYPES:
+            raise ValueError('未知的压缩方式：{}'.format(codec))
+        if codec != 'none' and _COMPRESSORS[codec] is None:
+            self.__warning('未安装{}压缩包，改为不压缩.'.format(codec))
+            return 'none'
+        return codec
+
+    def __warning(self, msg):
+        if self.loger:
+            self.loger.warning(msg)
+
+    @property
+    def codecs(self):
+        '''
+        该策略可能用到的压缩方式
+        '''
+        if self.__codec == 'adaptive':
+            return sorted({self.__fast, self.__bulk})
+        return [self.__codec]
+
+    @staticmethod
+    def compression_type(codec):
+        '''
+        压缩方式名对应的pykafka压缩类型
+        '''
+        return _COMPRESSION_TYPES[codec]
+
+    def choose(self, size):
+        '''
+        根据消息大小选择压缩方式
+
+        :param size: 消息字节数
+        :return: 压缩方式名
+        '''
+        if self.__codec != 'adaptive':
+            return self.__codec
+        if size < self.__small_size:
+            return self.__fast
+        if self.__ratio.get(self.__bulk, 0) > self.__min_ratio:
+            return self.__fast
+        return self.__bulk
+
+    def record(self, codec, message):
+        '''
+        记录一条按codec发送的消息，每sample_every条抽样压缩一次，更新压缩率和CPU耗时的估算
+
+        :param codec: 使用的压缩方式
+        :param message: 消息内容（bytes）
+        :return:
+        '''
+        with self.__lock:
+            _stats = self.__stats.get(codec)
+            if _stats is None:
+                _stats = self.__stats[codec] = {'messages': 0, 'bytes_in': 0, 'bytes_out': 0,
+                                                'cpu_seconds': 0.0, 'ratio': 1.0}
+            _stats['messages'] += 1
+            _stats['bytes_in'] += len(message)
+            _sample = (_stats['messages'] - 1) % self.__sample_every == 0
+        if _sample:
+            _codecs = {codec}
+            if self.__codec == 'adaptive' and len(message) >= self.__small_size:
+                # 大消息改用fast后也要继续抽样bulk的压缩率，否则无法切换回bulk
+                _codecs.add(self.__bulk)
+            for _codec in _codecs:
+                if _COMPRESSORS.get(_codec) is not None:
+                    self.__sample(_codec, message)
+        with self.__lock:
+            _stats['bytes_out'] += int(len(message) * self.__ratio.get(codec, 1.0))
+            _stats['cpu_seconds'] += len(message) * self.__cpu.get(codec, 0.0)
+
+    def __sample(self, codec, message):
+        _begin = _cpu_time()
+        _size = len(_COMPRESSORS[codec](message))
+        _cpu = _cpu_time() - _begin
+        _ratio = float(_size) / max(1, len(message))
+        with self.__lock:
+            # 指数平均，避免单条消息的偶然值影响选择
+            self.__ratio[codec] = 0.8 * self.__ratio.get(codec, _ratio) + 0.2 * _ratio
+            _per_byte = _cpu / max(1, len(message))
+            self.__cpu[codec] = 0.8 * self.__cpu.get(codec, _per_byte) + 0.2 * _per_byte
+            if codec in self.__stats:
+                self.__stats[codec]['ratio'] = self.__ratio[codec]
+
+    def stats(self):
+        '''
+        各压缩方式的统计，bytes_out和cpu_seconds是按抽样得到的压缩率和每字节CPU耗时估算的
+
+        :return: {codec: {'messages':..., 'bytes_in':..., 'bytes_out':..., 'cpu_seconds':..., 'ratio':...}}
+        '''
+        with self.__lock:
+            return {codec: dict(_stats) for codec, _stats in self.__stats.items()}
+
+
+def make_policy(compression, loger=None):
+    '''
+    把压缩方式名或者策略对象统一转换为策略对象
+
+    :param compression: 压缩方式名或者CompressionPolicy对象
+    :param loger: 日志记录对象
+    :return: CompressionPolicy对象
+    '''
+    if isinstance(compression, CompressionPolicy):
+        return compression
+    return CompressionPolicy(compression, loger=loger)
@@ -5,18 +5,30 @@
 # @Date  : 2018-08-17
 # @Desc  : Linux系统守护进程基础类，此类只能用于Linux操作系统
 
-import sys, os, time, atexit, platform
+import sys, os, time, atexit, platform, signal
+import multiprocessing
 from signal import SIGTERM
+from BaseClass import Log
 from BaseClass.Log import Loger
 
+SIGKILL = getattr(signal, 'SIGKILL', SIGTERM)
+
 
 class Daemon(object):
-    def __init__(self, pidfile, loger=None):
+    def __init__(self, pidfile, loger=None, prefork=False, workers=None, drain_timeout=30,
+                 max_backoff=60, stable_seconds=60):
         '''
         类初始化
 
         :param pidfile: 记录Pid的文件，可以用来判断进程是否启动
         :param loger: 日志记录对象
+        :param prefork: 是否使用多进程模式：主进程只负责管理，fork出workers个工作进程分别执行_run，
+                        工作进程异常退出时按退避时间重启，收到SIGHUP时逐个重启工作进程，
+                        收到SIGTERM时通知所有工作进程处理完当前消息后退出
+        :param workers: 多进程模式的工作进程数，默认为CPU核数
+        :param drain_timeout: 停止时等待工作进程退出的最长时间（秒），超时后强制结束
+        :param max_backoff: 工作进程连续异常退出时，重启等待时间的上限（秒）
+        :param stable_seconds: 工作进程运行超过该时间后退出，不计入连续异常次数
         '''
         self.platform = platform.system().lower()
         self.__pidfile = pidfile
@@ -24,6 +36,18 @@ class Daemon(object):
             self.loger = loger
         else:
             self.loger = Loger('Daemon', 'debug')
+        self.__prefork = prefork and self.platform != 'windows'
+        self.__workers = workers or multiprocessing.cpu_count()
+        self.__drain_timeout = drain_timeout
+        self.__max_backoff = max_backoff
+        self.__stable_seconds = stable_seconds
+        self.__master_pid = None
+        self.__slots = list()
+        self.__rolling = list()
+        self.__roll_after = 0
+        self.__reload = False
+        # 收到SIGTERM后为True，_run的循环据此退出
+        self.stopping = False
 
     def _daemonize(self):
         '''
@@ -57,7 +81,10 @@ class Daemon(object):
         open(self.__pidfile, 'w+').write('{}\n'.format(pid))
 
     def _delpid(self):
-        os.remove(self.__pidfile)
+        # fork出的工作进程退出时不删除主进程的pid文件
+        if self.__master_pid is None or self.__master_pid == os.getpid():
+            if os.path.exists(self.__pidfile):
+                os.remove(self.__pidfile)
 
     def start(self):
         '''
@@ -80,7 +107,11 @@ class Daemon(object):
         # 启动
         if self.platform != 'windows':
             self._daemonize()
-        self._run()
+        if self.__prefork:
+            self._supervise()
+        else:
+            self.__install_worker_signals()
+            self._run()
 
     def stop(self):
         '''
@@ -100,19 +131,23 @@ class Daemon(object):
             self.loger.warning('pidfile {} does not exist. Daemon not running!'.format(self.__pidfile))
             exit(1)
 
-        # 杀进程
+        # 发送一次SIGTERM，等待进程处理完当前消息后退出，超时后强制结束
         try:
-            while True:
-                os.kill(pid, SIGTERM)
+            os.kill(pid, SIGTERM)
+            _deadline = time.time() + self.__drain_timeout + 5
+            while time.time() < _deadline:
+                os.kill(pid, 0)
                 time.sleep(0.1)
+            self.loger.warning('进程{}在{}秒内没有退出，强制结束.'.format(pid, self.__drain_timeout + 5))
+            os.kill(pid, SIGKILL)
+            time.sleep(0.1)
         except OSError as e:
             err = str(e)
-            if err.find('No such process') > 0:
-                if os.path.exists(self.__pidfile):
-                    os.remove(self.__pidfile)
-                else:
-                    self.loger.error('{}'.format(err))
-                    sys.exit(1)
+            if err.find('No such process') < 0:
+                self.loger.error('{}'.format(err))
+                sys.exit(1)
+        if os.path.exists(self.__pidfile):
+            os.remove(self.__pidfile)
 
     def restart(self):
         self.stop()
@@ -121,13 +156,178 @@ class Daemon(object):
     def _run(self):
         '''
         运行的服务
-        用户进行重载，加入自己的业务逻辑
+        用户进行重载，加入自己的业务逻辑；循环中检查self.stopping，为True时处理完当前工作后返回
 
         :return:
         '''
-        while True:
-            self.loger.debug('{}:hello world!'.format(time.ctime()))
+        while not self.stopping:
+            self.loger.debug('%s:hello world!', time.ctime())
             time.sleep(2)
 
+    def _drain(self):
+        '''
+        收到SIGTERM时在进程的主线程中调用，此时self.stopping已经为True
+        默认直接退出进程；需要处理完当前工作再退出时重载该方法，例如调用Kafka.drain()，
+        由_run检查self.stopping后返回；不能在这里长时间阻塞
+        '''
+        sys.exit(0)
+
+    def _cleanup(self):
+        '''
+        工作进程退出前调用：工作进程用os._exit退出，不执行atexit注册的函数，
+        默认停止连接池中的producer、写完剩余日志；重载时释放自己的资源后调用父类方法
+        '''
+        # 没有导入过连接池模块时进程中没有连接池，不需要为此导入pykafka
+        _pool = sys.modules.get('BaseClass.Pool')
+        try:
+            if _pool is not None:
+                _pool.close_pool()
+        except Exception as e:
+            self.loger.error('工作进程{}停止连接池出错：{}'.format(os.getpid(), e))
+        Log.shutdown()
+
+    def __install_worker_signals(self):
+        def _on_term(signum, frame):
+            if not self.stopping:
+                self.loger.info('进程{}收到退出信号，处理完当前工作后退出.'.format(os.getpid()))
+            self.stopping = True
+            self._drain()
+
+        signal.signal(signal.SIGTERM, _on_term)
+        signal.signal(signal.SIGINT, _on_term)
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    def _supervise(self):
+        '''
+        多进程模式的主进程：启动并管理工作进程，直到收到SIGTERM且所有工作进程退出
+        '''
+        self.__master_pid = os.getpid()
+        self.__slots = [{'pid': None, 'started': 0, 'failures': 0, 'restart_at': 0} for i in range(self.__workers)]
+
+        def _on_term(signum, frame):
+            self.stopping = True
+
+        def _on_hup(signum, frame):
+            self.__reload = True
+
+        signal.signal(signal.SIGTERM, _on_term)
+        signal.signal(signal.SIGINT, _on_term)
+        signal.signal(signal.SIGHUP, _on_hup)
+        self.loger.info('主进程{}启动，工作进程数：{}'.format(self.__master_pid, self.__workers))
+        while not self.stopping:
+            self.__reap()
+            if self.__reload:
+                self.__reload = False
+                self.loger.info('收到SIGHUP，逐个重启工作进程.')
+                self.__rolling = list(range(self.__workers))
+            self.__roll()
+            _now = time.time()
+            for _index, _slot in enumerate(self.__slots):
+                if _slot['pid'] is None and _now >= _slot['restart_at'] and not self.stopping:
+                    self.__spawn(_index)
+            time.sleep(0.2)
+        self.__shutdown()
+
+    def __spawn(self, index):
+        _slot = self.__slots[index]
+        _pid = os.fork()
+        if _pid == 0:
+            # 工作进程：不返回到主进程的代码中，执行完_run后直接退出
+            _code = 0
+            try:
+                self.stopping = False
+                self.__install_worker_signals()
+                self._run()
+            except SystemExit as e:
+                _code = e.code if isinstance(e.code, int) else 0
+            except BaseException as e:
+                self.loger.error('工作进程{}异常退出：{}'.format(os.getpid(), e))
+                _code = 1
+            finally:
+                try:
+                    self._cleanup()
+                finally:
+                    os._exit(_code)
+        _slot['pid'] = _pid
+        _slot['started'] = time.time()
+        self.loger.info('工作进程{}启动，pid：{}'.format(index, _pid))
+
+    def __reap(self):
+        '''
+        回收已退出的工作进程，异常退出的按退避时间安排重启
+        '''
+        while True:
+            try:
+                _pid, _status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if _pid == 0:
+                return
+            for _index, _slot in enumerate(self.__slots):
+                if _slot['pid'] != _pid:
+                    continue
+                _slot['pid'] = None
+                if self.stopping or _index in self.__rolling:
+                    break
+                if time.time() - _slot['started'] >= self.__stable_seconds:
+                    _slot['failures'] = 0
+                _backoff = min(self.__max_backoff, 2 ** _slot['failures'] - 1)
+                _slot['failures'] += 1
+                _slot['restart_at'] = time.time() + _backoff
+                self.loger.error('工作进程{}(pid:{})退出，状态：{}，{}秒后重启.'.format(_index, _pid, _status, _backoff))
+                break
+
+    def __roll(self):
+        '''
+        滚动重启：每次只重启一个工作进程，新进程启动后再重启下一个
+        '''
+        if not self.__rolling or time.time() < self.__roll_after:
+            return
+        _index = self.__rolling[0]
+        _slot = self.__slots[_index]
+        if _slot.get('retiring'):
+            if _slot['pid'] is None:
+                _slot['retiring'] = False
+                _slot['failures'] = 0
+                self.__spawn(_index)
+                self.__rolling.pop(0)
+                # 给新进程留出加入消费者组的时间，再重启下一个
+                self.__roll_after = time.time() + 2
+            elif time.time() - _slot['retiring'] > self.__drain_timeout:
+                self.__kill(_slot['pid'], SIGKILL)
+            return
+        if _slot['pid'] is None:
+            self.__rolling.pop(0)
+            return
+        _slot['retiring'] = time.time()
+        self.__kill(_slot['pid'], SIGTERM)
+
+    def __shutdown(self):
+        '''
+        通知所有工作进程处理完当前工作后退出，超过drain_timeout后强制结束
+        '''
+        self.loger.info('主进程{}收到退出信号，等待工作进程退出.'.format(self.__master_pid))
+        for _slot in self.__slots:
+            if _slot['pid'] is not None:
+                self.__kill(_slot['pid'], SIGTERM)
+        _deadline = time.time() + self.__drain_timeout
+        while any(_slot['pid'] is not None for _slot in self.__slots):
+            if time.time() >= _deadline:
+                for _slot in self.__slots:
+                    if _slot['pid'] is not None:
+                        self.loger.warning('工作进程{}没有按时退出，强制结束.'.format(_slot['pid']))
+                        self.__kill(_slot['pid'], SIGKILL)
+                _deadline = time.time() + 5
+            time.sleep(0.1)
+            self.__reap()
+        self.loger.info('主进程{}退出.'.format(self.__master_pid))
+
+    def __kill(self, pid, sig):
+        try:
+            os.kill(pid, sig)
+        except OSError:
+            pass
+
 if __name__ == '__main__':
     pass
\ No newline at end of file
@@ -0,0 +1,227 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# @File  : Envelope.py
+# @Author: Liaop
+# @Date  : 2018-10-29
+# @Desc  : 消息信封，消息最多解析一次，并提供不解析整条消息直接取sessionid/action的快速方法
+
+import json
+import re
+import time
+
+from BaseClass import Codec
+
+# 兼容旧格式：单引号和空值（"key":,）
+_LEGACY_FIXES = (("'", '"'), ('":,', '":"",'))
+
+_PEEK_PATTERNS = dict()
+
+# 完整的字符串（双引号或者旧格式的单引号），计算字段所在的层级时去掉，字符串中的括号不计入
+_STRINGS = re.compile(rb'"(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\'')
+
+
+def _peek_pattern(key):
+    '''
+    字段快速查找用的正则表达式，按字段名缓存
+    :return: (正则表达式, 字段名bytes)
+    '''
+    _cached = _PEEK_PATTERNS.get(key)
+    if _cached is None:
+        _key = key.encode('ascii')
+        _pattern = re.compile(rb'["\']' + re.escape(_key) + rb'["\']\s*:\s*'
+                              rb'(?:"([^"\\]*)"|\'([^\'\\]*)\'|(-?\d+)(?![.\deE])|(null))')
+        _cached = _PEEK_PATTERNS[key] = (_pattern, _key)
+    return _cached
+
+
+def _top_level(prefix):
+    '''
+    字段名之前的内容是否表示该字段在顶层对象中：去掉完整的字符串后没有未闭合的引号，并且只有一层未闭合的括号
+    '''
+    _rest = _STRINGS.sub(b'', prefix)
+    if b'"' in _rest or b"'" in _rest:
+        return False
+    return _rest.count(b'{') + _rest.count(b'[') - _rest.count(b'}') - _rest.count(b']') == 1
+
+
+def legacy_fix(text):
+    '''
+    旧格式修正：单引号替换为双引号，空值替换为空字符串
+    '''
+    for _old, _new in _LEGACY_FIXES:
+        text = text.replace(_old, _new)
+    return text
+
+
+class Envelope(object):
+    '''
+    消息信封
+
+    持有原始消息，第一次访问text时解码，第一次访问json时解析，之后都使用缓存结果；
+    peek()在原始bytes上直接查找顶层的简单字段，用来跳过不需要处理的消息。
+    带编码标识头的消息（如msgpack）按消息头中的编码方式解码，不带的按json解析。
+    内存传输层直接传递的消息对象（dict/list）作为解析结果，不再解码。
+    '''
+    __slots__ = ('raw', 'encoding', 'codec', '_text', '_json')
+
+    def __init__(self, raw, encoding='utf-8', codec=None):
+        '''
+        初始化
+
+        :param raw: 原始消息，bytes、str或者消息对象
+        :param encoding: 编码格式
+        :param codec: 解析不带消息头的json文本时使用的编码方式，如'fastjson'
+        '''
+        self.raw = raw
+        self.encoding = encoding
+        codec = Codec.get_codec(codec)
+        self.codec = codec if codec.text else Codec.get_codec('json')
+        self._text = raw if isinstance(raw, str) else None
+        self._json = raw if isinstance(raw, (dict, list)) else None
+
+    @property
+    def tagged(self):
+        '''
+        是否是带编码标识头的消息
+        '''
+        return Codec.is_tagged(self.raw)
+
+    @property
+    def text(self):
+        '''
+        消息字符串，带编码标识头的二进制消息转换为json文本
+        '''
+        if self._text is None:
+            if not isinstance(self.raw, bytes) or self.tagged:
+                self._text = json.dumps(self.json)
+            else:
+                self._text = self.raw.decode(self.encoding)
+        return self._text
+
+    @property
+    def legacy_text(self):
+        '''
+        按旧格式修正后的消息字符串，与之前requestAndResponse返回的内容一致
+        '''
+        if not isinstance(self.raw, (bytes, str)) or self.tagged:
+            return self.text
+        return legacy_fix(self.text)
+
+    @property
+    def json(self):
+        '''
+        解析后的消息对象，带编码标识头的消息按消息头解码，
+        其他的先按标准json解析，失败时按旧格式修正后再解析
+        '''
+        if self._json is None:
+            if self.tagged:
+                self._json = Codec.decode_tagged(self.raw)
+            else:
+                try:
+                    self._json = self.codec.decode(self.raw)
+                except ValueError:
+                    self._json = json.loads(self.legacy_text)
+        return self._json
+
+    def get(self, key, default=None):
+        return self.json.get(key, default)
+
+    @property
+    def sessionid(self):
+        return self.peek_field('sessionid')
+
+    @property
+    def action(self):
+        return self.peek_field('action')
+
+    @property
+    def data(self):
+        return self.get('data')
+
+    @property
+    def deadline(self):
+        '''
+        请求的截止时间（毫秒时间戳），由requestAndResponse按等待回复的超时时间设置，没有时返回None
+        不带该字段的json消息只做一次子串查找，不解析
+        '''
+        if self._json is None and not self.tagged:
+            if (b'"deadline"' if isinstance(self.raw, bytes) else '"deadline"') not in self.raw:
+                return None
+        return self.peek_field('deadline')
+
+    def expired(self, now_ms=None):
+        '''
+        是否已经超过截止时间，发送方已经不再等待回复
+        :param now_ms: 当前时间（毫秒时间戳），默认取系统时间
+        '''
+        _deadline = self.deadline
+        if not isinstance(_deadline, (int, float)):
+            return False
+        return _deadline < (now_ms if now_ms is not None else time.time() * 1000)
+
+    def peek_field(self, key):
+        '''
+        获取顶层字段，已经解析过时直接取，否则先走快速查找
+        '''
+        if self._json is not None:
+            return self._json.get(key)
+        _found, _value = Envelope.peek(self.raw, key, self.encoding)
+        if _found:
+            return _value
+        return self.get(key)
+
+    @staticmethod
+    def peek(raw, key, encoding='utf-8'):
+        '''
+        不解析整条消息，直接在原始bytes中查找字段值
+        只有字段名在消息中只出现一次、位于顶层对象中（不是嵌套对象的字段，也不在字符串值里），
+        并且值是不含转义的字符串、整数或者null时才使用快速查找，其他情况返回未找到，由调用者完整解析
+
+        :param raw: 原始消息，bytes或者str
+        :param key: 字段名
+        :param encoding: 编码格式
+        :return: (是否找到, 字段值)
+        '''
+        if not raw:
+            return False, None
+        if isinstance(raw, dict):
+            return key in raw, raw.get(key)
+        if isinstance(raw, str):
+            raw = raw.encode(encoding)
+        elif Codec.is_tagged(raw):
+            return False, None
+        _pattern, _key = _peek_pattern(key)
+        if raw.count(_key) != 1:
+            return False, None
+        _match = _pattern.search(raw)
+        if _match is None or not _top_level(raw[:_match.start()]):
+            return False, None
+        _str, _quoted, _int, _null = _match.groups()
+        if _str is not None:
+            return True, _str.decode(encoding)
+        if _quoted is not None:
+            return True, _quoted.decode(encoding)
+        if _int is not None:
+            return True, int(_int)
+        return True, None
+
+    @staticmethod
+    def peek_session(raw, encoding='utf-8', codec=None):
+        '''
+        获取消息的sessionid，快速查找失败时完整解析
+
+        :param raw: 原始消息，bytes或者str
+        :param encoding: 编码格式
+        :param codec: 解析不带消息头的json文本时使用的编码方式
+        :return: sessionid，没有或者消息无法解析时返回None
+        '''
+        try:
+            return Envelope(raw, encoding, codec).sessionid
+        except Exception:
+            return None
+
+    def __str__(self):
+        return self.text
+
+    def __repr__(self):
+        return 'Envelope({!r})'.format(self.raw[:64] if isinstance(self.raw, (bytes, str)) else self.raw)
@@ -0,0 +1,165 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# @File  : HandlerPool.py
+# @Author: Liaop
+# @Date  : 2018-11-14
+# @Desc  : 可伸缩的处理进程池，按队列积压和处理耗时在最小、最大进程数之间增减处理进程
+
+import multiprocessing
+import signal
+import time
+
+from BaseClass.Log import Loger
+
+
+def ignore_interrupt(target, *args, **kwargs):
+    '''
+    子进程入口：忽略SIGINT后执行target
+    终端Ctrl+C会把SIGINT发给整个进程组，子进程忽略它，由主进程通过结束标记、stop_event按阶段通知退出，
+    不会在处理或提交offset的中途被打断
+    '''
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    return target(*args, **kwargs)
+
+
+class HandlerPool(object):
+    '''
+    处理进程池
+
+    每个处理进程执行target(queue, 进程名, stats, **kwargs)，从queue中取消息批次处理，收到结束标记（None）后退出；
+    stats是共享的[处理耗时（秒）, 处理消息数]，由处理进程累加。
+    处理进程忽略SIGINT，只在stop()放入的结束标记处退出。
+    主进程定期调用check()：积压的消息按平均耗时估计超过一个检查间隔才能处理完，
+    或者进程忙碌比例超过busy_high时增加一个进程；连续idle_checks次没有积压且忙碌比例低于busy_low时减少一个进程。
+    异常退出的进程会被移除，进程数低于最小值时补足。
+    '''
+
+    def __init__(self, target, queue, min_workers=1, max_workers=None, batch_size=100, loger=None,
+                 busy_high=0.75, busy_low=0.25, idle_checks=3, kwargs=None):
+        '''
+        初始化
+
+        :param target: 处理进程函数，参数为(queue, 进程名, stats, **kwargs)
+        :param queue: 处理进程读取的队列（multiprocessing.Queue或者ShmRing）
+        :param min_workers: 最少进程数
+        :param max_workers: 最多进程数，默认为CPU核数
+        :param batch_size: 每个消息批次的最大消息数，用来估计积压的消息数
+        :param loger: 日志记录对象
+        :param busy_high: 忙碌比例超过该值时增加进程
+        :param busy_low: 忙碌比例低于该值时可以减少进程
+        :param idle_checks: 连续多少次检查空闲后才减少进程
+        :param kwargs: 传给处理进程函数的其他参数
+        '''
+        if loger:
+            self.loger = loger
+        else:
+            self.loger = Loger('HandlerPool', 'info')
+        self.__target = target
+        self.__kwargs = kwargs or dict()
+        self.__queue = queue
+        self.__min = max(1, min_workers)
+        self.__max = max(self.__min, max_workers or multiprocessing.cpu_count())
+        self.__batch_size = batch_size
+        self.__busy_high = busy_high
+        self.__busy_low = busy_low
+        self.__idle_checks = idle_checks
+        self.__workers = list()     # [进程, stats, 上次检查时的处理耗时, 上次检查时的处理消息数]
+        self.__retiring = 0
+        self.__idle = 0
+        self.__serial = 0
+        self.__last_check = time.time()
+
+    @property
+    def size(self):
+        '''
+        当前运行的处理进程数（不含已经通知退出的进程）
+        '''
+        return len(self.__workers) - self.__retiring
+
+    def start(self):
+        '''
+        启动最少数量的处理进程
+        '''
+        self.__last_check = time.time()
+        for i in range(self.__min):
+            self.__spawn()
+
+    def check(self):
+        '''
+        回收已退出的进程，并按积压和处理耗时增减进程，由主进程定期调用
+        :return: 当前运行的处理进程数
+        '''
+        _now = time.time()
+        _interval = max(_now - self.__last_check, 1e-3)
+        self.__last_check = _now
+        _busy = 0.0
+        _count = 0
+        for _worker in list(self.__workers):
+            _process, _stats = _worker[0], _worker[1]
+            _total, _messages = _stats[0], _stats[1]
+            _busy += _total - _worker[2]
+            _count += _messages - _worker[3]
+            _worker[2], _worker[3] = _total, _messages
+            if not _process.is_alive():
+                _process.join()
+                self.__workers.remove(_worker)
+                if self.__retiring > 0 and _process.exitcode == 0:
+                    self.__retiring -= 1
+                else:
+                    self.loger.error('处理进程{}异常退出，退出码：{}'.format(_process.name, _process.exitcode))
+        while self.size < self.__min:
+            self.__spawn()
+
+        _size = self.size
+        _ratio = _busy / (_interval * _size)
+        _latency = _busy / _count if _count else 0.0
+        _backlog = self.__qsize() * self.__batch_size
+        _drain = _backlog * _latency / _size
+        if (_ratio > self.__busy_high or _drain > _interval) and _size < self.__max:
+            self.__idle = 0
+            self.loger.info('处理进程增加到{}，忙碌比例：{:.2f}，积压：{}，平均耗时：{:.6f}秒'.format(
+                _size + 1, _ratio, _backlog, _latency))
+            self.__spawn()
+        elif _backlog == 0 and _ratio < self.__busy_low and _size > self.__min:
+            self.__idle += 1
+            if self.__idle >= self.__idle_checks:
+                self.__idle = 0
+                self.loger.info('处理进程减少到{}，忙碌比例：{:.2f}'.format(_size - 1, _ratio))
+                self.__retire()
+        else:
+            self.__idle = 0
+        return self.size
+
+    def stop(self, timeout=None):
+        '''
+        给每个处理进程放入结束标记，等待处理完队列中的消息后退出
+        :param timeout: 每个进程的最长等待时间（秒）
+        '''
+        for i in range(len(self.__workers) - self.__retiring):
+            self.__queue.put(None)
+        for _worker in self.__workers:
+            _worker[0].join(timeout)
+        self.__workers = list()
+        self.__retiring = 0
+
+    def __spawn(self):
+        self.__serial += 1
+        _stats = multiprocessing.Array('d', 2)
+        _process = multiprocessing.Process(target=ignore_interrupt,
+                                           args=(self.__target, self.__queue, 'handler-{}'.format(self.__serial),
+                                                 _stats),
+                                           kwargs=self.__kwargs)
+        _process.daemon = True
+        _process.start()
+        self.__workers.append([_process, _stats, 0.0, 0.0])
+
+    def __retire(self):
+        # 结束标记排在已有消息之后，先取到的进程退出
+        self.__retiring += 1
+        self.__queue.put(None)
+
+    def __qsize(self):
+        try:
+            return self.__queue.qsize()
+        except NotImplementedError:
+            return 0
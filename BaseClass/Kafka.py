@@ -5,16 +5,43 @@
 # @Date  : 2018-08-24
 # @Desc  : Kafka操作的基础类，此类封装基本操作，主要用于设计服务端和前置端应用时使用
 
-from pykafka import KafkaClient
-from pykafka.common import CompressionType
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from collections import deque
+from queue import Empty
+import functools
+import hashlib
 import json
+import threading
+import time
 
+from BaseClass import Chunking
+from BaseClass.Compression import CompressionPolicy, make_policy
+from BaseClass.Envelope import Envelope
+from BaseClass import Codec
+from BaseClass.LagMonitor import FetchController, LagMonitor
 from BaseClass.Log import Loger
+from BaseClass.MarketCache import MarketCache
+from BaseClass.MarketIndex import MarketIndex
+from BaseClass import Metrics
+from BaseClass.Pool import get_pool
+from BaseClass.Offsets import OffsetTracker
+from BaseClass.Router import ReplyRouter
+from BaseClass.SingleFlight import SingleFlight
+from BaseClass.Transport import PykafkaTransport
 
 
 class Kafka(object):
+    # 为True时command收到的是Envelope对象（通过message.json取解析结果，只解析一次），否则是解码后的字符串
+    use_envelope = False
+    # 纯函数指令（结果只由action和data决定），配置了回复缓存时相同的请求直接使用缓存的结果
+    pure_actions = ()
 
-    def __init__(self, hosts, loger=None, encoding='utf-8', max_buf=999950, max_retry=4, debug=False):
+    def __init__(self, hosts, loger=None, encoding='utf-8', max_buf=999950, max_retry=4, debug=False,
+                 compression='gzip', codec='json', metrics=0, response_cache=None,
+                 coalesce=False, coalesce_ttl=0, on_expired='drop',
+                 transport=None, chunking=True, max_chunk_bytes=256 * 1024 * 1024, chunk_timeout=60,
+                 stream_chunks=False):
         '''
         初始化
 
@@ -23,55 +50,127 @@ class Kafka(object):
         :param encoding: 编码格式
         :param max_buf: 最大收发数据大小
         :param debug: 是否调试模式，如果是调试模式，cosumer将使用simple_consumer,否则使用balance_consumer
+        :param compression: 压缩方式，'none'、'snappy'、'lz4'、'gzip'、'adaptive'或者CompressionPolicy对象，
+                            小消息、对延迟敏感的主题建议使用'none'或者'snappy'/'lz4'
+        :param codec: 发送消息对象（dict/list）时的编码方式，'json'、'fastjson'、'msgpack'或者Codec对象；
+                      接收时按消息头自动识别，不带消息头的按json解析，新旧编码可以混用
+        :param metrics: 运行指标的抽样间隔，每多少条消息记录一次各阶段耗时，0表示不记录；
+                        指标通过Metrics.get_registry()的start_http/start_dump输出
+        :param response_cache: 回复缓存（ResponseCache对象），重复投递的请求直接发送缓存的回复，不再执行command；
+                               pure_actions中的指令按action和data缓存结果，为None时不使用缓存
+        :param coalesce: 是否合并相同的请求，action和data都相同的requestAndResponse同时在等待回复时只发送一次，
+                         共用同一个回复（sessionid换成各自的）
+        :param coalesce_ttl: 合并模式下成功（code为0）的回复继续使用的时间（秒），0表示不缓存
+        :param on_expired: 收到已超过截止时间（deadline）的请求时的处理方式，
+                           'drop'为不执行command直接丢弃，'fail'为不执行command并回复code为-5的失败信息
+        :param transport: 传输层（Transport对象），默认为连接hosts的PykafkaTransport；
+                          使用MemoryTransport时同一进程内的实例直接交换消息，hosts可以为空；
+                          行情快照缓存（start_market_cache等）只支持pykafka
+        :param chunking: 编码后超过max_buf的消息是否拆成多块发送，接收时自动重组
+        :param max_chunk_bytes: 重组未收齐的大消息最多占用的内存（字节）
+        :param chunk_timeout: 大消息的块最长等待时间（秒），超过时丢弃未收齐的消息
+        :param stream_chunks: 为True时大消息不重组，command收到ChunkStream对象，迭代时逐块接收，
+                              只能用于顺序模式的waitForAction
         '''
         if loger:
             self.loger = loger
         else:
             self.loger = Loger('Kafka', 'debug')
         self.__run = False
-        if not hosts:
+        self.__draining = False
+        if not hosts and transport is None:
             self.loger.error('Kafka服务器地址为空.')
         self.__hosts = hosts
+        self.__transport = transport or PykafkaTransport(hosts)
+        self.__chunking = chunking
+        self.__chunk_timeout = chunk_timeout
+        self.__stream_chunks = stream_chunks
+        self.__reassembler = Chunking.Reassembler(max_chunk_bytes, chunk_timeout, self.loger)
+        self.__backlog = deque()    # 流式读取大消息时收到的其他消息
+        self.__committed = dict()   # 分区号 -> waitForAction已提交的offset
         self.__encoding = encoding
         self.__max_buf = max_buf
         self.__max_retry = max_retry
         self.__debug = debug
         self.__application = None
-        self.__client = None
         self.__producer = None
+        self.__producers = dict()
+        self.__policy = make_policy(compression, self.loger)
+        self.__codec = Codec.get_codec(codec)
         self.__consumer = None
+        self.__lag_monitor = None
+        self.__fetch_controller = None
+        self.__router = None
+        self.__reply_timeout = None
+        self.__reports = False
+        self.__max_inflight = 0
+        self.__on_delivery = None
+        self.__local = threading.local()
+        self.__markets = dict()
+        self.__stages = None
+        self.__rpc = None
+        self.__response_cache = response_cache
+        self.__flight = SingleFlight(coalesce_ttl) if coalesce else None
+        self.__on_expired = on_expired
+        self.__request_timeout = None
+        self.__deadline_skew = 0
+        self.__expired_total = None
+        if metrics:
+            _registry = Metrics.get_registry()
+            self.__stages = Metrics.Stages('kafka', ('consume', 'decode', 'command', 'produce', 'commit'),
+                                           metrics, _registry)
+            self.__rpc = (_registry.histogram('kafka_rpc_seconds', 'requestAndResponse往返耗时'),
+                          _registry.counter('kafka_rpc_total', 'requestAndResponse请求数'),
+                          _registry.counter('kafka_rpc_timeout_total', 'requestAndResponse超时数'),
+                          _registry.counter('kafka_rpc_coalesced_total', 'requestAndResponse合并的请求数'))
+            self.__expired_total = _registry.counter('kafka_expired_total', '超过截止时间未执行的请求数')
 
-    def __init_producer(self, out_topic):
+    def __init_producer(self, out_topic, linger_ms=0, batch_size=None, delivery_reports=False):
         '''
         初始化Producer
         :param out_topic: 主题名
+        :param linger_ms: 消息在发送队列中最多等待多久凑成一批（毫秒），0表示立即发送
+        :param batch_size: 发送队列积累到多少条消息时立即发送一批
+        :param delivery_reports: 是否接收发送结果报告
         :return: 正确初始化返回true
         '''
         if not out_topic:
             self.loger.error('主题名不能为空.')
             return False
-        if not self.__hosts:
+        if isinstance(self.__transport, PykafkaTransport) and not self.__hosts:
             self.loger.error('Kafka服务器地址为空，初始化失败.')
             return False
         try:
-            if self.__client is None:
-                self.__client = KafkaClient(hosts=self.__hosts)
             if not isinstance(out_topic, bytes):
                 out_topic = out_topic.encode(self.__encoding)
-            self.__producer = (self.__client.topics[out_topic]).get_producer(max_request_size=self.__max_buf,
-                                                                             compression=CompressionType.GZIP,
-                                                                             linger_ms=0)
+            _kwargs = dict()
+            if batch_size:
+                _kwargs['min_queued_messages'] = batch_size
+            # 每种可能用到的压缩方式各建一个producer，发送时按压缩策略选择
+            for _codec in self.__policy.codecs:
+                _compression = CompressionPolicy.compression_type(_codec)
+                self.__producers[_codec] = self.__transport.producer(
+                    out_topic,
+                    max_request_size=self.__max_buf,
+                    compression=_compression,
+                    linger_ms=linger_ms,
+                    delivery_reports=delivery_reports,
+                    partitioner=Chunking.key_partitioner,
+                    **_kwargs)
+            self.__producer = self.__producers[self.__policy.codecs[0]]
+            self.__reports = delivery_reports
             return True
         except Exception as e:
             self.loger.error('初始化producer异常：{}'.format(e))
             return False
 
-    def __init_consumer(self, in_topic, consumer_group, consumer_timeout=0, balance=False):
+    def __init_consumer(self, in_topic, consumer_group, consumer_timeout=0, balance=False, lag_interval=5):
         '''
         初始化Consumer
         :param in_topic: 主题名
         :param consumer_group: 消费者组名
         :param balance: 是否进行负载均衡
+        :param lag_interval: 消费延迟查询结果的缓存时间（秒）
         :return: 正确初始化返回true
         '''
         if not in_topic:
@@ -80,23 +179,19 @@ class Kafka(object):
         if not consumer_group:
             self.loger.error('消费者组名不能为空.')
             return False
-        if not self.__hosts:
+        if isinstance(self.__transport, PykafkaTransport) and not self.__hosts:
             self.loger.error('Kafka服务器地址为空，初始化失败.')
             return False
         try:
-            if self.__client is None:
-                self.__client = KafkaClient(hosts=self.__hosts)
             if not isinstance(in_topic, bytes):
                 in_topic = in_topic.encode(self.__encoding)
             if not isinstance(consumer_group, bytes):
                 consumer_group = consumer_group.encode(self.__encoding)
-            if balance:
-                self.__consumer = (self.__client.topics[in_topic]).get_balanced_consumer(consumer_group=consumer_group,
-                                                                                         consumer_timeout_ms=consumer_timeout,
-                                                                                         managed=True)
-            else:
-                self.__consumer = (self.__client.topics[in_topic]).get_simple_consumer(consumer_group=consumer_group,
-                                                                                       consumer_timeout_ms=consumer_timeout)
+            self.__committed = dict()
+            self.__consumer = self.__transport.consumer(in_topic, consumer_group, consumer_timeout_ms=consumer_timeout,
+                                                        balance=balance)
+            self.__lag_monitor = LagMonitor(self.__transport, in_topic, consumer_group, interval=lag_interval,
+                                            loger=self.loger)
             return True
         except Exception as e:
             self.loger.error('初始化consumer异常：{}'.format(e))
@@ -109,56 +204,140 @@ class Kafka(object):
         :param in_topic: 输入主题
         :param out_topic: 输出主题
         :param consumer_group: 群组名
+        :param kwargs: consumer_timeout: consumer超时时间（毫秒）
+                       balance: 是否进行负载均衡
+                       router: 是否启用回复路由模式，启用后由后台线程按sessionid分发回复，
+                               多个线程可同时调用requestAndResponse
+                       reply_timeout: 回复路由模式下等待回复的超时时间（秒）
+                       linger_ms: producer凑批等待时间（毫秒），默认0立即发送，批量发送时调大以提高吞吐
+                       batch_size: producer发送队列积累到多少条消息时立即发送一批
+                       delivery_reports: 是否接收发送结果，启用后send_always返回Future
+                       on_delivery: 发送结果回调函数，参数为(消息内容, 异常)，发送成功时异常为None，
+                                    设置后自动启用delivery_reports
+                       max_inflight: 启用发送结果时，每个线程最多未确认的消息数，达到后阻塞等待
+                       lag_interval: lag()查询结果的缓存时间（秒），默认5
+                       adaptive_fetch: 是否按消费延迟自动调整consumer的拉取批量，
+                                       也可以是传给FetchController的参数字典，如{'high_lag': 5000}
+                       deadline: 是否给requestAndResponse发送的请求（dict）加上截止时间，
+                                 需要设置consumer_timeout或者启用回复路由模式，默认不加
+                       deadline_skew: 截止时间比等待回复的超时时间多出的秒数，容忍客户端和服务端的时钟偏差，默认1
         :return: 如果成功返回True
         '''
         if self.__run:
             self.loger.error('Kafka实例已经启动中.')
             return False
+        self.__draining = False
         if in_topic == out_topic:
             self.loger.error('输入与输出主题不能一样')
             return False
         consumer_timeout = kwargs.get('consumer_timeout', 0)
         balance = kwargs.get('balance', False)
+        consumer_kwargs = {'consumer_timeout': consumer_timeout, 'balance': balance,
+                           'lag_interval': kwargs.get('lag_interval', 5)}
+        self.__on_delivery = kwargs.get('on_delivery', None)
+        self.__max_inflight = kwargs.get('max_inflight', 10000)
+        producer_kwargs = {'linger_ms': kwargs.get('linger_ms', 0),
+                           'batch_size': kwargs.get('batch_size', None),
+                           'delivery_reports': kwargs.get('delivery_reports', False) or self.__on_delivery is not None}
         if (in_topic is None) and (out_topic is not None):
-            if self.__init_producer(out_topic):
+            if self.__init_producer(out_topic, **producer_kwargs):
                 self.__run = True
                 return True
             else:
                 return False
         if (out_topic is None) and (in_topic is not None):
-            if self.__init_consumer(in_topic, consumer_group, consumer_timeout=consumer_timeout, balance=balance):
+            if self.__init_consumer(in_topic, consumer_group, **consumer_kwargs):
                 self.__run = True
+                self.__start_fetch_controller(kwargs.get('adaptive_fetch', False))
                 return True
             else:
                 return False
-        if not self.__init_consumer(in_topic, consumer_group, consumer_timeout=consumer_timeout, balance=balance):
+        if not self.__init_consumer(in_topic, consumer_group, **consumer_kwargs):
             return False
-        if not self.__init_producer(out_topic):
+        if not self.__init_producer(out_topic, **producer_kwargs):
             return False
         self.__run = True
+        # 启用截止时间时requestAndResponse最多等待回复的时间，用来设置请求的截止时间
+        self.__request_timeout = None
+        self.__deadline_skew = kwargs.get('deadline_skew', 1)
+        if kwargs.get('deadline', False) and consumer_timeout > 0:
+            self.__request_timeout = consumer_timeout * self.__max_retry / 1000.0
+        if kwargs.get('router', False):
+            if consumer_timeout > 0:
+                self.__reply_timeout = kwargs.get('reply_timeout', consumer_timeout * self.__max_retry / 1000.0)
+            else:
+                self.__reply_timeout = kwargs.get('reply_timeout', 30)
+            if kwargs.get('deadline', False):
+                self.__request_timeout = self.__reply_timeout
+            self.__router = ReplyRouter(self.__consumer_value, self.__get_session, loger=self.loger)
+            self.__router.start()
+        self.__start_fetch_controller(kwargs.get('adaptive_fetch', False))
         self.loger.info("****START**** Kafka启动成功.")
         return True
 
+    def __start_fetch_controller(self, adaptive_fetch):
+        if not adaptive_fetch:
+            return
+        _kwargs = dict(adaptive_fetch) if isinstance(adaptive_fetch, dict) else dict()
+        _kwargs.setdefault('min_bytes', self.__max_buf)
+        self.__fetch_controller = FetchController(self.__consumer, self.__lag_monitor, loger=self.loger, **_kwargs)
+        self.__fetch_controller.start()
+
+    def lag(self, refresh=False):
+        '''
+        输入主题各分区的消费延迟（最新offset与本消费者组已提交offset的差），结果缓存lag_interval秒
+        :param refresh: 是否忽略缓存重新查询
+        :return: {分区号: {'latest', 'committed', 'lag', 'rate'}}，rate为延迟每秒的变化，见LagMonitor.lag；
+                 没有启动consumer时返回None
+        '''
+        if self.__lag_monitor is None:
+            self.loger.error('consumer没有启动，无法查询消费延迟.')
+            return None
+        return self.__lag_monitor.lag(refresh)
+
+    def drain(self):
+        '''
+        停止接收新的请求：waitForAction处理完当前的消息（工作池模式下为所有在途消息）、
+        发送回复并提交offset后返回，之后调用stop()关闭连接。
+        可以在信号处理函数中调用，配合start时设置consumer_timeout，空闲时也能及时返回
+        :return:
+        '''
+        self.__draining = True
+
+    @property
+    def draining(self):
+        return self.__draining
+
     def stop(self):
         '''
         关闭producer和consumer，并销毁kafka实例
+        先停止producer（等待发送队列中的消息发送完成），再停止consumer
 
         :return: 如果成功返回True
         '''
         self.__run = False
         try:
+            if self.__router:
+                self.__router.stop(timeout=1)
+                self.__router = None
+            if self.__fetch_controller:
+                self.__fetch_controller.stop(timeout=1)
+                self.__fetch_controller = None
             if self.__producer:
-                self.__producer.stop()
+                if self.__reports:
+                    self.__drain_reports(0, timeout=5)
+                for _producer in self.__producers.values():
+                    _producer.stop()
+                self.__producers = dict()
                 self.__producer = None
             if self.__consumer:
                 self.__consumer.stop()
                 self.__consumer = None
-            if self.__client:
-                self.__client = None
+                self.__lag_monitor = None
             self.loger.info('****STOP**** Kafka实例停止运行.')
             return True
         except Exception as e:
-            self.loger.error('停止失败，原因：'.format(e))
+            self.loger.error('停止失败，原因：{}'.format(e))
             return False
 
     def __producer_send(self, message):
@@ -170,63 +349,368 @@ class Kafka(object):
         if not self.__run:
             self.loger.error('Kafka实例未启动.')
             return False
-        if len(message) > self.__max_buf:
-            self.loger.error('消息大小为：{},已超过系统显示{}字节'.format(len(message), self.__max_buf))
-            return False
+        if isinstance(message, (dict, list)):
+            if self.__transport.objects:
+                # 内存传输层直接传递对象，不编码、不压缩
+                return self.__produce_object(message)
+            message = Codec.encode(message, self.__codec)
         try:
+            # 按编码后的字节数检查大小
             if not isinstance(message, bytes):
                 message = message.encode(self.__encoding)
-            self.__producer.produce(message)
+            if not Chunking.fits(len(message), self.__max_buf):
+                if self.__chunking:
+                    return self.__produce_chunks(message)
+                self.loger.error('消息大小为：{},已超过系统显示{}字节'.format(len(message), self.__max_buf))
+                return False
+            _codec = self.__policy.choose(len(message))
+            _producer = self.__producers[_codec]
+            _msg = _producer.produce(message)
+            self.__policy.record(_codec, message)
+            if self.__reports:
+                return self.__track_delivery(_msg, _producer)
             return True
         except Exception as e:
             self.loger.error('发送消息出错：{}'.format(e))
             return False
 
-    def __consumer_get(self):
+    def __produce_chunks(self, message):
         '''
-        获取信息
-        :return: 返回获取到的信息，如果无信息或者超时返回None
+        把大消息拆成多块发送，所有块使用同一个partition_key进入同一分区，
+        并且按整条消息的大小选择一个producer发送所有的块，不同producer之间不保证顺序
+        :param message: 编码后的消息（bytes）
+        :return: 全部发送成功返回True，需要发送结果报告时返回最后一块的Future
+        '''
+        _key, _chunks = Chunking.split(message, self.__max_buf)
+        _codec = self.__policy.choose(len(message))
+        _producer = self.__producers[_codec]
+        _result = True
+        for _chunk in _chunks:
+            _msg = _producer.produce(_chunk, partition_key=_key)
+            self.__policy.record(_codec, _chunk)
+            if self.__reports:
+                _result = self.__track_delivery(_msg, _producer)
+        self.loger.debug('消息大小为：%s字节，分块发送', len(message))
+        return _result
+
+    def __produce_object(self, message):
+        try:
+            _msg = self.__producer.produce(message)
+            if self.__reports:
+                return self.__track_delivery(_msg, self.__producer)
+            return True
+        except Exception as e:
+            self.loger.error('发送消息出错：{}'.format(e))
+            return False
+
+    def __pending_reports(self):
+        '''
+        当前线程未确认的消息，pykafka的发送结果只能在发送消息的线程中获取
+        :return: {id(msg): (msg, future, producer)}
+        '''
+        _pending = getattr(self.__local, 'pending', None)
+        if _pending is None:
+            _pending = self.__local.pending = dict()
+        return _pending
+
+    def __track_delivery(self, msg, producer):
+        '''
+        登记一条等待发送结果的消息，未确认的消息达到max_inflight时阻塞等待
+        :param msg: produce返回的消息对象
+        :param producer: 发送该消息的producer
+        :return: 发送完成后得到结果的Future
+        '''
+        _future = Future()
+        self.__pending_reports()[id(msg)] = (msg, _future, producer)
+        self.__drain_reports(self.__max_inflight - 1)
+        return _future
+
+    def __drain_reports(self, max_pending, timeout=None):
+        '''
+        处理当前线程的发送结果，直到未确认的消息不超过max_pending
+        :param max_pending: 允许保留的未确认消息数，超过时阻塞等待
+        :param timeout: 每次阻塞等待的超时时间（秒）
+        :return: 全部达到要求返回True，等待超时返回False
+        '''
+        _pending = self.__pending_reports()
+        # 先处理已经到达的结果
+        for _producer in self.__producers.values():
+            while _pending:
+                try:
+                    _msg, _exc = _producer.get_delivery_report(block=False)
+                except Empty:
+                    break
+                self.__on_report(_pending, _msg, _exc)
+        # 未确认的消息仍然过多时，阻塞等待最早发出的消息所在producer的结果
+        while len(_pending) > max_pending:
+            _producer = next(iter(_pending.values()))[2]
+            try:
+                _msg, _exc = _producer.get_delivery_report(block=True, timeout=timeout)
+            except Empty:
+                self.loger.error('等待发送结果超时，未确认消息数：{}'.format(len(_pending)))
+                return False
+            self.__on_report(_pending, _msg, _exc)
+        return True
+
+    def __on_report(self, pending, msg, exc):
+        '''
+        处理一条发送结果
+        :param pending: 当前线程未确认的消息
+        :param msg: 消息对象
+        :param exc: 发送成功为None，否则为异常
+        :return:
+        '''
+        _entry = pending.pop(id(msg), None)
+        if _entry is None:
+            return
+        _future = _entry[1]
+        if exc is None:
+            _future.set_result(True)
+        else:
+            self.loger.error('消息发送失败：{}'.format(exc))
+            _future.set_exception(exc)
+        if self.__on_delivery is not None:
+            try:
+                self.__on_delivery(msg.value, exc)
+            except Exception as e:
+                self.loger.error('发送结果回调出错：{}'.format(e))
+
+    def compression_stats(self):
+        '''
+        各压缩方式的发送统计，用于调整压缩策略
+        :return: {codec: {'messages':..., 'bytes_in':..., 'bytes_out':..., 'cpu_seconds':..., 'ratio':...}}
+        '''
+        return self.__policy.stats()
+
+    def flush(self, timeout=None):
+        '''
+        等待当前线程发送的消息全部得到发送结果（需要启用delivery_reports）
+        :param timeout: 每次等待发送结果的超时时间（秒），None表示一直等待
+        :return: 全部确认返回True
+        '''
+        if not self.__run or self.__producer is None:
+            self.loger.error('Kafka实例未启动.')
+            return False
+        if not self.__reports:
+            self.loger.error('未启用delivery_reports，无法等待发送结果.')
+            return False
+        return self.__drain_reports(0, timeout=timeout)
+
+    def __consumer_fetch(self):
+        '''
+        获取一条原始消息
+        :return: 返回获取到的pykafka消息对象（带分区和offset），如果无信息或者超时返回None
         '''
         if not self.__run:
             self.loger.error('Kafka实例未启动.')
             return None
         try:
-            for _msg in self.__consumer:
-                if _msg and _msg.value:
-                    return _msg.value.decode(self.__encoding)
-            return None
+            while True:
+                _msg = self.__backlog.popleft() if self.__backlog else self.__consumer_next()
+                if _msg is None or not self.__chunking or not Chunking.is_chunk(_msg.value):
+                    return _msg
+                if self.__stream_chunks:
+                    if Chunking.parse(_msg.value)[1] == 0:
+                        return Chunking.Assembled(Chunking.ChunkStream(_msg.value, self.__pull_chunk), _msg)
+                    continue
+                _value = self.__reassembler.add(_msg.value, (_msg.partition_id, _msg.offset))
+                if _value is not None:
+                    return Chunking.Assembled(_value, _msg)
         except Exception as e:
             self.loger.error('接收信息出错：{}'.format(e))
             return None
 
+    def __consumer_next(self):
+        for _msg in self.__consumer:
+            if _msg and _msg.value:
+                return _msg
+        return None
+
+    def __pull_chunk(self, chunk_id, index):
+        '''
+        流式读取大消息时接收下一块，期间收到的其他消息放入__backlog，之后由__consumer_fetch返回
+        :param chunk_id: 消息编号
+        :param index: 块序号
+        :return: 分块消息，超时返回None
+        '''
+        _deadline = time.time() + self.__chunk_timeout
+        while self.__run and time.time() < _deadline:
+            _msg = self.__consumer_next()
+            if _msg is None:
+                continue
+            if Chunking.is_chunk(_msg.value):
+                _id, _index = Chunking.parse(_msg.value)[:2]
+                if _id == chunk_id:
+                    if _index == index:
+                        return _msg.value
+                    if _index < index:
+                        continue
+                    return None
+            self.__backlog.append(_msg)
+        return None
+
+    def __consumer_get(self):
+        '''
+        获取信息
+        :return: 返回获取到的信息，如果无信息或者超时返回None
+        '''
+        _msg = self.__consumer_fetch()
+        if _msg is None:
+            return None
+        return self.__text(_msg.value)
+
+    def __text(self, value):
+        '''
+        把原始消息解码为字符串，带编码标识头的二进制消息转换为json文本
+        :param value: 原始bytes，内存传输层中可能是消息对象，stream_chunks模式下可能是ChunkStream（读取整条消息）
+        :return: 字符串
+        '''
+        if isinstance(value, Chunking.ChunkStream):
+            value = value.read()
+        if isinstance(value, bytes) and not Codec.is_tagged(value):
+            return value.decode(self.__encoding)
+        return Envelope(value, self.__encoding, self.__codec).text
+
+    def dumps(self, obj):
+        '''
+        按配置的编码方式编码消息对象，command构造反馈信息时使用
+        :param obj: 消息对象（dict/list）
+        :return: json类编码返回字符串，二进制编码返回带消息头的bytes，传输层直接传递对象时原样返回
+        '''
+        if self.__transport.objects:
+            return obj
+        _data = Codec.encode(obj, self.__codec)
+        if self.__codec.text:
+            return _data.decode('utf-8')
+        return _data
+
+    def __consumer_value(self):
+        '''
+        获取信息，不解码
+        :return: 返回获取到的原始bytes，如果无信息或者超时返回None
+        '''
+        _msg = self.__consumer_fetch()
+        if _msg is None:
+            return None
+        return _msg.value
+
+    def __wrap(self, value):
+        '''
+        把收到的原始消息转换为command的参数
+        :param value: 原始消息，bytes或者str
+        :return: use_envelope为True时返回Envelope，否则返回字符串
+        '''
+        if isinstance(value, Chunking.ChunkStream):
+            return value
+        if self.use_envelope:
+            return Envelope(value, self.__encoding, self.__codec)
+        if isinstance(value, str):
+            return value
+        return self.__text(value)
+
     def __get_session(self, message):
         '''
-        从json消息串中解析出sessionid
+        从json消息串中解析出sessionid，优先在原始消息中直接查找，不解析整条消息
         :param message: json消息串
         :return: 解析出的sessionid, 如果没有则返回None
         '''
-        if not message:
-            return None
+        if isinstance(message, dict):
+            return message.get('sessionid', None)
+        return Envelope.peek_session(message, self.__encoding, self.__codec)
+
+    def __lookup(self, value):
+        '''
+        执行command之前的检查：已经超过截止时间的请求按on_expired丢弃或者直接回复失败；
+        配置了回复缓存时查找重复的请求，pure_actions中的指令按action和data的哈希查找，
+        找到的结果换成这条请求的sessionid后重新编码，其他指令按缓存配置的sessionid或者原始内容的哈希查找
+
+        :param value: 原始消息bytes
+        :return: (回复，需要执行command时为None，丢弃时为False, 保存回复时使用的缓存键，不需要保存时为None)
+        '''
+        _cache = self.__response_cache
+        if isinstance(value, Chunking.ChunkStream):
+            return None, None
         try:
-            if isinstance(message, bytes):
-                message = message.decode(self.__encoding)
-            message = message.replace("'", '"').replace('":,', '":"",')
-            _json_msg = json.loads(message)
-            return _json_msg.get('sessionid', None)
+            if isinstance(value, str):
+                value = value.encode(self.__encoding)
+            _envelope = Envelope(value, self.__encoding, self.__codec)
+            if _envelope.expired():
+                return self.__expire(_envelope), None
+            if _cache is None:
+                return None, None
+            if self.pure_actions:
+                _action = _envelope.action
+                if _action in self.pure_actions:
+                    _data = json.dumps(_envelope.data, sort_keys=True, ensure_ascii=False, default=str)
+                    _key = ('memo', _action, hashlib.blake2b(_data.encode('utf-8'), digest_size=16).digest())
+                    _result = _cache.get(_key)
+                    if _result is None:
+                        return None, (_key, True)
+                    _result = dict(_result)
+                    _result['sessionid'] = _envelope.sessionid
+                    return self.dumps(_result), None
+            if _cache.key == 'content':
+                if not isinstance(value, bytes):
+                    value = json.dumps(value, sort_keys=True, ensure_ascii=False, default=str).encode('utf-8')
+                _key = hashlib.blake2b(value, digest_size=16).digest()
+            else:
+                _key = _envelope.sessionid
+                if _key is None:
+                    return None, None
+            _reply = _cache.get(_key)
+            if _reply is None:
+                return None, (_key, False)
+            self.loger.debug('重复的请求%s，发送缓存的回复', _key)
+            return _reply, None
         except Exception as e:
-            return None
+            self.loger.error('检查请求出错：{}'.format(e))
+            return None, None
+
+    def __expire(self, envelope):
+        '''
+        处理已经超过截止时间的请求
+        :param envelope: 请求消息
+        :return: on_expired为'fail'时返回失败回复，否则返回False（丢弃）
+        '''
+        if self.__expired_total is not None:
+            self.__expired_total.inc()
+        _sessionid = envelope.sessionid
+        self.loger.debug('请求%s已超过截止时间', _sessionid)
+        if self.__on_expired == 'fail':
+            return self.dumps({'code': -5, 'err': '请求已过期', 'sessionid': _sessionid, 'data': None})
+        return False
+
+    def __cache_store(self, cache_key, reply):
+        '''
+        保存command的回复，纯函数指令只缓存成功（code为0）的结果
+        :param cache_key: __lookup返回的缓存键
+        :param reply: command的回复
+        :return:
+        '''
+        if cache_key is None or reply is None:
+            return
+        _key, _memo = cache_key
+        try:
+            if _memo:
+                _result = Envelope(reply, self.__encoding, self.__codec).json
+                if isinstance(_result, dict) and _result.get('code', 0) == 0:
+                    self.__response_cache.put(_key, _result, self.__response_cache.memo_ttl)
+            else:
+                self.__response_cache.put(_key, reply)
+        except Exception as e:
+            self.loger.error('保存回复缓存出错：{}'.format(e))
 
     def command(self, message):
         '''
         处理远程请求命令，在具体应用中重载该方法进行具体业务逻辑处理
 
-        :param message: 远程请求消息，json字符串，格式：{'action':'command', 'sessionid':'****', 'data':{...}}
+        :param message: 远程请求消息，json字符串或者Envelope对象（use_envelope为True时），
+                        格式：{'action':'command', 'sessionid':'****', 'data':{...}}
         :return: 业务处理后的反馈信息，json字符串，格式：{'code':0, 'err':'info', 'sessionid':'****', 'data':{...}}
         '''
-        if isinstance(message, bytes):
-            message = message.decode(self.__encoding)
-        message = message.replace("'", '"').replace('":,', '":"",')
-        _json_msg = json.loads(message)
+        if not isinstance(message, Envelope):
+            message = Envelope(message, self.__encoding, self.__codec)
+        _json_msg = message.json
         _action = _json_msg.get('action')
         _sessionid = _json_msg.get('sessionid')
         _data = _json_msg.get('data')
@@ -236,62 +720,379 @@ class Kafka(object):
             _rt = {'code': 0, 'err': '{} 执行成功'.format(_action), 'sessionid': _sessionid, 'data': _data}
         else:
             _rt = {'code': -2, 'err': '未知指令 {}'.format(_action), 'sessionid': _sessionid, 'data': _data}
-        return json.dumps(_rt)
+        return self.dumps(_rt)
 
-    def waitForAction(self):
+    def command_batch(self, messages):
+        '''
+        批量处理远程请求命令，批量模式的waitForAction调用该方法
+        默认逐条调用command，需要整批处理（如批量查询数据库）时在具体应用中重载
+
+        :param messages: 远程请求消息列表
+        :return: 反馈信息列表，为None的项不发送
+        '''
+        return [self.command(message) for message in messages]
+
+    def waitForAction(self, workers=None, executor='thread', max_inflight=None, batch_size=None, batch_wait_ms=100):
         '''
         等待处理远程请求命令
+        :param workers: 并发处理的工作线程/进程数，为None时逐条顺序处理
+        :param executor: 工作池类型，'thread'为线程池，'process'为进程池（适用于CPU密集的command，
+                         子类必须定义在模块顶层，以便在子进程中重新创建实例）
+        :param max_inflight: 同时在处理中的最大消息数，达到后暂停接收，默认为workers的2倍
+                             工作池模式下offset在每次接收之后提交，建议start时设置consumer_timeout，
+                             空闲时也能及时提交已完成的消息
+        :param batch_size: 批量模式每批最多的消息数，为None时不使用批量模式；
+                           批量模式下整批交给command_batch处理，每批只提交一次offset，不能与workers同时使用
+        :param batch_wait_ms: 批量模式凑满一批最多等待的时间（毫秒）
         :return:
         '''
+        if self.__stream_chunks and (batch_size or workers):
+            self.loger.error('stream_chunks只能用于顺序模式')
+            return
+        if batch_size:
+            if workers:
+                self.loger.error('批量模式不能与工作池模式同时使用')
+                return
+            return self.__wait_batched(batch_size, batch_wait_ms)
+        if workers:
+            return self.__wait_pooled(workers, executor, max_inflight or workers * 2)
+        _stages = self.__stages
+        _timed = False
         try:
-            while self.__run:
-                message = self.__consumer_get()
-                if message is None:
+            while self.__run and not self.__draining:
+                if _stages is not None:
+                    _timed = _stages.tick()
+                    _t = Metrics.now_ns() if _timed else 0
+                _msg = self.__consumer_fetch()
+                if _msg is None:
                     continue
-                resp_msg = self.command(message)
-                if not self.__producer_send(resp_msg):
+                if _stages is not None:
+                    _stages.messages.value += 1
+                if _timed:
+                    _t = _stages.lap(_stages.consume, _t)
+                resp_msg, _cache_key = self.__lookup(_msg.value)
+                if resp_msg is None:
+                    _message = self.__wrap(_msg.value)
+                    if _timed:
+                        _t = _stages.lap(_stages.decode, _t)
+                    resp_msg = self.command(_message)
+                    self.__cache_store(_cache_key, resp_msg)
+                elif _timed:
+                    _t = _stages.lap(_stages.decode, _t)
+                if _timed:
+                    _t = _stages.lap(_stages.command, _t)
+                if resp_msg is not False and not self.__producer_send(resp_msg):
                     raise Exception('发送失败')
-                self.__consumer.commit_offsets()
+                if _timed:
+                    _t = _stages.lap(_stages.produce, _t)
+                self.__commit_handled([(_msg.partition, _msg.offset)])
+                if _timed:
+                    _stages.lap(_stages.commit, _t)
         except Exception as e:
             raise e
 
+    def __wait_batched(self, batch_size, batch_wait_ms):
+        '''
+        批量模式处理远程请求命令，每批只提交一次offset，运行指标按批抽样计时
+        :param batch_size: 每批最多的消息数
+        :param batch_wait_ms: 凑满一批最多等待的时间（毫秒）
+        :return:
+        '''
+        _stages = self.__stages
+        _timed = False
+        while self.__run and not self.__draining:
+            if _stages is not None:
+                _timed = _stages.tick()
+                _t = Metrics.now_ns() if _timed else 0
+            _batch = self.get_batch(batch_size, batch_wait_ms, raw=True)
+            if not _batch:
+                continue
+            if _stages is not None:
+                _stages.messages.value += len(_batch)
+            if _timed:
+                _t = _stages.lap(_stages.consume, _t)
+            _lookups = [self.__lookup(_msg['value']) for _msg in _batch]
+            _misses = [i for i, _lookup in enumerate(_lookups) if _lookup[0] is None]
+            _messages = [self.__wrap(_batch[i]['value']) for i in _misses]
+            if _timed:
+                _t = _stages.lap(_stages.decode, _t)
+            resp_msgs = [_lookup[0] for _lookup in _lookups]
+            if _messages:
+                for i, resp_msg in zip(_misses, self.command_batch(_messages)):
+                    self.__cache_store(_lookups[i][1], resp_msg)
+                    resp_msgs[i] = resp_msg
+            if _timed:
+                _t = _stages.lap(_stages.command, _t)
+            for resp_msg in resp_msgs:
+                if resp_msg is None or resp_msg is False:
+                    continue
+                if not self.__producer_send(resp_msg):
+                    raise Exception('发送失败')
+            if _timed:
+                _t = _stages.lap(_stages.produce, _t)
+            _last = dict()
+            for _msg in _batch:
+                _last[_msg['partition']] = max(_msg['offset'], _last.get(_msg['partition'], -1))
+            self.__commit_handled(list(_last.items()))
+            if _timed:
+                _stages.lap(_stages.commit, _t)
+
+    def __wait_pooled(self, workers, executor, max_inflight):
+        '''
+        工作池模式处理远程请求命令
+
+        command在工作池中并发执行，回复在完成时发送；每个分区只提交连续完成的offset，
+        消息乱序完成时也能保证至少一次处理。
+        :param workers: 工作线程/进程数
+        :param executor: 'thread'或者'process'
+        :param max_inflight: 同时在处理中的最大消息数
+        :return:
+        '''
+        if executor == 'process':
+            # ProcessPoolExecutor的initializer参数在3.7中加入，工作进程在第一次执行时创建实例
+            _pool = ProcessPoolExecutor(workers)
+            _submit = functools.partial(_pool.submit, _pool_command,
+                                        (self.__class__, self.__hosts, self.__encoding, self.__codec.name))
+        else:
+            _pool = ThreadPoolExecutor(workers)
+            _submit = functools.partial(_pool.submit, self.command)
+        _tracker = OffsetTracker()
+        _slots = threading.BoundedSemaphore(max_inflight)
+        _errors = list()
+
+        _stages = self.__stages
+
+        def _on_done(msg, begin, cache_key, future):
+            try:
+                resp_msg = future.result()
+                self.__cache_store(cache_key, resp_msg)
+                if begin:
+                    # 工作池模式下command耗时包含在池中排队的时间
+                    begin = _stages.lap(_stages.command, begin)
+                if resp_msg is not False and not self.__producer_send(resp_msg):
+                    raise Exception('发送失败')
+                if begin:
+                    _stages.lap(_stages.produce, begin)
+                _tracker.done(msg.partition, msg.offset)
+            except Exception as e:
+                # 不标记完成，offset停在这条消息之前，重启后重新投递
+                _errors.append(e)
+            finally:
+                _slots.release()
+
+        try:
+            while self.__run and not self.__draining and not _errors:
+                # 在途消息达到上限时阻塞，形成背压
+                _slots.acquire()
+                _msg = self.__consumer_fetch()
+                if _msg is None:
+                    _slots.release()
+                else:
+                    _tracker.add(_msg.partition, _msg.offset)
+                    _begin = 0
+                    if _stages is not None:
+                        _stages.messages.value += 1
+                        if _stages.tick():
+                            _begin = Metrics.now_ns()
+                    _cached, _cache_key = self.__lookup(_msg.value)
+                    if _cached is None:
+                        _future = _submit(self.__wrap(_msg.value))
+                    else:
+                        # 过期和重复的请求不进工作池，直接丢弃或者发送缓存的回复
+                        _future = Future()
+                        _future.set_result(_cached)
+                    _future.add_done_callback(functools.partial(_on_done, _msg, _begin, _cache_key))
+                self.__commit_tracked(_tracker)
+        finally:
+            _pool.shutdown(wait=True)
+            self.__commit_tracked(_tracker)
+        if _errors:
+            raise _errors[0]
+
+    def __commit_tracked(self, tracker):
+        '''
+        提交跟踪器中连续完成的offset
+        :param tracker: OffsetTracker对象
+        :return:
+        '''
+        _offsets = tracker.committable()
+        if _offsets and self.__consumer is not None:
+            self.__commit_handled(_offsets)
+
+    def __commit_handled(self, offsets):
+        '''
+        提交已经处理完的消息的offset。不越过未收齐的大消息的第一块和流式读取时暂存、还没有处理的消息，
+        崩溃重启后这些消息会重新投递，保证至少一次处理
+        :param offsets: [(分区或者分区号, 最后处理完的offset)]
+        :return:
+        '''
+        _commits = list()
+        for _partition, _offset in offsets:
+            _id = getattr(_partition, 'id', _partition)
+            # pykafka提交的是下一条待读取的offset
+            _next = _offset + 1
+            _floor = self.__reassembler.floor(_id)
+            if _floor is not None:
+                _next = min(_next, _floor)
+            for _msg in self.__backlog:
+                if _msg.partition_id == _id:
+                    # __backlog按接收顺序保存，同一分区的第一条offset最小
+                    _next = min(_next, _msg.offset)
+                    break
+            if _next <= self.__committed.get(_id, -1):
+                continue
+            self.__committed[_id] = _next
+            if not hasattr(_partition, 'id'):
+                _partition = self.__consumer.partitions[_id]
+            _commits.append((_partition, _next))
+        if _commits:
+            self.__consumer.commit_offsets(_commits)
+
     def requestAndResponse(self, message):
         '''
         发送远程请求指令，并等待指令结果
-        :param message: 发送给远程的指令，json字符串，格式：{'action':'command', 'sessionid':'****', 'data':{...}}
+        :param message: 发送给远程的指令，json字符串或者dict（按codec编码），
+                        格式：{'action':'command', 'sessionid':'****', 'data':{...}}
         :return: 指令结果，json字符串，格式：{'code':0, 'err':'info', 'sessionid':'****', 'data':{...}}
         '''
+        message = self.__with_deadline(message)
+        _request = self.__request if self.__flight is None else self.__request_coalesced
+        if self.__rpc is not None:
+            _begin = Metrics.now_ns()
+            resp_msg = _request(message)
+            _histogram, _total = self.__rpc[:2]
+            _histogram.record_ns(Metrics.now_ns() - _begin)
+            _total.inc()
+            return resp_msg
+        return _request(message)
+
+    def __with_deadline(self, message):
+        '''
+        按等待回复的超时时间加上时钟偏差的余量给请求加上截止时间（deadline，毫秒时间戳），
+        服务端不再执行超过截止时间的请求；没有启用deadline、请求不是dict或者已经有deadline时原样返回，
+        字符串和bytes请求不解析、不重新编码
+        :param message: 发送给远程的指令
+        :return: 加上deadline的指令
+        '''
+        if not self.__request_timeout or not isinstance(message, dict) or 'deadline' in message:
+            return message
+        message = dict(message)
+        message['deadline'] = int((time.time() + self.__request_timeout + self.__deadline_skew) * 1000)
+        return message
+
+    def __request_coalesced(self, message):
+        '''
+        合并模式下发送请求，action和data相同的请求正在等待回复时共用该回复
+        :param message: 发送给远程的指令
+        :return: 指令结果，json字符串，sessionid为本次请求的sessionid
+        '''
+        try:
+            _json = message if isinstance(message, dict) else Envelope(message, self.__encoding, self.__codec).json
+            _key = json.dumps([_json.get('action'), _json.get('data')], sort_keys=True, ensure_ascii=False, default=str)
+            _key = hashlib.blake2b(_key.encode('utf-8'), digest_size=16).digest()
+        except Exception as e:
+            self.loger.error('请求无法合并，原因：{}'.format(e))
+            return self.__request(message)
+        resp_msg, _shared = self.__flight.do(_key, functools.partial(self.__request, message), self.__cacheable)
+        if not _shared:
+            return resp_msg
+        if self.__rpc is not None:
+            self.__rpc[3].inc()
+        try:
+            _rt = json.loads(resp_msg)
+            _rt['sessionid'] = _json.get('sessionid')
+            return json.dumps(_rt)
+        except Exception:
+            return resp_msg
+
+    @staticmethod
+    def __cacheable(resp_msg):
+        try:
+            return json.loads(resp_msg).get('code') == 0
+        except Exception:
+            return False
+
+    def __request(self, message):
+        '''
+        发送请求并等待回复，requestAndResponse的具体实现
+        '''
         try:
             sessionid = self.__get_session(message)
             if sessionid is None:
                 self.loger.error('待发送的信息没有sessionid,发送失败')
                 return json.dumps({'code': -1, 'err': '没有session值', 'sessionid': None, 'data': None})
+            if self.__router is not None:
+                return self.__request_routed(message, sessionid)
             if not self.__producer_send(message):
                 return json.dumps({'code': -2, 'err': '发送远程请求失败', 'sessionid': sessionid, 'data': None})
+            # 持续收到其他请求的回复时每次重试的等待会超过consumer_timeout，启用截止时间时到期就不再等待
+            _give_up = time.time() + self.__request_timeout if self.__request_timeout else None
             for i_retry in range(self.__max_retry):
                 while self.__run:
-                    resp_msg = self.__consumer_get()
+                    if _give_up is not None and time.time() >= _give_up:
+                        break
+                    resp_msg = self.__consumer_value()
                     if resp_msg is None:
                         break
+                    # 在原始bytes上取sessionid，不属于自己的回复不解码、不解析
                     resp_sessionid = self.__get_session(resp_msg)
                     if sessionid == resp_sessionid:
-                        resp_msg = resp_msg.replace("'", '"').replace('":,', '":"",')
-                        # js_msg = json.loads(resp_msg)
-                        # return json.dumps(js_msg)
-                        return resp_msg
+                        return Envelope(resp_msg, self.__encoding, self.__codec).legacy_text
                 self.loger.error('获取超时，尝试第{}次重新获取.'.format(i_retry+1))
+            self.__count_timeout()
             return json.dumps({'code': -3, 'err': '获取回复超时', 'sessionid': sessionid, 'data': None})
         except Exception as e:
             self.loger.error('发生异常：{}'.format(e))
             return json.dumps({'code': -7, 'err': '其他异常：{}'.format(e), 'sessionid': None, 'data': None})
 
+    def __request_routed(self, message, sessionid):
+        '''
+        回复路由模式下发送请求，并等待路由线程投递回复
+        :param message: 发送给远程的指令
+        :param sessionid: 指令的sessionid
+        :return: 指令结果，json字符串
+        '''
+        _future = self.__router.register(sessionid)
+        if _future is None:
+            self.loger.error('sessionid:{} 已有请求在等待回复'.format(sessionid))
+            return json.dumps({'code': -4, 'err': 'sessionid重复', 'sessionid': sessionid, 'data': None})
+        if not self.__producer_send(message):
+            self.__router.cancel(sessionid)
+            return json.dumps({'code': -2, 'err': '发送远程请求失败', 'sessionid': sessionid, 'data': None})
+        try:
+            resp_msg = _future.result(self.__reply_timeout)
+        except FutureTimeoutError:
+            self.__router.cancel(sessionid)
+            self.loger.error('sessionid:{} 获取回复超时'.format(sessionid))
+            self.__count_timeout()
+            return json.dumps({'code': -3, 'err': '获取回复超时', 'sessionid': sessionid, 'data': None})
+        return Envelope(resp_msg, self.__encoding, self.__codec).legacy_text
+
+    def __count_timeout(self):
+        if self.__rpc is not None:
+            self.__rpc[2].inc()
+
     def send_always(self, msg):
         '''
         可持续发送信息到主题
         :param msg: 发送的信息内容
-        :return:
+        :return: 启用delivery_reports时返回Future，通过result()获取发送结果，否则放入发送队列成功返回True，
+                 失败均返回False
         '''
-        self.__producer_send(msg)
+        return self.__producer_send(msg)
+
+    def send_many(self, messages):
+        '''
+        批量发送信息到主题，messages可以是生成器，边生成边发送，不会整体读入内存
+        启用delivery_reports时，未确认的消息达到max_inflight后会阻塞等待，结束后调用flush()等待全部确认
+        :param messages: 可迭代的信息内容
+        :return: 成功放入发送队列的信息数
+        '''
+        _count = 0
+        for msg in messages:
+            if self.__producer_send(msg):
+                _count += 1
+        return _count
 
     def get_always(self):
         '''
@@ -300,6 +1101,43 @@ class Kafka(object):
         '''
         return self.__consumer_get()
 
+    def get_batch(self, max_messages=100, max_wait_ms=100, raw=False):
+        '''
+        批量从主题接收信息，凑满max_messages条或者等待超过max_wait_ms后返回
+        接收后不会自动提交offset，处理完一批后调用commitOffsets()
+
+        :param max_messages: 每批最多的消息数
+        :param max_wait_ms: 最多等待的时间（毫秒）
+        :param raw: 为True时value为未解码的原始bytes
+        :return: 信息列表，每项格式：{'partition': 分区号, 'offset': offset, 'value': 信息内容}，超时没接收到返回空列表
+        '''
+        _batch = list()
+        if not self.__run:
+            self.loger.error('Kafka实例未启动.')
+            return _batch
+        _deadline = time.time() + max_wait_ms / 1000.0
+        try:
+            while len(_batch) < max_messages:
+                _msg = self.__consumer.consume(block=False)
+                if _msg is None:
+                    _remain = _deadline - time.time()
+                    if _remain <= 0:
+                        break
+                    time.sleep(min(0.002, _remain))
+                    continue
+                if self.__chunking and Chunking.is_chunk(_msg.value):
+                    _value = self.__reassembler.add(_msg.value, (_msg.partition_id, _msg.offset))
+                    if _value is None:
+                        continue
+                    _msg = Chunking.Assembled(_value, _msg)
+                if _msg.value:
+                    _batch.append({'partition': _msg.partition_id,
+                                   'offset': _msg.offset,
+                                   'value': _msg.value if raw else self.__text(_msg.value)})
+        except Exception as e:
+            self.loger.error('接收信息出错：{}'.format(e))
+        return _batch
+
     def send_msg(self, topic, msg):
         '''
         向指定主题发送一条信息
@@ -308,12 +1146,37 @@ class Kafka(object):
         :param msg: 信息内容
         :return: 发送成功则返回true
         '''
-        if not self.start(out_topic=topic):
+        if not topic:
+            self.loger.error('主题名不能为空.')
             return False
-        if not self.__producer_send(msg):
+        if isinstance(self.__transport, PykafkaTransport) and not self.__hosts:
+            self.loger.error('Kafka服务器地址为空，发送失败.')
+            return False
+        if not isinstance(topic, bytes):
+            topic = topic.encode(self.__encoding)
+        try:
+            if isinstance(msg, (dict, list)) and self.__transport.objects:
+                self.__transport.shared_producer(topic).produce(msg)
+                return True
+            if isinstance(msg, (dict, list)):
+                msg = Codec.encode(msg, self.__codec)
+            elif not isinstance(msg, bytes):
+                msg = msg.encode(self.__encoding)
+            if not Chunking.fits(len(msg), self.__max_buf):
+                self.loger.error('消息大小为：{},已超过系统显示{}字节'.format(len(msg), self.__max_buf))
+                return False
+            # 使用连接池中共享的producer，不需要每次重新连接
+            _codec = self.__policy.choose(len(msg))
+            _producer = self.__transport.shared_producer(topic,
+                                                         max_request_size=self.__max_buf,
+                                                         compression=CompressionPolicy.compression_type(_codec),
+                                                         linger_ms=0)
+            _producer.produce(msg)
+            self.__policy.record(_codec, msg)
+            return True
+        except Exception as e:
+            self.loger.error('发送消息出错：{}'.format(e))
             return False
-        self.stop()
-        return True
 
     def get_msg(self, topic, group):
         '''
@@ -323,12 +1186,28 @@ class Kafka(object):
         :param group: 群组
         :return: 获取的信息
         '''
-        if not self.start(in_topic=topic, consumer_group=group, consumer_timeout=6000):
+        if not topic or not group:
+            self.loger.error('主题名和消费者组名不能为空.')
+            return None
+        if isinstance(self.__transport, PykafkaTransport) and not self.__hosts:
+            self.loger.error('Kafka服务器地址为空，接收失败.')
+            return None
+        if not isinstance(topic, bytes):
+            topic = topic.encode(self.__encoding)
+        if not isinstance(group, bytes):
+            group = group.encode(self.__encoding)
+        try:
+            # 使用连接池中共享的consumer，不需要每次重新连接和获取offset
+            _consumer, _lock = self.__transport.shared_consumer(topic, group, consumer_timeout_ms=6000)
+            with _lock:
+                _msg = _consumer.consume()
+                if _msg is None or not _msg.value:
+                    return None
+                _consumer.commit_offsets()
+            return self.__text(_msg.value)
+        except Exception as e:
+            self.loger.error('接收信息出错：{}'.format(e))
             return None
-        rt = self.__consumer_get()
-        self.__consumer.commit_offsets()
-        self.stop()
-        return rt
 
     def commitOffsets(self):
         '''
@@ -337,16 +1216,116 @@ class Kafka(object):
         '''
         self.__consumer.commit_offsets()
 
+    def start_market_cache(self, topic, index_path=None, **kwargs):
+        '''
+        启动行情快照缓存，之后get_market直接从内存读取该主题的最新行情
+
+        :param topic: 行情主题
+        :param index_path: 行情索引文件路径，设置后同时建立(合约号, 时间) -> (分区, offset)索引，
+                           可以用get_market_at查询历史行情
+        :param kwargs: 传给MarketCache的参数，如code_field、key_func、backfill
+        :return: MarketCache对象，可用于subscribe订阅行情变化，启动失败返回None
+        '''
+        _name = topic.decode(self.__encoding) if isinstance(topic, bytes) else topic
+        if _name in self.__markets:
+            return self.__markets[_name]
+        if index_path:
+            kwargs['index'] = MarketIndex(index_path, loger=self.loger)
+        kwargs.setdefault('codec', self.__codec)
+        kwargs.setdefault('chunk_timeout', self.__chunk_timeout)
+        _cache = MarketCache(self.__hosts, topic, loger=self.loger, encoding=self.__encoding, **kwargs)
+        if not _cache.start():
+            return None
+        self.__markets[_name] = _cache
+        return _cache
+
+    def stop_market_cache(self, topic=None):
+        '''
+        停止行情快照缓存
+
+        :param topic: 行情主题，为None时停止全部
+        :return:
+        '''
+        if topic is None:
+            _names = list(self.__markets.keys())
+        else:
+            _names = [topic.decode(self.__encoding) if isinstance(topic, bytes) else topic]
+        for _name in _names:
+            _cache = self.__markets.pop(_name, None)
+            if _cache is not None:
+                _cache.stop()
+
+    def get_market_at(self, topic, code, timestamp=None):
+        '''
+        根据行情索引获取合约在指定时间（含）之前的最后一条行情，只读取这一条消息
+        需要先用start_market_cache(topic, index_path=...)启动带索引的行情缓存
+
+        :param topic: 行情主题
+        :param code: 合约号
+        :param timestamp: 毫秒时间戳，为None时取索引中最新的一条
+        :return: 行情消息字符串，没有则返回None
+        '''
+        _cache = self.__markets.get(topic.decode(self.__encoding) if isinstance(topic, bytes) else topic)
+        if _cache is None or _cache.index is None:
+            self.loger.error('主题{}没有启动带索引的行情缓存'.format(topic))
+            return None
+        _found = _cache.index.lookup(code, timestamp)
+        if _found is None:
+            return None
+        return self.__fetch_at(topic, _found[0], _found[1])
+
+    def __fetch_at(self, topic, partition_id, offset):
+        '''
+        读取指定分区、offset的一条消息
+        :return: 消息字符串，读取失败返回None
+        '''
+        _client = get_pool().get_client(self.__hosts)
+        if not isinstance(topic, bytes):
+            topic = topic.encode(self.__encoding)
+        _topic = _client.topics[topic]
+        _partition = _topic.partitions[partition_id]
+        _consumer = _topic.get_simple_consumer(partitions=[_partition], consumer_timeout_ms=1000)
+        try:
+            # reset_offsets设置的是最后已读的offset
+            _consumer.reset_offsets([(_partition, offset - 1)])
+            _msg = _consumer.consume()
+            if _msg is None or _msg.offset != offset:
+                return None
+            _value = _msg.value
+            if Chunking.is_chunk(_value):
+                # 分块的行情索引到第一块，继续读取同一条消息的其余块
+                _id = Chunking.parse(_value)[0]
+                _reassembler = Chunking.Reassembler(timeout=self.__chunk_timeout, loger=self.loger)
+                _value = _reassembler.add(_value)
+                while _value is None and _reassembler.pending:
+                    _msg = _consumer.consume()
+                    if _msg is None:
+                        return None
+                    if Chunking.is_chunk(_msg.value) and Chunking.parse(_msg.value)[0] == _id:
+                        _value = _reassembler.add(_msg.value)
+                if _value is None:
+                    return None
+            return self.__text(_value)
+        except Exception as e:
+            self.loger.error('读取分区{} offset:{}出错：{}'.format(partition_id, offset, e))
+            return None
+        finally:
+            _consumer.stop()
+
     def get_market(self, topic, code):
         '''
         根据合约号获取最新的合约行情
+        已经用start_market_cache启动该主题的行情缓存时直接从内存读取，否则回溯分区0最近的500条行情查找
         :param code:
         :return:
         '''
+        _cache = self.__markets.get(topic.decode(self.__encoding) if isinstance(topic, bytes) else topic)
+        if _cache is not None:
+            return _cache.get(code)
 
         # 向前追溯的历史数据数量
         _count = 500
-        _client = KafkaClient(self.__hosts)
+        _client = get_pool().get_client(self.__hosts)
         if not isinstance(topic, bytes):
             topic = topic.encode(self.__encoding)
         _topic = _client.topics[topic]
@@ -372,3 +1351,18 @@ class Kafka(object):
             return msgs[-1]
         else:
             return None
+
+
+# 进程池模式下，每个工作进程持有一个未启动的实例，只用来执行command
+_pool_worker = None
+
+
+def _pool_init(cls, hosts, encoding, codec):
+    global _pool_worker
+    _pool_worker = cls(hosts, encoding=encoding, codec=codec)
+
+
+def _pool_command(init, message):
+    if _pool_worker is None:
+        _pool_init(*init)
+    return _pool_worker.command(message)
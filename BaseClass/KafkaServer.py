@@ -5,17 +5,69 @@
 # @Date  : 2018-10-16
 # @Desc  : Kafka服务端封装包
 
-from pykafka import KafkaClient
+import multiprocessing
+import time
+
 from pykafka.topic import OffsetType
-from pykafka.producer import CompressionType
+
+from BaseClass import Chunking
+from BaseClass.Compression import CompressionPolicy, make_policy
+from BaseClass.Envelope import Envelope
+from BaseClass.HandlerPool import HandlerPool, ignore_interrupt
+from BaseClass.LagMonitor import FetchController, LagMonitor
+from BaseClass.Log import Loger
+from BaseClass import Metrics
+from BaseClass.ShmRing import ShmRing
+from BaseClass.Transport import PykafkaTransport
+from BaseClass import Codec
 
 class KafkaServer(object):
     '''
     针对快单手服务端，专用Python封装类
     '''
+    # 为True时handler收到的是Envelope对象（通过message.json取解析结果，只解析一次），否则是字符串
+    use_envelope = False
+
+    def __init__(self, hosts, in_topic, out_topic, group_id, encoding='utf-8', compression='gzip', codec='json',
+                 loger=None, batch_size=100, batch_wait_ms=50, metrics=0, metrics_dump=60, on_expired='drop',
+                 transport=None, max_buf=999950, adaptive_fetch=False):
+        '''
+        初始化
 
-    def __init__(self, hosts, in_topic, out_topic, group_id, encoding='utf-8'):
+        :param hosts: kafka主机地址，多个主机用逗号隔开
+        :param in_topic: 接收请求的主题
+        :param out_topic: 发送反馈的主题
+        :param group_id: 消费者组名
+        :param encoding: 编码格式
+        :param compression: 反馈的压缩方式，'none'、'snappy'、'lz4'、'gzip'、'adaptive'或者CompressionPolicy对象
+        :param codec: handler返回消息对象（dict/list）时的编码方式，'json'、'fastjson'、'msgpack'或者Codec对象
+        :param loger: 日志记录对象，每条消息的内容只在debug级别下记录
+        :param batch_size: 接收进程每次放入队列的最大消息数
+        :param batch_wait_ms: 接收进程凑批的最长等待时间（毫秒）
+        :param metrics: 运行指标的抽样间隔，每多少条消息记录一次各阶段耗时，0表示不记录
+        :param metrics_dump: 每个进程把运行指标写入日志的间隔（秒），0表示不写入
+        :param on_expired: 收到已超过截止时间（deadline）的请求时的处理方式，
+                           'drop'为不执行handler直接丢弃，'fail'为不执行handler并回复code为-5的失败信息
+        :param transport: 传输层（Transport对象），默认为连接hosts的PykafkaTransport；
+                          MemoryTransport只在同一进程内有效，需要在线程中运行各个进程函数，不能使用serve和shm_size
+        :param max_buf: 单条消息的最大字节数，编码后超过时拆成多块发送；接收进程把收到的分块消息重组后再放入队列
+        :param adaptive_fetch: 接收进程是否按消费延迟自动调整consumer的拉取批量，
+                               也可以是传给FetchController的参数字典，如{'high_lag': 5000}
+        '''
+        if loger:
+            self.loger = loger
+        else:
+            self.loger = Loger('KafkaServer', 'info')
+        self.__batch_size = max(1, batch_size)
+        self.__batch_wait_ms = batch_wait_ms
+        self.__metrics = metrics
+        self.__metrics_dump = metrics_dump
+        self.__on_expired = on_expired
         self.__hosts = hosts
+        self.__transport = transport or PykafkaTransport(hosts)
+        self.__max_buf = max_buf
+        self.__policy = make_policy(compression)
+        self.__codec = Codec.get_codec(codec)
         self.__encoding = encoding
         if not isinstance(in_topic, bytes):
             in_topic = in_topic.encode(self.__encoding)
@@ -26,51 +78,415 @@ class KafkaServer(object):
         if not isinstance(group_id, bytes):
             group_id = group_id.encode(self.__encoding)
         self.__group_id = group_id
+        self.__adaptive_fetch = adaptive_fetch
+        self.__lag_monitor = None
 
-    def get_process(self, queue, name=None):
+    def get_process(self, queue, name=None, commit_every=1, stop_event=None):
         '''
         接收请求进程
-        :param queue: 消息队列
+        消息按批放入队列（每批最多batch_size条，或者本批第一条消息等待batch_wait_ms后不满一批也放入），
+        队列满时阻塞，发送进程处理不过来时接收进程随之停下，不会无限占用内存
+        :param queue: 消息队列，用make_queue创建
         :param name: 进程名
+        :param commit_every: 每接收多少条消息提交一次offset，空闲时也会提交剩余的消息；
+                             提交的offset不越过还没有放入队列的消息和未收齐的大消息的第一块
+        :param stop_event: multiprocessing.Event，被设置后放入剩余消息、提交offset并退出
         :return:
         '''
-        print('get {} process begin..'.format(name))
-        _client = KafkaClient(hosts=self.__hosts)
-        _consumer = (_client.topics[self.__in_topic]).get_balanced_consumer(consumer_group=self.__group_id,
-                                                                            auto_offset_reset=OffsetType.LATEST,
-                                                                            managed=True)
+        self.loger.info('接收进程{}启动.'.format(name))
+        # consume的超时比凑批时间短，持续有少量消息时也能按时放入不满的一批
+        _consumer = self.__transport.consumer(self.__in_topic, self.__group_id, balance=True,
+                                              auto_offset_reset=OffsetType.LATEST,
+                                              consumer_timeout_ms=max(1, self.__batch_wait_ms // 5))
+        _controller = self.__fetch_controller(_consumer)
+        _stages = self.__open_metrics('consume', 'commit')
+        _timed = False
+        _reassembler = Chunking.Reassembler(loger=self.loger)
+        _batch = list()
+        _first = 0      # 本批第一条消息的接收时间
+        _uncommitted = 0
+        _consumed = dict()      # 分区号 -> 最后接收的offset
+        _held = dict()          # 分区号 -> 本批还没有放入队列的消息的最小offset
+        _committed = dict()     # 分区号 -> 已提交的offset
         try:
-            while True:
-                for _msg in _consumer:
-                    if _msg is not None:
-                        _value = _msg.value.decode(self.__encoding)
-                        queue.put(_value)
-                        print('[GETPROCESS {}] msg:{}'.format(name, _value))
-                        _consumer.commit_offsets()
+            while stop_event is None or not stop_event.is_set():
+                if _stages is not None:
+                    _timed = _stages.tick()
+                    _t = Metrics.now_ns() if _timed else 0
+                _msg = _consumer.consume()
+                if _timed and _msg is not None:
+                    _stages.lap(_stages.consume, _t)
+                if _msg is not None:
+                    _consumed[_msg.partition_id] = _msg.offset
+                if _msg is not None and _msg.value:
+                    # 原样传给发送进程，由发送进程按编码方式解码；分块的大消息收齐后再放入
+                    _value = _msg.value
+                    _position = (_msg.partition_id, _msg.offset)
+                    if Chunking.is_chunk(_value):
+                        _value = _reassembler.add(_value, _position)
+                        _position = _reassembler.origin
+                    if _value is not None:
+                        if not _batch:
+                            _first = time.time()
+                        _batch.append(_value)
+                        _held.setdefault(_position[0], _position[1])
+                        self.loger.debug('[GETPROCESS %s] msg:%s', name, _msg.value)
+                if _batch and (len(_batch) >= self.__batch_size or
+                               (time.time() - _first) * 1000 >= self.__batch_wait_ms):
+                    queue.put(_batch)
+                    _uncommitted += len(_batch)
+                    if _stages is not None:
+                        _stages.messages.value += len(_batch)
+                    _batch = list()
+                    _held = dict()
+                # 提交的offset只包含已经放入队列的消息
+                if _uncommitted and (_uncommitted >= commit_every or _msg is None):
+                    self.__commit(_consumer, _stages, self.__handled(_consumer, _consumed, _held, _reassembler,
+                                                                     _committed))
+                    _uncommitted = 0
+            if _batch:
+                queue.put(_batch)
+                _uncommitted += len(_batch)
+                if _stages is not None:
+                    _stages.messages.value += len(_batch)
+                _held = dict()
+            if _uncommitted:
+                self.__commit(_consumer, _stages, self.__handled(_consumer, _consumed, _held, _reassembler,
+                                                                 _committed))
         finally:
+            if _controller is not None:
+                _controller.stop(timeout=1)
             _consumer.stop()
+            self.loger.info('接收进程{}退出.'.format(name))
 
     def send_process(self, queue, name=None):
         '''
-        发送反馈进程
-        :param queue: 消息队列
+        发送反馈进程，在同一个进程中处理请求并发送反馈
+        阻塞等待队列中的消息批次，收到结束标记（None）后退出
+        :param queue: 消息队列，用make_queue创建
+        :param name: 进程名
+        :return:
+        '''
+        self.loger.info('发送进程{}启动.'.format(name))
+        _producers = self.__get_producers()
+        _stages = self.__open_metrics('handler', 'produce')
+        _timed = False
+        try:
+            while True:
+                _batch = queue.get()
+                if _batch is None:
+                    break
+                if _stages is not None:
+                    _stages.messages.value += len(_batch)
+                for _value in _batch:
+                    if _stages is not None:
+                        _timed = _stages.tick()
+                        _t = Metrics.now_ns() if _timed else 0
+                    _message = self.__handle_one(_value, name)
+                    if _timed:
+                        _t = _stages.lap(_stages.handler, _t)
+                    if _message is not None:
+                        self.__produce(_producers, _message, name)
+                        if _timed:
+                            _stages.lap(_stages.produce, _t)
+        finally:
+            for _producer in _producers.values():
+                _producer.stop()
+            self.loger.info('发送进程{}退出.'.format(name))
+
+    def handle_process(self, queue, name=None, stats=None, out_queue=None):
+        '''
+        处理进程，只执行handler，处理结果按批放入out_queue，由produce_process发送
+        :param queue: 接收进程放入请求的队列
         :param name: 进程名
+        :param stats: 共享的[处理耗时（秒）, 处理消息数]，供HandlerPool调整进程数
+        :param out_queue: 处理结果队列
         :return:
         '''
-        print('send {} process begin..'.format(name))
-        _client = KafkaClient(hosts=self.__hosts)
-        _producer = (_client.topics[self.__out_topic]).get_producer(linger_ms=0, compression=CompressionType.GZIP)
+        self.loger.info('处理进程{}启动.'.format(name))
+        _stages = self.__open_metrics('handler')
+        _timed = False
         try:
             while True:
-                if not queue.empty():
-                    _value = queue.get(True)
-                    _message = self.handler(_value)
-                    if not isinstance(_message, bytes):
-                        _message = _message.encode(self.__encoding)
-                    _producer.produce(_message)
-                    print('[SENDPROCESS {}] msg:{}'.format(name, _message))
+                _batch = queue.get()
+                if _batch is None:
+                    break
+                if _stages is not None:
+                    _stages.messages.value += len(_batch)
+                _begin = time.perf_counter()
+                _results = list()
+                for _value in _batch:
+                    if _stages is not None:
+                        _timed = _stages.tick()
+                        _t = Metrics.now_ns() if _timed else 0
+                    _message = self.__handle_one(_value, name)
+                    if _timed:
+                        _stages.lap(_stages.handler, _t)
+                    if _message is not None:
+                        _results.append(_message)
+                if _results:
+                    out_queue.put(_results)
+                if stats is not None:
+                    with stats.get_lock():
+                        stats[0] += time.perf_counter() - _begin
+                        stats[1] += len(_batch)
         finally:
-            _producer.stop()
+            self.loger.info('处理进程{}退出.'.format(name))
+
+    def produce_process(self, queue, name=None):
+        '''
+        发送进程，只发送处理进程放入队列的结果
+        :param queue: 处理结果队列
+        :param name: 进程名
+        :return:
+        '''
+        self.loger.info('发送进程{}启动.'.format(name))
+        _producers = self.__get_producers()
+        _stages = self.__open_metrics('produce')
+        try:
+            while True:
+                _batch = queue.get()
+                if _batch is None:
+                    break
+                if _stages is not None:
+                    _stages.messages.value += len(_batch)
+                for _message in _batch:
+                    if _stages is not None and _stages.tick():
+                        _t = Metrics.now_ns()
+                        self.__produce(_producers, _message, name)
+                        _stages.lap(_stages.produce, _t)
+                    else:
+                        self.__produce(_producers, _message, name)
+        finally:
+            for _producer in _producers.values():
+                _producer.stop()
+            self.loger.info('发送进程{}退出.'.format(name))
+
+    def serve(self, i_get=1, i_produce=1, min_handlers=1, max_handlers=None, shm_size=None, max_batches=1000,
+              check_interval=2, stop_event=None):
+        '''
+        分阶段运行：接收进程 -> 处理进程 -> 发送进程，各阶段进程数分别设置，
+        处理进程数在min_handlers和max_handlers之间随积压和处理耗时自动增减，
+        增加处理能力不需要增加消费者，不会引起消费者组重新分配分区。
+        在主进程中调用，阻塞直到stop_event被设置或者收到KeyboardInterrupt，然后按阶段依次退出；
+        子进程都忽略SIGINT，Ctrl+C只由主进程处理，再通过stop_event和结束标记通知子进程
+
+        :param i_get: 接收进程数
+        :param i_produce: 发送进程数
+        :param min_handlers: 最少处理进程数
+        :param max_handlers: 最多处理进程数，默认为CPU核数
+        :param shm_size: 设置时阶段之间使用共享内存环形缓冲区，见make_queue
+        :param max_batches: 阶段之间队列最多缓存的消息批次数
+        :param check_interval: 调整处理进程数的检查间隔（秒）
+        :param stop_event: multiprocessing.Event，被设置后退出
+        :return:
+        '''
+        if stop_event is None:
+            stop_event = multiprocessing.Event()
+        # 共享内存时每个接收进程写自己的通道；处理进程数会变化，写发送队列时共用一条加锁的通道
+        _in_queue = KafkaServer.make_queue(max_batches, shm_size, producers=i_get)
+        _out_queue = KafkaServer.make_queue(max_batches, shm_size, producers=0)
+        _getters = [multiprocessing.Process(target=ignore_interrupt,
+                                            args=(self.get_process, _in_queue.writer(i) if shm_size else _in_queue,
+                                                  'get-{}'.format(i)),
+                                            kwargs={'stop_event': stop_event}) for i in range(i_get)]
+        _senders = [multiprocessing.Process(target=ignore_interrupt,
+                                            args=(self.produce_process, _out_queue, 'produce-{}'.format(i)))
+                    for i in range(i_produce)]
+        _handlers = HandlerPool(self.handle_process, _in_queue, min_handlers, max_handlers,
+                                batch_size=self.__batch_size, loger=self.loger, kwargs={'out_queue': _out_queue})
+        for _process in _senders:
+            _process.start()
+        _handlers.start()
+        for _process in _getters:
+            _process.start()
+        try:
+            while not stop_event.wait(check_interval):
+                _handlers.check()
+                if not any(_process.is_alive() for _process in _getters):
+                    self.loger.error('接收进程已全部退出.')
+                    break
+        except KeyboardInterrupt:
+            pass
+        # 接收进程放入剩余消息并提交offset后退出，处理进程、发送进程处理完队列中的消息后依次退出
+        stop_event.set()
+        for _process in _getters:
+            _process.join()
+        _handlers.stop()
+        KafkaServer.shutdown(_out_queue, i_produce)
+        for _process in _senders:
+            _process.join()
+        _in_queue.close()
+        _out_queue.close()
+
+    def lag(self, refresh=False):
+        '''
+        请求主题各分区的消费延迟（最新offset与本消费者组已提交offset的差），结果缓存5秒
+        :param refresh: 是否忽略缓存重新查询
+        :return: {分区号: {'latest', 'committed', 'lag', 'rate'}}，rate为延迟每秒的变化，见LagMonitor.lag
+        '''
+        if self.__lag_monitor is None:
+            self.__lag_monitor = LagMonitor(self.__transport, self.__in_topic, self.__group_id, loger=self.loger)
+        return self.__lag_monitor.lag(refresh)
+
+    def __fetch_controller(self, consumer):
+        '''
+        启动接收进程consumer的拉取批量调整，没有设置adaptive_fetch时返回None
+        '''
+        if not self.__adaptive_fetch:
+            return None
+        _kwargs = dict(self.__adaptive_fetch) if isinstance(self.__adaptive_fetch, dict) else dict()
+        _kwargs.setdefault('min_bytes', self.__max_buf)
+        _monitor = LagMonitor(self.__transport, self.__in_topic, self.__group_id, interval=_kwargs.get('interval', 5),
+                              loger=self.loger)
+        _controller = FetchController(consumer, _monitor, prefix='kafkaserver', loger=self.loger, **_kwargs)
+        _controller.start()
+        return _controller
+
+    def __open_metrics(self, *stages):
+        '''
+        创建当前进程的阶段耗时统计，并按metrics_dump定时写入日志
+        :param stages: 阶段名
+        :return: Metrics.Stages，未启用运行指标时返回None
+        '''
+        if not self.__metrics:
+            return None
+        _registry = Metrics.get_registry()
+        if self.__metrics_dump:
+            _registry.start_dump(self.__metrics_dump, self.loger)
+        return Metrics.Stages('kafkaserver', stages, self.__metrics, _registry)
+
+    @staticmethod
+    def __handled(consumer, consumed, held, reassembler, committed):
+        '''
+        接收进程可以提交的offset：各分区最后接收的offset之后，但不越过本批还没有放入队列的消息
+        和未收齐的大消息的第一块，崩溃或者重新分配分区后这些消息会重新投递
+        :param consumed: 分区号 -> 最后接收的offset
+        :param held: 分区号 -> 还没有放入队列的消息的最小offset
+        :param reassembler: 分块消息重组对象
+        :param committed: 分区号 -> 已提交的offset，提交后更新
+        :return: [(分区, 下一条待读取的offset)]
+        '''
+        _partitions = consumer.partitions
+        _commits = list()
+        for _id, _offset in consumed.items():
+            if _id not in _partitions:
+                # 重新分配分区后已经不属于该consumer
+                continue
+            _next = _offset + 1
+            _floor = reassembler.floor(_id)
+            if _floor is not None:
+                _next = min(_next, _floor)
+            if _id in held:
+                _next = min(_next, held[_id])
+            if _next <= committed.get(_id, -1):
+                continue
+            committed[_id] = _next
+            _commits.append((_partitions[_id], _next))
+        return _commits
+
+    def __commit(self, consumer, stages, offsets):
+        if not offsets:
+            return
+        if stages is None:
+            consumer.commit_offsets(offsets)
+            return
+        _begin = Metrics.now_ns()
+        consumer.commit_offsets(offsets)
+        stages.lap(stages.commit, _begin)
+
+    def __get_producers(self):
+        _producers = dict()
+        for _codec in self.__policy.codecs:
+            _producers[_codec] = self.__transport.producer(
+                self.__out_topic, linger_ms=0, compression=CompressionPolicy.compression_type(_codec),
+                max_request_size=self.__max_buf, partitioner=Chunking.key_partitioner)
+        return _producers
+
+    def __handle_one(self, value, name):
+        '''
+        处理一条请求，处理出错时记录日志并跳过该消息
+        :return: 编码后的反馈消息，没有反馈时返回None
+        '''
+        try:
+            _value = Envelope(value, self.__encoding, self.__codec)
+            if _value.expired():
+                return self.__expire(_value, name)
+            if not self.use_envelope:
+                _value = _value.text
+            _message = self.handler(_value)
+            if _message is None:
+                return None
+            if isinstance(_message, (dict, list)):
+                if self.__transport.objects:
+                    return _message
+                return Codec.encode(_message, self.__codec)
+            elif not isinstance(_message, bytes):
+                return _message.encode(self.__encoding)
+            return _message
+        except Exception as e:
+            self.loger.error('[{}] 处理消息出错：{}'.format(name, e))
+            return None
+
+    def __expire(self, message, name):
+        '''
+        处理已经超过截止时间的请求
+        :return: on_expired为'fail'时返回编码后的失败回复，否则返回None（丢弃）
+        '''
+        if self.__metrics:
+            Metrics.get_registry().counter('kafkaserver_expired_total', '超过截止时间未执行的请求数').inc()
+        _sessionid = message.sessionid
+        self.loger.debug('[%s] 请求%s已超过截止时间', name, _sessionid)
+        if self.__on_expired == 'fail':
+            return Codec.encode({'code': -5, 'err': '请求已过期', 'sessionid': _sessionid, 'data': None}, self.__codec)
+        return None
+
+    def __produce(self, producers, message, name):
+        try:
+            if not isinstance(message, bytes):
+                # 内存传输层直接传递的对象，不压缩
+                producers[self.__policy.codecs[0]].produce(message)
+                return
+            if not Chunking.fits(len(message), self.__max_buf):
+                # 所有块经同一个producer发送，保持块的顺序
+                _key, _chunks = Chunking.split(message, self.__max_buf)
+                _codec = self.__policy.choose(len(message))
+                for _chunk in _chunks:
+                    producers[_codec].produce(_chunk, partition_key=_key)
+                    self.__policy.record(_codec, _chunk)
+                return
+            _codec = self.__policy.choose(len(message))
+            producers[_codec].produce(message)
+            self.__policy.record(_codec, message)
+            self.loger.debug('[SENDPROCESS %s] msg:%s', name, message)
+        except Exception as e:
+            self.loger.error('[SENDPROCESS {}] 发送消息出错：{}'.format(name, e))
+
+    @staticmethod
+    def make_queue(max_batches=1000, shm_size=None, producers=1):
+        '''
+        创建接收进程和发送进程之间的有界队列
+        :param max_batches: 队列中最多缓存的消息批次数
+        :param shm_size: 设置时使用共享内存环形缓冲区传递原始消息，不经过pickle和管道，
+                         每个写进程一条该大小（字节）的通道，使用完后由主进程调用close()释放
+        :param producers: 使用共享内存时的写进程数，每个写进程通过writer(i)写自己的通道；
+                          为0时写进程数不固定，共用一条加锁的通道
+        :return: multiprocessing.Queue或者ShmRing
+        '''
+        if shm_size:
+            return ShmRing(shm_size, producers=max(1, producers), multi_producer=producers == 0)
+        return multiprocessing.Queue(max_batches)
+
+    @staticmethod
+    def shutdown(queue, senders):
+        '''
+        接收进程全部退出后调用，给每个发送进程放入一个结束标记，发送进程处理完队列中的消息后退出
+        :param queue: 消息队列
+        :param senders: 发送进程数
+        :return:
+        '''
+        for i in range(senders):
+            queue.put(None)
 
     def handler(self, message):
         return message
\ No newline at end of file
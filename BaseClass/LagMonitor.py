@@ -0,0 +1,206 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# @File  : LagMonitor.py
+# @Author: Liaop
+# @Date  : 2018-11-26
+# @Desc  : 消费延迟监控：按分区比较最新offset和已提交的offset，并按延迟的增减调整consumer的拉取批量
+
+import threading
+import time
+
+from BaseClass.Log import Loger
+from BaseClass import Metrics
+
+
+class LagMonitor(object):
+    '''
+    消费延迟监控
+
+    延迟为分区最新offset与消费者组已提交offset的差，变化速度为两次查询之间延迟的变化除以间隔秒数
+    （正数表示越积越多）。查询结果缓存interval秒，多个线程、多次调用不会频繁请求broker。
+    '''
+
+    def __init__(self, transport, topic, consumer_group, interval=5, loger=None):
+        '''
+        初始化
+
+        :param transport: 传输层（Transport对象）
+        :param topic: 主题名（bytes）
+        :param consumer_group: 消费者组名（bytes）
+        :param interval: 查询结果的缓存时间（秒）
+        :param loger: 日志记录对象
+        '''
+        if loger:
+            self.loger = loger
+        else:
+            self.loger = Loger('LagMonitor', 'debug')
+        self.__transport = transport
+        self.__topic = topic
+        self.__group = consumer_group
+        self.__interval = interval
+        self.__lock = threading.Lock()
+        self.__lags = dict()        # 分区号 -> {'latest', 'committed', 'lag', 'rate'}
+        self.__checked = 0          # 上次查询的时间
+
+    def lag(self, refresh=False):
+        '''
+        各分区的消费延迟
+        :param refresh: 是否忽略缓存重新查询
+        :return: {分区号: {'latest': 最新offset, 'committed': 已提交的offset, 'lag': 延迟的消息数,
+                  'rate': 延迟每秒的变化}}，没有提交过的分区committed和lag为None；查询失败时返回上次的结果
+        '''
+        with self.__lock:
+            _now = time.time()
+            if not refresh and _now - self.__checked < self.__interval:
+                return self.__lags
+            try:
+                _latest = self.__transport.latest_offsets(self.__topic)
+                _committed = self.__transport.committed_offsets(self.__topic, self.__group)
+            except Exception as e:
+                self.loger.error('查询消费延迟异常：{}'.format(e))
+                return self.__lags
+            _elapsed = _now - self.__checked
+            _lags = dict()
+            for _id, _offset in _latest.items():
+                _done = _committed.get(_id)
+                _lag = max(0, _offset - _done) if _done is not None else None
+                _last = self.__lags.get(_id, {}).get('lag')
+                _rate = (_lag - _last) / _elapsed if _lag is not None and _last is not None else 0.0
+                _lags[_id] = {'latest': _offset, 'committed': _done, 'lag': _lag, 'rate': _rate}
+            self.__lags = _lags
+            self.__checked = _now
+            self.loger.debug('[LAG] %s %s', self.__topic, _lags)
+            return _lags
+
+    def total(self, refresh=False):
+        '''
+        所有分区合计的消费延迟
+        :return: (延迟的消息数, 延迟每秒的变化)，所有分区都没有提交过时延迟为None
+        '''
+        _lags = [v for v in self.lag(refresh).values() if v['lag'] is not None]
+        if not _lags:
+            return None, 0.0
+        return sum(v['lag'] for v in _lags), sum(v['rate'] for v in _lags)
+
+
+class FetchController(object):
+    '''
+    拉取批量自适应调整
+
+    延迟超过high_lag、或者超过low_lag且还在增长时，把consumer每次拉取的最大字节数和预取的消息数加倍，
+    一次拉取更多消息追赶积压；延迟降到low_lag以下时减半，追上后小批量拉取，降低尾部延迟。
+    调整的是pykafka consumer的fetch_message_max_bytes和queued_max_messages，下一次拉取时生效，
+    均衡consumer重新分配分区后沿用调整后的值。
+    '''
+
+    def __init__(self, consumer, monitor, min_bytes=1024 * 1024, max_bytes=16 * 1024 * 1024,
+                 min_queued=200, max_queued=20000, low_lag=100, high_lag=10000, interval=5, prefix='kafka',
+                 loger=None):
+        '''
+        初始化
+
+        :param consumer: 要调整的consumer
+        :param monitor: 该consumer所在消费者组的LagMonitor
+        :param min_bytes: 每个分区每次拉取的最小字节数，不能小于单条消息的最大字节数
+        :param max_bytes: 每个分区每次拉取的最大字节数
+        :param min_queued: 每个分区最少预取的消息数
+        :param max_queued: 每个分区最多预取的消息数
+        :param low_lag: 延迟低于该值时认为已经追上
+        :param high_lag: 延迟高于该值时认为积压
+        :param interval: 后台线程的检查间隔（秒）
+        :param prefix: 指标名前缀，当前延迟和拉取批量记录为prefix_consumer_lag等指标
+        :param loger: 日志记录对象
+        '''
+        if loger:
+            self.loger = loger
+        else:
+            self.loger = Loger('FetchController', 'debug')
+        self.__consumer = consumer
+        self.__monitor = monitor
+        self.__bytes_range = (min_bytes, max_bytes)
+        self.__queued_range = (min_queued, max_queued)
+        self.__low_lag = low_lag
+        self.__high_lag = high_lag
+        self.__interval = interval
+        self.__fetch_bytes = min(max(getattr(consumer, '_fetch_message_max_bytes', min_bytes), min_bytes), max_bytes)
+        self.__queued = min(max(getattr(consumer, '_queued_max_messages', min_queued), min_queued), max_queued)
+        self.__stop = threading.Event()
+        self.__thread = None
+        _registry = Metrics.get_registry()
+        self.__gauges = (_registry.gauge('{}_consumer_lag'.format(prefix), '消费者组未消费的消息数'),
+                         _registry.gauge('{}_consumer_lag_rate'.format(prefix), '未消费消息数每秒的变化'),
+                         _registry.gauge('{}_fetch_max_bytes'.format(prefix), '每个分区每次拉取的最大字节数'),
+                         _registry.gauge('{}_queued_max_messages'.format(prefix), '每个分区最多预取的消息数'))
+        self.__apply()
+
+    @property
+    def fetch_bytes(self):
+        return self.__fetch_bytes
+
+    @property
+    def queued(self):
+        return self.__queued
+
+    def step(self):
+        '''
+        检查一次延迟并调整拉取批量
+        :return: 调整后的(拉取字节数, 预取消息数)
+        '''
+        _lag, _rate = self.__monitor.total()
+        self.__gauges[0].set(_lag or 0)
+        self.__gauges[1].set(_rate)
+        if _lag is None:
+            return self.__fetch_bytes, self.__queued
+        if _lag > self.__high_lag or (_lag > self.__low_lag and _rate > 0):
+            _fetch_bytes = min(self.__fetch_bytes * 2, self.__bytes_range[1])
+            _queued = min(self.__queued * 2, self.__queued_range[1])
+        elif _lag <= self.__low_lag:
+            _fetch_bytes = max(self.__fetch_bytes // 2, self.__bytes_range[0])
+            _queued = max(self.__queued // 2, self.__queued_range[0])
+        else:
+            return self.__fetch_bytes, self.__queued
+        if (_fetch_bytes, _queued) != (self.__fetch_bytes, self.__queued):
+            self.loger.info('消费延迟{}（每秒{:+.1f}），拉取批量调整为{}字节/{}条'.format(_lag, _rate, _fetch_bytes, _queued))
+            self.__fetch_bytes, self.__queued = _fetch_bytes, _queued
+            self.__apply()
+        return self.__fetch_bytes, self.__queued
+
+    def __apply(self):
+        # 均衡consumer的设置在重新分配分区时传给新的内部consumer，当前的内部consumer也同时修改
+        for _consumer in (self.__consumer, getattr(self.__consumer, '_consumer', None)):
+            if _consumer is not None:
+                _consumer._fetch_message_max_bytes = self.__fetch_bytes
+                _consumer._queued_max_messages = self.__queued
+        self.__gauges[2].set(self.__fetch_bytes)
+        self.__gauges[3].set(self.__queued)
+
+    def start(self):
+        '''
+        启动后台线程，每interval秒调用一次step
+        :return: 如果成功返回True
+        '''
+        if self.__thread is not None:
+            self.loger.error('拉取批量调整已经启动中.')
+            return False
+        self.__stop.clear()
+        self.__thread = threading.Thread(target=self.__loop, name='FetchController')
+        self.__thread.daemon = True
+        self.__thread.start()
+        return True
+
+    def stop(self, timeout=None):
+        '''
+        停止后台线程
+        :param timeout: 等待线程退出的时间（秒）
+        '''
+        self.__stop.set()
+        if self.__thread is not None and self.__thread is not threading.current_thread():
+            self.__thread.join(timeout)
+        self.__thread = None
+
+    def __loop(self):
+        while not self.__stop.wait(self.__interval):
+            try:
+                self.step()
+            except Exception as e:
+                self.loger.error('调整拉取批量异常：{}'.format(e))
@@ -1,58 +1,175 @@
+import atexit
 import logging
-from logging.handlers import TimedRotatingFileHandler
+import os
+import queue
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
+
+_LEVELS = {'debug': logging.DEBUG, 'info': logging.INFO, 'warning': logging.WARNING,
+           'error': logging.ERROR, 'critical': logging.CRITICAL}
+
+# 已经由Loger配置过的logger：名称 -> _Output，同名Loger共用同一组handler，不会重复输出
+_outputs = dict()
+_outputs_lock = threading.Lock()
+# queue.SimpleQueue在3.7中加入，更早的版本使用queue.Queue
+_Queue = getattr(queue, 'SimpleQueue', queue.Queue)
+
+
+class _DeferredQueueHandler(QueueHandler):
+    '''
+    只把日志记录放入队列，格式化（包括%参数）在后台线程中进行
+    '''
+
+    def prepare(self, record):
+        return record
+
+
+class _Output(object):
+    '''
+    一个logger的后台输出：调用线程只把记录放入队列，由QueueListener线程写终端和文件
+    '''
+
+    def __init__(self, logger, handlers):
+        self.logger = logger
+        self.handlers = handlers
+        self.queue_handler = None
+        self.listener = None
+        self.start()
+
+    def start(self):
+        _queue = _Queue()
+        _queue_handler = _DeferredQueueHandler(_queue)
+        if self.queue_handler is not None:
+            self.logger.removeHandler(self.queue_handler)
+        self.logger.addHandler(_queue_handler)
+        self.queue_handler = _queue_handler
+        self.listener = QueueListener(_queue, *self.handlers, respect_handler_level=True)
+        self.listener.start()
+
+    def stop(self):
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+
+def shutdown():
+    '''
+    进程退出时写完队列中剩余的日志；不经过atexit退出的进程（如调用os._exit）在退出前调用
+    '''
+    for _output in list(_outputs.values()):
+        _output.stop()
+
+
+def _restart_in_child():
+    '''
+    fork出的子进程中没有后台输出线程，重新创建队列和输出线程
+    '''
+    global _outputs_lock
+    _outputs_lock = threading.Lock()
+    for _output in _outputs.values():
+        _output.listener = None
+        _output.start()
+
+
+atexit.register(shutdown)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_restart_in_child)
+
 
 class Loger(object):
-    def __init__(self, name='', level='debug', logfile=None, verbose=False):
+    def __init__(self, name='', level='debug', logfile=None, verbose=False, rate_limit=0, rate_interval=1.0):
         '''
         初始化Loger对象
+        日志在后台线程中格式化和写入，调用线程只负责放入队列；同名的Loger共用同一组输出，
+        第一次创建时的logfile、verbose生效，之后创建只调整记录级别
 
         :param name: loger名称
         :param level: 记录级别
         :param logfile: 日志文件（为None时仅终端显示）
         :param verbose: 当日志文件被设置时，是否在终端显示记录信息
+        :param rate_limit: 同一条日志模板每rate_interval秒最多记录的条数，0表示不限制；
+                           超出的日志被丢弃，下一个周期记录一条丢弃数量的提示
+        :param rate_interval: 限流周期（秒）
         '''
-        if level == 'debug':
-            self._level = logging.DEBUG
-        elif level == 'info':
-            self._level = logging.INFO
-        elif level == 'warning':
-            self._level = logging.WARNING
-        elif level == 'error':
-            self._level = logging.ERROR
-        elif level == 'critical':
-            self._level = logging.CRITICAL
+        self._level = _LEVELS.get(level, logging.DEBUG)
         self._formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+        self._logger = logging.getLogger(name)
+        self._logger.setLevel(self._level)
+        self._rate_limit = rate_limit
+        self._rate_interval = rate_interval
+        self._rates = dict()        # 日志模板 -> [周期开始时间, 已记录条数, 丢弃条数]
 
-        if logfile:
-            self._file_handler = TimedRotatingFileHandler(logfile, when='H', interval=4, backupCount=180, encoding='utf-8')
-            self._file_handler.setLevel(self._level)
-            self._file_handler.setFormatter(self._formatter)
-        else:
-            self._file_handler = None
+        with _outputs_lock:
+            if name not in _outputs:
+                _handlers = list()
+                if logfile:
+                    _file_handler = TimedRotatingFileHandler(logfile, when='H', interval=4, backupCount=180,
+                                                             encoding='utf-8')
+                    _file_handler.setFormatter(self._formatter)
+                    _handlers.append(_file_handler)
+                if not logfile or verbose:
+                    _console_handler = logging.StreamHandler()
+                    _console_handler.setFormatter(self._formatter)
+                    _handlers.append(_console_handler)
+                # 记录只经过Loger的队列输出，不再传到root logger重复输出
+                self._logger.propagate = False
+                _outputs[name] = _Output(self._logger, _handlers)
 
-        self._console_handler = logging.StreamHandler()
-        self._console_handler.setLevel(self._level)
-        self._console_handler.setFormatter(self._formatter)
+    @property
+    def is_debug(self):
+        '''
+        是否记录debug级别的日志，用来跳过不会被记录的日志内容的格式化
+        '''
+        return self._logger.isEnabledFor(logging.DEBUG)
 
-        self._logger = logging.getLogger(name)
-        self._logger.setLevel(self._level)
-        self._logger.addHandler(self._console_handler)
-        if self._file_handler:
-            self._logger.addHandler(self._file_handler)
-            if not verbose:
-                self._logger.removeHandler(self._console_handler)
+    def _allow(self, msg):
+        '''
+        限流检查，按日志模板（%参数替换前的字符串）计数
+        :return: 是否记录这条日志
+        '''
+        _now = time.time()
+        _rate = self._rates.get(msg)
+        if _rate is None:
+            self._rates[msg] = [_now, 1, 0]
+            return True
+        if _now - _rate[0] >= self._rate_interval:
+            if _rate[2]:
+                self._logger.warning('以下日志在%.1f秒内被限流丢弃%d条：%s', _now - _rate[0], _rate[2], msg)
+            _rate[0], _rate[1], _rate[2] = _now, 1, 0
+            return True
+        if _rate[1] < self._rate_limit:
+            _rate[1] += 1
+            return True
+        _rate[2] += 1
+        return False
 
-    def debug(self, msg):
-        self._logger.debug(msg)
+    def _log(self, level, msg, args, kwargs):
+        if not self._logger.isEnabledFor(level):
+            return
+        if self._rate_limit and not self._allow(msg):
+            return
+        if kwargs:
+            self._logger.log(level, msg, *args, **kwargs)
+        else:
+            # 输出格式中不包含文件名和行号，跳过查找调用位置
+            self._logger.handle(self._logger.makeRecord(self._logger.name, level, '', 0, msg, args, None))
+
+    def debug(self, msg, *args, **kwargs):
+        '''
+        记录debug日志，参数按%方式在后台线程中格式化，如loger.debug('收到信息：%s', message)，
+        记录级别不够时不做任何格式化；参数对象在写入前不能再被修改
+        '''
+        self._log(logging.DEBUG, msg, args, kwargs)
 
-    def info(self, msg):
-        self._logger.info(msg)
+    def info(self, msg, *args, **kwargs):
+        self._log(logging.INFO, msg, args, kwargs)
 
-    def warning(self, msg):
-        self._logger.warning(msg)
+    def warning(self, msg, *args, **kwargs):
+        self._log(logging.WARNING, msg, args, kwargs)
 
-    def error(self, msg):
-        self._logger.error(msg)
+    def error(self, msg, *args, **kwargs):
+        self._log(logging.ERROR, msg, args, kwargs)
 
-    def critical(self, msg):
-        self._logger.critical(msg)
+    def critical(self, msg, *args, **kwargs):
+        self._log(logging.CRITICAL, msg, args, kwargs)
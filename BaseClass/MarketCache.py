@@ -0,0 +1,266 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# @File  : MarketCache.py
+# @Author: Liaop
+# @Date  : 2018-11-05
+# @Desc  : 行情快照缓存，后台线程持续读取行情主题的所有分区，按合约号保存最新行情
+
+import threading
+import time
+
+from pykafka.common import OffsetType
+
+from BaseClass import Chunking
+from BaseClass.Envelope import Envelope
+from BaseClass.Log import Loger
+from BaseClass.Pool import get_pool
+
+
+class MarketCache(object):
+    '''
+    行情快照缓存
+
+    后台线程读取行情主题的所有分区，把每个合约的最新行情保存在字典中，get(code)直接从内存读取。
+    启动时每个分区先回溯backfill条历史数据预热，预热完成后wait_ready()返回。
+    '''
+
+    def __init__(self, hosts, topic, loger=None, encoding='utf-8', code_field='code', key_func=None,
+                 backfill=500, consumer_group=None, index=None, codec=None, max_chunk_bytes=256 * 1024 * 1024,
+                 chunk_timeout=60):
+        '''
+        初始化
+
+        :param hosts: kafka主机地址，多个主机用逗号隔开
+        :param topic: 行情主题
+        :param loger: 日志记录对象
+        :param encoding: 编码格式
+        :param code_field: 行情消息中合约号的字段名
+        :param key_func: 自定义的合约号提取函数，参数为原始bytes，返回合约号（None表示忽略该消息），
+                         设置后code_field不再使用
+        :param backfill: 启动时每个分区回溯的历史消息数，0表示只接收新行情
+        :param consumer_group: 消费者组名，为None时不提交offset
+        :param index: MarketIndex对象，设置后边消费边建立(合约号, 时间) -> (分区, offset)索引，
+                      启动时从索引进度和回溯位置中较早的一个开始消费，已经建立索引的行情只更新缓存不重复索引；
+                      分块发送的行情索引到第一块
+        :param codec: 解析不带消息头的json文本时使用的编码方式，带编码标识头的行情按消息头解码
+        :param max_chunk_bytes: 重组未收齐的分块行情最多占用的内存（字节）
+        :param chunk_timeout: 分块行情的块最长等待时间（秒）
+        '''
+        if loger:
+            self.loger = loger
+        else:
+            self.loger = Loger('MarketCache', 'debug')
+        self.__hosts = hosts
+        self.__encoding = encoding
+        self.__codec = codec
+        self.__reassembler = Chunking.Reassembler(max_chunk_bytes, chunk_timeout, self.loger)
+        if not isinstance(topic, bytes):
+            topic = topic.encode(encoding)
+        self.__topic_name = topic
+        if consumer_group is not None and not isinstance(consumer_group, bytes):
+            consumer_group = consumer_group.encode(encoding)
+        self.__consumer_group = consumer_group
+        self.__code_field = code_field
+        self.__key_func = key_func
+        self.__backfill = backfill
+        self.__quotes = dict()
+        self.__listeners = list()
+        self.__ready = threading.Event()
+        self.__run = False
+        self.__thread = None
+        self.__client = None
+        self.__consumer = None
+        self.__warmup = None
+        self.__index = index
+        self.__indexed = dict()     # 分区号 -> 下一条需要索引的offset
+
+    @property
+    def running(self):
+        return self.__run
+
+    @property
+    def index(self):
+        return self.__index
+
+    def start(self, offsets=None):
+        '''
+        启动后台读取线程
+
+        :param offsets: 指定每个分区的起始offset {分区号: offset}，为None时按backfill回溯；
+                        设置了索引时，索引进度早于回溯位置的分区从索引进度开始，补齐中断期间的索引
+        :return: 如果成功返回True
+        '''
+        if self.__run:
+            self.loger.error('行情缓存已经启动中.')
+            return False
+        self.__indexed = dict()
+        if self.__index is not None:
+            if not self.__index.open():
+                return False
+            self.__indexed = self.__index.resume_offsets()
+        try:
+            self.__client = get_pool().get_client(self.__hosts)
+            _topic = self.__client.topics[self.__topic_name]
+            self.__consumer = _topic.get_simple_consumer(consumer_group=self.__consumer_group,
+                                                         auto_offset_reset=OffsetType.LATEST,
+                                                         reset_offset_on_start=True,
+                                                         consumer_timeout_ms=1000)
+            _latest = {p: r.offset[0] for p, r in _topic.latest_available_offsets().items()}
+            _earliest = {p: r.offset[0] for p, r in _topic.earliest_available_offsets().items()}
+            _resets = list()
+            self.__warmup = dict()
+            for _pid, _partition in _topic.partitions.items():
+                if offsets is not None and _pid in offsets:
+                    _begin = offsets[_pid]
+                else:
+                    # 缓存总是按backfill预热，索引进度更早时从索引进度开始
+                    _begin = min(_latest[_pid] - self.__backfill, self.__indexed.get(_pid, _latest[_pid]))
+                _begin = max(_begin, _earliest[_pid])
+                # reset_offsets设置的是最后已读的offset
+                _resets.append((_partition, _begin - 1))
+                if _begin < _latest[_pid]:
+                    self.__warmup[_pid] = _latest[_pid] - 1
+            self.__consumer.reset_offsets(_resets)
+        except Exception as e:
+            self.loger.error('初始化行情缓存异常：{}'.format(e))
+            self.__close()
+            return False
+        if not self.__warmup:
+            self.__ready.set()
+        self.__run = True
+        self.__thread = threading.Thread(target=self.__loop, name='MarketCache')
+        self.__thread.daemon = True
+        self.__thread.start()
+        self.loger.info('****START**** 行情缓存启动成功.')
+        return True
+
+    def stop(self):
+        '''
+        停止后台读取线程
+        :return:
+        '''
+        self.__run = False
+        if self.__thread is not None:
+            self.__thread.join(2)
+            self.__thread = None
+        self.__close()
+        if self.__index is not None:
+            self.__index.close()
+        self.__ready.clear()
+        self.loger.info('****STOP**** 行情缓存停止运行.')
+
+    def __close(self):
+        if self.__consumer is not None:
+            try:
+                self.__consumer.stop()
+            except Exception as e:
+                self.loger.error('停止consumer出错：{}'.format(e))
+            self.__consumer = None
+        self.__client = None
+
+    def wait_ready(self, timeout=None):
+        '''
+        等待启动时的历史数据预热完成
+
+        :param timeout: 超时时间（秒）
+        :return: 预热完成返回True
+        '''
+        return self.__ready.wait(timeout)
+
+    def subscribe(self, callback):
+        '''
+        订阅行情变化通知，合约行情与缓存中不同时调用callback(code, message)，
+        回调在后台线程中执行，不能长时间阻塞
+
+        :param callback: 回调函数
+        :return:
+        '''
+        self.__listeners.append(callback)
+
+    def unsubscribe(self, callback):
+        if callback in self.__listeners:
+            self.__listeners.remove(callback)
+
+    def get(self, code):
+        '''
+        获取合约的最新行情
+
+        :param code: 合约号
+        :return: 最新行情消息字符串（带编码标识头的行情转换为json文本），没有则返回None
+        '''
+        return self.__quotes.get(code)
+
+    def codes(self):
+        '''
+        已缓存行情的合约号
+        '''
+        return list(self.__quotes.keys())
+
+    def __len__(self):
+        return len(self.__quotes)
+
+    def __get_code(self, value):
+        if self.__key_func is not None:
+            return self.__key_func(value)
+        return Envelope(value, self.__encoding, self.__codec).peek_field(self.__code_field)
+
+    def __loop(self):
+        _commit = 0
+        while self.__run:
+            try:
+                _msg = self.__consumer.consume()
+            except Exception as e:
+                if self.__run:
+                    self.loger.error('接收行情出错：{}'.format(e))
+                continue
+            if _msg is None:
+                if _commit and self.__consumer_group is not None:
+                    self.__consumer.commit_offsets()
+                    _commit = 0
+                if self.__index is not None:
+                    self.__index.flush()
+                continue
+            if _msg.value:
+                _value = _msg.value
+                _position = (_msg.partition_id, _msg.offset)
+                if Chunking.is_chunk(_value):
+                    # 分块的行情收齐后再更新，索引指向第一块
+                    _value = self.__reassembler.add(_value, _position)
+                    _position = self.__reassembler.origin
+                if _value is not None:
+                    _code = self.__update(_value)
+                    if _code is not None and self.__index is not None and \
+                            _position[1] >= self.__indexed.get(_position[0], 0):
+                        self.__index.add(_code, _msg.timestamp or time.time() * 1000, _position[0], _position[1])
+                _commit += 1
+            if self.__warmup:
+                _last = self.__warmup.get(_msg.partition_id)
+                if _last is not None and _msg.offset >= _last:
+                    del self.__warmup[_msg.partition_id]
+                    if not self.__warmup:
+                        self.loger.info('行情缓存预热完成，合约数：{}'.format(len(self.__quotes)))
+                        self.__ready.set()
+
+    def __update(self, value):
+        '''
+        更新合约的最新行情
+        :param value: 原始行情消息，分块的行情为重组后的完整消息
+        :return: 合约号，无法解析时返回None
+        '''
+        try:
+            _code = self.__get_code(value)
+            if _code is None:
+                return None
+            _message = Envelope(value, self.__encoding, self.__codec).text
+        except Exception as e:
+            self.loger.debug('无法解析行情：%s', e)
+            return None
+        if self.__quotes.get(_code) == _message:
+            return _code
+        self.__quotes[_code] = _message
+        for _callback in self.__listeners:
+            try:
+                _callback(_code, _message)
+            except Exception as e:
+                self.loger.error('行情通知回调出错：{}'.format(e))
+        return _code
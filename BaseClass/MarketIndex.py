@@ -0,0 +1,165 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# @File  : MarketIndex.py
+# @Author: Liaop
+# @Date  : 2018-11-07
+# @Desc  : 行情索引，用SQLite保存(合约号, 时间) -> (分区, offset)，历史行情查询只读取需要的消息
+
+import sqlite3
+import threading
+import time
+
+from BaseClass.Log import Loger
+
+
+class MarketIndex(object):
+    '''
+    行情索引
+
+    边消费行情边增量建立索引，索引行与每个分区的索引进度在同一个事务中提交，
+    重启后从进度之后继续索引，不需要重新扫描整个主题。
+    '''
+
+    def __init__(self, path, loger=None, flush_every=1000, flush_ms=1000):
+        '''
+        初始化
+
+        :param path: 索引文件路径
+        :param loger: 日志记录对象
+        :param flush_every: 缓存多少条索引后写入文件
+        :param flush_ms: 索引最多缓存多久后写入文件（毫秒）
+        '''
+        if loger:
+            self.loger = loger
+        else:
+            self.loger = Loger('MarketIndex', 'debug')
+        self.__path = path
+        self.__flush_every = flush_every
+        self.__flush_ms = flush_ms
+        self.__lock = threading.Lock()
+        self.__conn = None
+        self.__rows = list()
+        self.__progress = dict()
+        self.__last_flush = time.time()
+
+    def open(self):
+        '''
+        打开索引文件，不存在时创建
+        :return: 如果成功返回True
+        '''
+        if self.__conn is not None:
+            return True
+        try:
+            self.__conn = sqlite3.connect(self.__path, check_same_thread=False)
+            self.__conn.execute('PRAGMA journal_mode=WAL')
+            self.__conn.execute('PRAGMA synchronous=NORMAL')
+            self.__conn.execute('CREATE TABLE IF NOT EXISTS ticks ('
+                                'code TEXT NOT NULL, ts INTEGER NOT NULL, '
+                                'partition INTEGER NOT NULL, offset INTEGER NOT NULL, '
+                                'UNIQUE (partition, offset))')
+            self.__conn.execute('CREATE INDEX IF NOT EXISTS ticks_code_ts ON ticks (code, ts)')
+            self.__conn.execute('CREATE TABLE IF NOT EXISTS progress ('
+                                'partition INTEGER PRIMARY KEY, offset INTEGER NOT NULL)')
+            self.__conn.commit()
+            return True
+        except Exception as e:
+            self.loger.error('打开行情索引{}异常：{}'.format(self.__path, e))
+            self.__conn = None
+            return False
+
+    def close(self):
+        '''
+        写入缓存的索引并关闭索引文件
+        '''
+        if self.__conn is None:
+            return
+        self.flush()
+        with self.__lock:
+            self.__conn.close()
+            self.__conn = None
+
+    def add(self, code, timestamp, partition, offset):
+        '''
+        添加一条行情索引，缓存达到flush_every条或者超过flush_ms后写入文件
+
+        :param code: 合约号
+        :param timestamp: 行情时间（毫秒时间戳）
+        :param partition: 分区号
+        :param offset: 消息offset
+        :return:
+        '''
+        with self.__lock:
+            self.__rows.append((code, int(timestamp), partition, offset))
+            if offset > self.__progress.get(partition, -1):
+                self.__progress[partition] = offset
+            _flush = (len(self.__rows) >= self.__flush_every or
+                      (time.time() - self.__last_flush) * 1000 >= self.__flush_ms)
+        if _flush:
+            self.flush()
+
+    def flush(self):
+        '''
+        把缓存的索引和分区进度写入文件
+        '''
+        with self.__lock:
+            self.__last_flush = time.time()
+            if self.__conn is None or (not self.__rows and not self.__progress):
+                return
+            _rows, self.__rows = self.__rows, list()
+            _progress, self.__progress = self.__progress, dict()
+            try:
+                with self.__conn:
+                    self.__conn.executemany('INSERT OR IGNORE INTO ticks (code, ts, partition, offset) '
+                                            'VALUES (?, ?, ?, ?)', _rows)
+                    self.__conn.executemany('INSERT INTO progress (partition, offset) VALUES (?, ?) '
+                                            'ON CONFLICT(partition) DO UPDATE SET offset=max(offset, excluded.offset)',
+                                            list(_progress.items()))
+            except Exception as e:
+                self.loger.error('写入行情索引异常：{}'.format(e))
+
+    def resume_offsets(self):
+        '''
+        每个分区下一条需要索引的offset，启动时从这里继续消费
+
+        :return: {分区号: offset}
+        '''
+        with self.__lock:
+            if self.__conn is None:
+                return dict()
+            return {p: o + 1 for p, o in self.__conn.execute('SELECT partition, offset FROM progress')}
+
+    def lookup(self, code, timestamp=None):
+        '''
+        查找合约在指定时间（含）之前的最后一条行情
+
+        :param code: 合约号
+        :param timestamp: 毫秒时间戳，为None时查找最新一条
+        :return: (分区号, offset, 时间戳)，没有找到返回None
+        '''
+        self.flush()
+        with self.__lock:
+            if self.__conn is None:
+                return None
+            if timestamp is None:
+                _cursor = self.__conn.execute('SELECT partition, offset, ts FROM ticks WHERE code=? '
+                                              'ORDER BY ts DESC, offset DESC LIMIT 1', (code,))
+            else:
+                _cursor = self.__conn.execute('SELECT partition, offset, ts FROM ticks WHERE code=? AND ts<=? '
+                                              'ORDER BY ts DESC, offset DESC LIMIT 1', (code, int(timestamp)))
+            return _cursor.fetchone()
+
+    def range(self, code, begin, end):
+        '''
+        查找合约在时间段内的全部行情位置
+
+        :param code: 合约号
+        :param begin: 开始时间（毫秒时间戳，含）
+        :param end: 结束时间（毫秒时间戳，含）
+        :return: [(分区号, offset, 时间戳), ...]，按时间排序
+        '''
+        self.flush()
+        with self.__lock:
+            if self.__conn is None:
+                return list()
+            return self.__conn.execute('SELECT partition, offset, ts FROM ticks WHERE code=? AND ts>=? AND ts<=? '
+                                       'ORDER BY ts, offset', (code, int(begin), int(end))).fetchall()
@@ -0,0 +1,334 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# @File  : Metrics.py
+# @Author: Liaop
+# @Date  : 2018-11-16
+# @Desc  : 运行指标：计数器、当前值和对数分桶的耗时直方图，支持Prometheus文本格式的HTTP接口和定时输出到日志
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+import itertools
+import os
+import threading
+import time
+
+# 每个2的幂区间再分为2**_SUB_BITS个子桶，相对误差不超过1/8
+_SUB_BITS = 3
+_SUB = 1 << _SUB_BITS
+# 微秒值最大到2**40（约12天）
+_BUCKETS = _SUB * 41
+
+
+def _bucket_low(index):
+    '''
+    直方图桶的下界（微秒）
+    '''
+    if index < _SUB:
+        return index
+    _shift = index // _SUB - 1
+    return (_SUB + index % _SUB) << _shift
+
+
+class Counter(object):
+    '''
+    计数器，多线程同时累加时可能少计，只用于统计
+    '''
+    __slots__ = ('name', 'help', 'value')
+
+    def __init__(self, name, help=''):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+
+class Gauge(object):
+    '''
+    当前值，如消费延迟，由调用者定时设置
+    '''
+    __slots__ = ('name', 'help', 'value')
+
+    def __init__(self, name, help=''):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram(object):
+    '''
+    耗时直方图
+
+    按微秒记录，小于8微秒每个值一个桶，之后每个2的幂区间分为8个桶（HDR方式），
+    记录只需要一次bit_length和一次列表累加；分位数按桶的下界返回，相对误差不超过12.5%。
+    '''
+    __slots__ = ('name', 'help', 'counts', 'count', 'sum', 'max')
+
+    def __init__(self, name, help=''):
+        self.name = name
+        self.help = help
+        self.counts = [0] * _BUCKETS
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def record_ns(self, ns):
+        '''
+        记录一次耗时
+        :param ns: 纳秒，通常是两次now_ns()的差
+        '''
+        _us = ns // 1000
+        if _us < _SUB:
+            self.counts[_us if _us > 0 else 0] += 1
+        else:
+            _shift = _us.bit_length() - _SUB_BITS - 1
+            _index = ((_shift + 1) << _SUB_BITS) + (_us >> _shift) - _SUB
+            self.counts[_index if _index < _BUCKETS else _BUCKETS - 1] += 1
+        self.count += 1
+        self.sum += _us
+        if _us > self.max:
+            self.max = _us
+
+    def record(self, seconds):
+        '''
+        记录一次耗时
+        :param seconds: 秒
+        '''
+        self.record_ns(int(seconds * 1e9))
+
+    def percentile(self, q):
+        '''
+        分位数
+        :param q: 0~100，如99.9
+        :return: 微秒
+        '''
+        if not self.count:
+            return 0
+        _rank = self.count * q / 100.0
+        _seen = 0
+        for _index, _n in enumerate(self.counts):
+            _seen += _n
+            if _n and _seen >= _rank:
+                return min(_bucket_low(_index), self.max)
+        return self.max
+
+    def summary(self):
+        '''
+        :return: {'count', 'mean', 'p50', 'p99', 'p999', 'max'}，耗时单位为微秒
+        '''
+        return {'count': self.count,
+                'mean': self.sum / self.count if self.count else 0,
+                'p50': self.percentile(50),
+                'p99': self.percentile(99),
+                'p999': self.percentile(99.9),
+                'max': self.max}
+
+
+class Registry(object):
+    '''
+    指标注册表，同名指标只创建一次
+    '''
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__counters = dict()
+        self.__gauges = dict()
+        self.__histograms = dict()
+        self.__server = None
+        self.__dumper = None    # 定时输出线程所在的进程号，fork出的子进程需要重新启动
+
+    def counter(self, name, help=''):
+        _counter = self.__counters.get(name)
+        if _counter is None:
+            with self.__lock:
+                _counter = self.__counters.setdefault(name, Counter(name, help))
+        return _counter
+
+    def gauge(self, name, help=''):
+        _gauge = self.__gauges.get(name)
+        if _gauge is None:
+            with self.__lock:
+                _gauge = self.__gauges.setdefault(name, Gauge(name, help))
+        return _gauge
+
+    def histogram(self, name, help=''):
+        _histogram = self.__histograms.get(name)
+        if _histogram is None:
+            with self.__lock:
+                _histogram = self.__histograms.setdefault(name, Histogram(name, help))
+        return _histogram
+
+    def render(self):
+        '''
+        Prometheus文本格式，直方图按2的幂输出桶，单位为秒
+        :return: 字符串
+        '''
+        _lines = list()
+        for _name in sorted(self.__counters):
+            _counter = self.__counters[_name]
+            _lines.append('# HELP {} {}'.format(_name, _counter.help))
+            _lines.append('# TYPE {} counter'.format(_name))
+            _lines.append('{} {}'.format(_name, _counter.value))
+        for _name in sorted(self.__gauges):
+            _gauge = self.__gauges[_name]
+            _lines.append('# HELP {} {}'.format(_name, _gauge.help))
+            _lines.append('# TYPE {} gauge'.format(_name))
+            _lines.append('{} {}'.format(_name, _gauge.value))
+        for _name in sorted(self.__histograms):
+            _histogram = self.__histograms[_name]
+            _counts = list(_histogram.counts)
+            _lines.append('# HELP {} {}'.format(_name, _histogram.help))
+            _lines.append('# TYPE {} histogram'.format(_name))
+            _last = max([i for i, n in enumerate(_counts) if n] or [0])
+            _seen = 0
+            for _index, _n in enumerate(_counts[:_last + 1]):
+                _seen += _n
+                if (_index + 1) % _SUB == 0 or _index == _last:
+                    _lines.append('{}_bucket{{le="{}"}} {}'.format(_name, _bucket_low(_index + 1) / 1e6, _seen))
+            _lines.append('{}_bucket{{le="+Inf"}} {}'.format(_name, _histogram.count))
+            _lines.append('{}_sum {}'.format(_name, _histogram.sum / 1e6))
+            _lines.append('{}_count {}'.format(_name, _histogram.count))
+        return '\n'.join(_lines) + '\n'
+
+    def dump(self, loger):
+        '''
+        把所有指标的当前值写入日志，每行带进程号
+        :param loger: 日志记录对象
+        '''
+        _pid = os.getpid()
+        for _name in sorted(self.__counters):
+            loger.info('[METRICS {}] {} {}'.format(_pid, _name, self.__counters[_name].value))
+        for _name in sorted(self.__gauges):
+            loger.info('[METRICS {}] {} {}'.format(_pid, _name, self.__gauges[_name].value))
+        for _name in sorted(self.__histograms):
+            _summary = self.__histograms[_name].summary()
+            loger.info('[METRICS {}] {} count={count} mean={mean:.1f}us p50={p50}us p99={p99}us '
+                       'p999={p999}us max={max}us'.format(_pid, _name, **_summary))
+
+    def start_http(self, port=9108, host='0.0.0.0'):
+        '''
+        启动Prometheus抓取接口，GET /metrics返回render()的内容
+        :param port: 端口
+        :param host: 监听地址
+        :return: 如果成功返回True
+        '''
+        if self.__server is not None:
+            return True
+        _registry = self
+
+        class _Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                _body = _registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(_body)))
+                self.end_headers()
+                self.wfile.write(_body)
+
+            def log_message(self, format, *args):
+                pass
+
+        class _Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        try:
+            self.__server = _Server((host, port), _Handler)
+        except Exception:
+            return False
+        _thread = threading.Thread(target=self.__server.serve_forever, name='MetricsHTTP')
+        _thread.daemon = True
+        _thread.start()
+        return True
+
+    def stop_http(self):
+        if self.__server is not None:
+            self.__server.shutdown()
+            self.__server.server_close()
+            self.__server = None
+
+    def start_dump(self, interval, loger):
+        '''
+        启动定时输出，每interval秒把指标写入日志，多进程运行时每个进程各自输出
+        :param interval: 间隔（秒）
+        :param loger: 日志记录对象
+        '''
+        if self.__dumper == os.getpid():
+            return
+
+        def _loop():
+            while True:
+                time.sleep(interval)
+                self.dump(loger)
+
+        _thread = threading.Thread(target=_loop, name='MetricsDump')
+        _thread.daemon = True
+        _thread.start()
+        self.__dumper = os.getpid()
+
+
+class Stages(object):
+    '''
+    消息处理各阶段的耗时统计
+
+    每个阶段一个直方图（prefix_阶段_seconds），消息数由调用者累加到messages（prefix_messages_total）。
+    每sample_every条消息计时一条，tick()只是一次迭代器调用，平均到每条消息的开销在百纳秒以内：
+        _timed = stages.tick()
+        _t = now_ns() if _timed else 0
+        ...
+        if _timed:
+            _t = stages.lap(stages.consume, _t)
+    '''
+
+    def __init__(self, prefix, stages, sample_every=16, registry=None):
+        '''
+        初始化
+
+        :param prefix: 指标名前缀，如'kafka'
+        :param stages: 阶段名列表，每个阶段成为同名属性，如stages.consume
+        :param sample_every: 每多少条消息计时一条，1表示每条都计时
+        :param registry: 指标注册表，默认为进程内共享的注册表
+        '''
+        registry = registry or get_registry()
+        self.sample_every = max(1, int(sample_every))
+        self.messages = registry.counter('{}_messages_total'.format(prefix), '处理的消息数')
+        for _stage in stages:
+            setattr(self, _stage, registry.histogram('{}_{}_seconds'.format(prefix, _stage),
+                                                     '{}阶段耗时（抽样）'.format(_stage)))
+        # 返回这条消息是否需要计时
+        self.tick = itertools.cycle([True] + [False] * (self.sample_every - 1)).__next__
+
+    @staticmethod
+    def lap(histogram, begin):
+        '''
+        记录从begin到现在的耗时
+        :return: 现在的时间（纳秒），作为下一阶段的开始时间
+        '''
+        _now = now_ns()
+        histogram.record_ns(_now - begin)
+        return _now
+
+
+# time.perf_counter_ns需要Python 3.7，3.6上用perf_counter换算
+now_ns = getattr(time, 'perf_counter_ns', None) or (lambda: int(time.perf_counter() * 1e9))
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry():
+    '''
+    获取进程内共享的指标注册表
+    '''
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = Registry()
+    return _registry
@@ -0,0 +1,88 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# @File  : Offsets.py
+# @Author: Liaop
+# @Date  : 2018-10-24
+# @Desc  : 分区offset跟踪，消息乱序完成时只提交连续完成的部分，保证至少一次处理
+
+import threading
+from collections import deque
+
+
+class OffsetTracker(object):
+    '''
+    分区offset跟踪器
+
+    每个分区按消费顺序记录已分发的offset，消息处理完成后标记完成，
+    只有从最早未完成消息之前连续完成的offset才允许提交。
+    '''
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__pending = dict()     # partition -> deque(已分发未提交的offset，按消费顺序)
+        self.__done = dict()        # partition -> set(已完成但前面还有未完成的offset)
+        self.__frontier = dict()    # partition -> 连续完成的最大offset
+        self.__dirty = set()        # 有新的可提交offset的分区
+        self.__inflight = 0
+
+    @property
+    def inflight(self):
+        '''
+        已分发但未完成的消息数
+        '''
+        return self.__inflight
+
+    def add(self, partition, offset):
+        '''
+        登记一条已分发的消息
+
+        :param partition: 消息所在分区
+        :param offset: 消息offset
+        :return:
+        '''
+        with self.__lock:
+            self.__pending.setdefault(partition, deque()).append(offset)
+            self.__inflight += 1
+
+    def done(self, partition, offset):
+        '''
+        标记一条消息处理完成
+
+        :param partition: 消息所在分区
+        :param offset: 消息offset
+        :return:
+        '''
+        with self.__lock:
+            _pending = self.__pending.get(partition)
+            if not _pending:
+                return
+            _done = self.__done.setdefault(partition, set())
+            _done.add(offset)
+            self.__inflight -= 1
+            while _pending and _pending[0] in _done:
+                _offset = _pending.popleft()
+                _done.discard(_offset)
+                self.__frontier[partition] = _offset
+                self.__dirty.add(partition)
+
+    def committable(self):
+        '''
+        取出自上次调用以来可以提交的offset
+
+        :return: [(partition, offset), ...]，offset为连续完成的最大offset
+        '''
+        with self.__lock:
+            _rt = [(p, self.__frontier[p]) for p in self.__dirty]
+            self.__dirty.clear()
+        return _rt
+
+    def clear(self):
+        '''
+        清空所有记录（重新分配分区或者重启时调用）
+        '''
+        with self.__lock:
+            self.__pending.clear()
+            self.__done.clear()
+            self.__frontier.clear()
+            self.__dirty.clear()
+            self.__inflight = 0
@@ -0,0 +1,156 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# @File  : Pool.py
+# @Author: Liaop
+# @Date  : 2018-11-09
+# @Desc  : 进程内共享的KafkaClient/producer/consumer连接池，避免每次收发都重新连接和获取元数据
+
+import atexit
+import os
+import threading
+import time
+
+from pykafka import KafkaClient
+
+from BaseClass.Log import Loger
+
+
+class KafkaPool(object):
+    '''
+    连接池
+
+    KafkaClient按hosts缓存，同一进程内共享broker连接和集群元数据；
+    producer、consumer按(hosts, 主题, 参数)缓存，超过idle_seconds未使用时停止并移除。
+    缓存按进程号区分，fork出来的子进程不会使用父进程的连接。
+    '''
+
+    def __init__(self, idle_seconds=300, loger=None):
+        '''
+        初始化
+
+        :param idle_seconds: producer/consumer空闲多久后被回收（秒）
+        :param loger: 日志记录对象
+        '''
+        if loger:
+            self.loger = loger
+        else:
+            self.loger = Loger('KafkaPool', 'debug')
+        self.__idle_seconds = idle_seconds
+        self.__lock = threading.RLock()
+        self.__clients = dict()     # (pid, hosts) -> KafkaClient
+        self.__entries = dict()     # (pid, 类型, hosts, topic, 参数) -> [对象, 最后使用时间, 锁]
+        self.__last_evict = time.time()
+
+    def get_client(self, hosts):
+        '''
+        获取共享的KafkaClient
+
+        :param hosts: kafka主机地址，多个主机用逗号隔开
+        :return: KafkaClient
+        '''
+        _key = (os.getpid(), hosts)
+        _client = self.__clients.get(_key)
+        if _client is None:
+            with self.__lock:
+                _client = self.__clients.get(_key)
+                if _client is None:
+                    _client = self.__clients[_key] = KafkaClient(hosts=hosts)
+        return _client
+
+    def get_producer(self, hosts, topic, **kwargs):
+        '''
+        获取共享的producer，相同hosts、主题和参数的调用得到同一个producer
+
+        :param hosts: kafka主机地址
+        :param topic: 主题名（bytes）
+        :param kwargs: 传给get_producer的参数
+        :return: producer
+        '''
+        return self.__get('producer', hosts, topic, kwargs)[0]
+
+    def get_consumer(self, hosts, topic, consumer_group, **kwargs):
+        '''
+        获取共享的simple consumer，返回的锁用于保证同一时间只有一个线程在使用该consumer
+
+        :param hosts: kafka主机地址
+        :param topic: 主题名（bytes）
+        :param consumer_group: 消费者组名（bytes）
+        :param kwargs: 传给get_simple_consumer的参数
+        :return: (consumer, 锁)
+        '''
+        kwargs['consumer_group'] = consumer_group
+        _entry = self.__get('consumer', hosts, topic, kwargs)
+        return _entry[0], _entry[2]
+
+    def __get(self, kind, hosts, topic, kwargs):
+        _key = (os.getpid(), kind, hosts, topic, tuple(sorted(kwargs.items())))
+        _now = time.time()
+        with self.__lock:
+            _entry = self.__entries.get(_key)
+            if _entry is None:
+                _topic = self.get_client(hosts).topics[topic]
+                if kind == 'producer':
+                    _obj = _topic.get_producer(**kwargs)
+                else:
+                    _obj = _topic.get_simple_consumer(**kwargs)
+                _entry = self.__entries[_key] = [_obj, _now, threading.Lock()]
+            _entry[1] = _now
+        if _now - self.__last_evict > min(60, self.__idle_seconds):
+            self.evict_idle()
+        return _entry
+
+    def evict_idle(self):
+        '''
+        停止并移除超过idle_seconds未使用的producer/consumer
+        '''
+        _now = time.time()
+        with self.__lock:
+            self.__last_evict = _now
+            _idle = [k for k, e in self.__entries.items() if _now - e[1] > self.__idle_seconds]
+            _entries = [self.__entries.pop(k) for k in _idle]
+        for _entry in _entries:
+            self.__stop(_entry[0])
+
+    def clear(self):
+        '''
+        停止当前进程的所有producer/consumer，并释放KafkaClient
+        '''
+        _pid = os.getpid()
+        with self.__lock:
+            _keys = [k for k in self.__entries if k[0] == _pid]
+            _entries = [self.__entries.pop(k) for k in _keys]
+            for _key in [k for k in self.__clients if k[0] == _pid]:
+                del self.__clients[_key]
+        for _entry in _entries:
+            self.__stop(_entry[0])
+
+    def __stop(self, obj):
+        try:
+            obj.stop()
+        except Exception as e:
+            self.loger.error('停止{}出错：{}'.format(obj, e))
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    '''
+    获取进程内共享的连接池，进程退出时停止池中的producer，保证已发送的消息写入kafka
+    '''
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = KafkaPool()
+                atexit.register(_pool.clear)
+    return _pool
+
+
+def close_pool():
+    '''
+    停止当前进程连接池中的producer/consumer，不经过atexit退出的进程（如调用os._exit）在退出前调用
+    '''
+    if _pool is not None:
+        _pool.clear()
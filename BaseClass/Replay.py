@@ -0,0 +1,470 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# @File  : Replay.py
+# @Author: Liaop
+# @Date  : 2018-11-27
+# @Desc  : 主题回放：按offset或者时间范围把主题的历史消息并行交给处理函数重新处理，结果写入主题或者文件，支持断点续跑
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import functools
+import json
+import multiprocessing
+import os
+import queue
+import sys
+import time
+
+from BaseClass import Chunking
+from BaseClass import Codec
+from BaseClass.Compression import CompressionPolicy
+from BaseClass.Envelope import Envelope
+from BaseClass.Log import Loger
+from BaseClass.Transport import EARLIEST, PykafkaTransport
+
+
+class Replay(object):
+    '''
+    主题回放
+
+    回放范围按分区划分为若干段，每段由一个工作进程（或线程）单独读取：按批接收、批量解码，
+    逐条交给handler处理，handler的返回值写入输出主题或者文件。每批处理完成（输出主题收到发送确认、
+    文件已写入）后才推进该段的进度，进度定时写入检查点文件，中断后用同一个检查点重新运行时从进度处继续，
+    最后一批可能被重复处理。
+    '''
+
+    def __init__(self, hosts, topic, handler, begin=None, end=None, begin_time=None, end_time=None,
+                 out_topic=None, out_file=None, checkpoint=None, workers=None, executor='process',
+                 segment_size=None, batch_size=1000, decode='text', encoding='utf-8', codec='json',
+                 compression='gzip', max_buf=999950, time_grace_ms=60000, progress_interval=5,
+                 on_progress=None, transport=None, loger=None):
+        '''
+        初始化
+
+        :param hosts: kafka主机地址，多个主机用逗号隔开
+        :param topic: 回放的主题
+        :param handler: 处理函数，参数为一条消息（decode决定类型），返回值为None时不输出，
+                        dict/list按codec编码，str按encoding编码；进程模式下必须是模块级函数
+        :param begin: 开始offset（含），整数时所有分区相同，{分区号: offset}时只回放其中的分区，默认为最早的消息
+        :param end: 结束offset（不含），整数或者{分区号: offset}，默认为开始回放时的最新offset
+        :param begin_time: 开始时间（毫秒时间戳），设置时按时间定位开始offset，早于该时间的消息被跳过
+        :param end_time: 结束时间（毫秒时间戳），晚于该时间的消息被跳过，
+                         某个分区读到晚于end_time + time_grace_ms的消息时该分区结束
+        :param out_topic: 输出主题，handler的返回值发送到该主题
+        :param out_file: 输出文件路径前缀，每段写入一个文件（路径.分区号.段开始offset），每个结果一行
+        :param checkpoint: 检查点文件路径，文件存在且属于同一主题时按其中的范围和进度继续回放
+        :param workers: 工作进程（线程）数，默认为CPU核数，不超过段数
+        :param executor: 'process'为多进程，'thread'为多线程（使用MemoryTransport时只能用线程）
+        :param segment_size: 每段的最大消息数，设置后一个分区拆成多段并行处理，同一分区内的消息不再按顺序处理；
+                             默认每个分区一段，按顺序处理
+        :param batch_size: 每批接收的消息数
+        :param decode: handler收到的消息类型，'text'为字符串，'envelope'为Envelope对象，
+                       'json'为解析后的对象（一批不带消息头的json文本一次解析）
+        :param encoding: 编码格式
+        :param codec: 解析json文本和编码handler返回对象的编码方式，'json'、'fastjson'、'msgpack'
+        :param compression: 输出主题的压缩方式，'none'、'snappy'、'lz4'、'gzip'
+        :param max_buf: 输出消息的最大字节数，超过时拆成多块发送
+        :param time_grace_ms: 按end_time结束分区时允许的消息时间乱序（毫秒）
+        :param progress_interval: 记录进度和写入检查点的间隔（秒）
+        :param on_progress: 进度回调函数，参数为stats()的返回值
+        :param transport: 传输层（Transport对象），默认为连接hosts的PykafkaTransport
+        :param loger: 日志记录对象
+        '''
+        if loger:
+            self.loger = loger
+        else:
+            self.loger = Loger('Replay', 'info')
+        self.__hosts = hosts
+        self.__transport = transport or PykafkaTransport(hosts)
+        if isinstance(self.__transport, PykafkaTransport):
+            self.__hosts = self.__transport.hosts
+        self.__encoding = encoding
+        if not isinstance(topic, bytes):
+            topic = topic.encode(encoding)
+        self.__topic = topic
+        if out_topic is not None and not isinstance(out_topic, bytes):
+            out_topic = out_topic.encode(encoding)
+        self.__begin = begin
+        self.__end = end
+        self.__begin_time = begin_time
+        self.__end_time = end_time
+        self.__checkpoint = checkpoint
+        self.__workers = workers or multiprocessing.cpu_count()
+        self.__executor = executor
+        self.__segment_size = segment_size
+        self.__progress_interval = progress_interval
+        self.__on_progress = on_progress
+        self.__config = {'hosts': self.__hosts, 'topic': topic, 'handler': handler, 'out_topic': out_topic,
+                         'out_file': out_file, 'batch_size': max(1, batch_size), 'decode': decode,
+                         'encoding': encoding, 'codec': Codec.get_codec(codec).name,
+                         'compression': CompressionPolicy.compression_type(compression), 'max_buf': max_buf,
+                         'begin_time': begin_time, 'end_time': end_time, 'time_grace_ms': time_grace_ms,
+                         'objects': self.__transport.objects}
+        self.__stop = multiprocessing.Event()
+        self.__segments = list()    # [[分区号, 段开始offset, 下一条要处理的offset, 段结束offset], ...]
+        self.__counts = {'messages': 0, 'results': 0, 'errors': 0}
+        self.__total = 0
+        self.__resumed = (0, 0)     # 本次运行开始时已经完成的(offset数, 消息数)
+        self.__begin_at = None
+
+    def stop(self):
+        '''
+        停止回放：各段处理完当前批次后退出，写入检查点，run随后返回
+        '''
+        self.__stop.set()
+
+    def stats(self):
+        '''
+        回放进度
+        :return: {'messages': 已处理消息数, 'results': 输出结果数, 'errors': 处理失败数,
+                  'done': 已完成的offset数, 'total': 回放范围的offset总数, 'percent', 'rate': 每秒处理消息数,
+                  'eta': 预计剩余秒数, 'segments': 剩余段数}
+        '''
+        _done = sum(s[2] - s[1] for s in self.__segments)
+        _elapsed = time.time() - self.__begin_at if self.__begin_at else 0
+        _rate = (self.__counts['messages'] - self.__resumed[1]) / _elapsed if _elapsed > 0 else 0.0
+        _offset_rate = (_done - self.__resumed[0]) / _elapsed if _elapsed > 0 else 0.0
+        _left = self.__total - _done
+        _stats = dict(self.__counts)
+        _stats.update({'done': _done, 'total': self.__total,
+                       'percent': 100.0 * _done / self.__total if self.__total else 100.0,
+                       'rate': _rate, 'eta': _left / _offset_rate if _offset_rate > 0 else None,
+                       'segments': len([s for s in self.__segments if s[2] < s[3]])})
+        return _stats
+
+    def run(self):
+        '''
+        执行回放，阻塞直到所有段处理完成、调用了stop()或者收到KeyboardInterrupt
+        :return: stats()的返回值，无法确定回放范围时返回None
+        '''
+        if not self.__plan():
+            return None
+        _pending = [i for i, s in enumerate(self.__segments) if s[2] < s[3]]
+        self.__resumed = (sum(s[2] - s[1] for s in self.__segments), self.__counts['messages'])
+        self.__begin_at = time.time()
+        if not _pending:
+            self.loger.info('主题{}的回放范围已经全部处理完成.'.format(self.__topic))
+            return self.stats()
+        _workers = min(self.__workers, len(_pending))
+        self.loger.info('开始回放主题{}：{}段，共{}条，{}个工作{}.'.format(
+            self.__topic, len(_pending), self.__total - self.__resumed[0], _workers,
+            '进程' if self.__executor == 'process' else '线程'))
+        if self.__executor == 'process':
+            if not isinstance(self.__transport, PykafkaTransport):
+                self.loger.error('进程模式只支持pykafka传输层.')
+                return None
+            _progress = multiprocessing.Queue()
+            if _POOL_INITIALIZER:
+                _pool = ProcessPoolExecutor(_workers, initializer=_replay_init,
+                                            initargs=(self.__config, _progress, self.__stop))
+            else:
+                # 3.6没有initializer参数：进度队列和停止标志不能作为任务参数传递，
+                # 在主进程中设置后由fork出的工作进程继承
+                _replay_init(self.__config, _progress, self.__stop)
+                _pool = ProcessPoolExecutor(_workers)
+            _submit = functools.partial(_pool.submit, _replay_task)
+        else:
+            _progress = queue.Queue()
+            _config = dict(self.__config, transport=self.__transport, loger=self.loger)
+            _pool = ThreadPoolExecutor(_workers)
+            _submit = functools.partial(_pool.submit, _replay_segment, _config, _progress, self.__stop)
+        _futures = dict((_submit(i, tuple(self.__segments[i])), i) for i in _pending)
+        _last_report = time.time()
+        try:
+            while _futures:
+                try:
+                    self.__update(_progress.get(timeout=0.2))
+                except queue.Empty:
+                    pass
+                except KeyboardInterrupt:
+                    self.loger.info('收到中断，等待各段处理完当前批次.')
+                    self.__stop.set()
+                for _future in [f for f in _futures if f.done()]:
+                    _index = _futures.pop(_future)
+                    if _future.exception() is not None:
+                        self.loger.error('回放分区{}（offset {}起）出错：{}'.format(
+                            self.__segments[_index][0], self.__segments[_index][2], _future.exception()))
+                if time.time() - _last_report >= self.__progress_interval:
+                    _last_report = time.time()
+                    self.__report()
+            # 工作进程退出前放入的进度
+            while True:
+                try:
+                    self.__update(_progress.get(timeout=0.2))
+                except queue.Empty:
+                    break
+        finally:
+            _pool.shutdown(wait=True)
+            self.__report()
+        _stats = self.stats()
+        self.loger.info('主题{}回放{}：处理{}条，输出{}条，失败{}条，耗时{:.1f}秒.'.format(
+            self.__topic, '完成' if not _stats['segments'] else '中止', _stats['messages'], _stats['results'],
+            _stats['errors'], time.time() - self.__begin_at))
+        return _stats
+
+    def __plan(self):
+        '''
+        确定各段的范围，有检查点时从检查点读取
+        :return: 如果成功返回True
+        '''
+        if self.__checkpoint and os.path.exists(self.__checkpoint):
+            try:
+                with open(self.__checkpoint, 'r', encoding='utf-8') as f:
+                    _saved = json.load(f)
+                if _saved['topic'] == self.__topic.decode(self.__encoding):
+                    self.__segments = _saved['segments']
+                    self.__counts = _saved['counts']
+                    self.__total = sum(s[3] - s[1] for s in self.__segments)
+                    self.loger.info('从检查点{}继续回放，回放范围以检查点为准.'.format(self.__checkpoint))
+                    return True
+                self.loger.error('检查点{}不属于主题{}，重新回放.'.format(self.__checkpoint, self.__topic))
+            except Exception as e:
+                self.loger.error('读取检查点{}出错：{}'.format(self.__checkpoint, e))
+                return False
+        try:
+            _earliest = self.__transport.earliest_offsets(self.__topic)
+            _latest = self.__transport.latest_offsets(self.__topic)
+            if self.__begin_time is not None:
+                _starts = self.__transport.offsets_for_time(self.__topic, self.__begin_time)
+            else:
+                _starts = _earliest
+        except Exception as e:
+            self.loger.error('查询主题{}的offset出错：{}'.format(self.__topic, e))
+            return False
+        _segments = list()
+        for _id in sorted(_latest):
+            if isinstance(self.__begin, dict) and _id not in self.__begin:
+                continue
+            _begin = max(_starts.get(_id, 0), _earliest.get(_id, 0), _bound(self.__begin, _id, 0))
+            _end = min(_latest[_id], _bound(self.__end, _id, _latest[_id]))
+            _step = self.__segment_size or max(1, _end - _begin)
+            for _offset in range(_begin, _end, _step):
+                _segments.append([_id, _offset, _offset, min(_offset + _step, _end)])
+        self.__segments = _segments
+        self.__total = sum(s[3] - s[1] for s in _segments)
+        self.__save()
+        return True
+
+    def __update(self, report):
+        _index, _next, _messages, _results, _errors = report
+        _segment = self.__segments[_index]
+        if _next is not None and _next > _segment[2]:
+            _segment[2] = min(_next, _segment[3])
+        self.__counts['messages'] += _messages
+        self.__counts['results'] += _results
+        self.__counts['errors'] += _errors
+
+    def __report(self):
+        _stats = self.stats()
+        self.loger.info('回放进度：{:.1f}%（{}/{}），已处理{}条，每秒{:.0f}条，预计剩余{}秒.'.format(
+            _stats['percent'], _stats['done'], _stats['total'], _stats['messages'], _stats['rate'],
+            '-' if _stats['eta'] is None else int(_stats['eta'])))
+        self.__save()
+        if self.__on_progress is not None:
+            try:
+                self.__on_progress(_stats)
+            except Exception as e:
+                self.loger.error('进度回调出错：{}'.format(e))
+
+    def __save(self):
+        '''
+        写入检查点，先写临时文件再替换，中途退出不会留下不完整的检查点
+        '''
+        if not self.__checkpoint:
+            return
+        _tmp = self.__checkpoint + '.tmp'
+        try:
+            with open(_tmp, 'w', encoding='utf-8') as f:
+                json.dump({'topic': self.__topic.decode(self.__encoding), 'segments': self.__segments,
+                           'counts': self.__counts}, f)
+            os.replace(_tmp, self.__checkpoint)
+        except Exception as e:
+            self.loger.error('写入检查点{}出错：{}'.format(self.__checkpoint, e))
+
+
+def _bound(value, partition_id, default):
+    if value is None:
+        return default
+    if isinstance(value, dict):
+        return value.get(partition_id, default)
+    return value
+
+
+# 进程模式下，每个工作进程保存回放参数、进度队列和停止标志
+_replay_state = None
+# ProcessPoolExecutor的initializer参数在3.7中加入
+_POOL_INITIALIZER = sys.version_info >= (3, 7)
+
+
+def _replay_init(config, progress, stop_event):
+    global _replay_state
+    _replay_state = (config, progress, stop_event)
+
+
+def _replay_task(index, segment):
+    return _replay_segment(_replay_state[0], _replay_state[1], _replay_state[2], index, segment)
+
+
+def _replay_segment(config, progress, stop_event, index, segment):
+    '''
+    回放一段：[分区号, 段开始offset, 下一条要处理的offset, 段结束offset]
+    每批处理完成后向progress放入(段序号, 下一条要处理的offset, 消息数, 结果数, 失败数)
+    '''
+    _partition_id, _, _offset, _stop = segment
+    _loger = config.get('loger') or Loger('Replay', 'info')
+    _transport = config.get('transport') or PykafkaTransport(config['hosts'])
+    _consumer = _transport.consumer(config['topic'], None, consumer_timeout_ms=5000, partitions=[_partition_id],
+                                    fetch_message_max_bytes=max(config['max_buf'], 8 * 1024 * 1024),
+                                    queued_max_messages=max(config['batch_size'] * 2, 2000))
+    _producer = None
+    if config['out_topic']:
+        _producer = _transport.producer(config['out_topic'], max_request_size=config['max_buf'],
+                                        compression=config['compression'], linger_ms=5,
+                                        min_queued_messages=config['batch_size'], delivery_reports=True,
+                                        partitioner=Chunking.key_partitioner)
+    _file = None
+    if config['out_file']:
+        _file = open('{}.{}.{}'.format(config['out_file'], _partition_id, segment[1]), 'ab')
+    _reassembler = Chunking.Reassembler(loger=_loger)
+    _codec = Codec.get_codec(config['codec'])
+    _end_time = config['end_time']
+    _late = _end_time + config['time_grace_ms'] if _end_time is not None else None
+    try:
+        # reset_offsets设置的是最后已读的offset，-1/-2是LATEST/EARLIEST
+        _consumer.reset_offsets([(_consumer.partitions[_partition_id], _offset - 1 if _offset > 0 else EARLIEST)])
+        _done = False
+        while not _done and not stop_event.is_set():
+            _values = list()
+            _safe = None
+            while len(_values) < config['batch_size']:
+                _msg = _consumer.consume()
+                if _msg is None:
+                    # 后面的offset已经被删除或者压缩
+                    _done = True
+                    break
+                _value = _msg.value
+                if _msg.offset >= _stop:
+                    # 段结束，但是跨段的大消息要读完剩余的块
+                    if not _reassembler.pending:
+                        _done = True
+                        break
+                    if not Chunking.is_chunk(_value):
+                        continue
+                _timestamp = getattr(_msg, 'timestamp', 0)
+                if _timestamp and _late is not None and _timestamp > _late:
+                    _done = True
+                    break
+                if Chunking.is_chunk(_value):
+                    if _msg.offset >= _stop and Chunking.parse(_value)[1] == 0:
+                        continue
+                    _value = _reassembler.add(_value)
+                if not _reassembler.pending:
+                    # 没有未收齐的大消息时才推进进度，续跑时不会丢失前面的块
+                    _safe = min(_msg.offset + 1, _stop)
+                if _value and not (_timestamp and (
+                        (config['begin_time'] is not None and _timestamp < config['begin_time']) or
+                        (_end_time is not None and _timestamp > _end_time))):
+                    _values.append(_value)
+                if _msg.offset >= _stop - 1 and not _reassembler.pending:
+                    _done = True
+                    break
+            _results, _errors = _handle_batch(config, _codec, _values, _loger)
+            _write_results(config, _producer, _file, _results)
+            progress.put((index, _safe, len(_values), len(_results), _errors))
+        return index
+    finally:
+        _consumer.stop()
+        if _producer is not None:
+            _producer.stop()
+        if _file is not None:
+            _file.close()
+
+
+def _decode_batch(config, codec, values):
+    '''
+    按decode把一批消息转换为handler的参数
+    :return: [(参数, 是否解码成功), ...]
+    '''
+    if config['decode'] == 'envelope':
+        return [(Envelope(v, config['encoding'], codec), True) for v in values]
+    if config['decode'] != 'json':
+        return [(Envelope(v, config['encoding'], codec).text, True) for v in values]
+    if not codec.text:
+        codec = Codec.get_codec('json')
+    _decoded = [None] * len(values)
+    _texts = list()
+    for i, _value in enumerate(values):
+        if isinstance(_value, (dict, list)):
+            _decoded[i] = (_value, True)
+        elif Codec.is_tagged(_value):
+            try:
+                _decoded[i] = (Codec.decode_tagged(_value), True)
+            except Exception:
+                _decoded[i] = (None, False)
+        else:
+            _texts.append(i)
+    if _texts:
+        _raw = [values[i] if isinstance(values[i], bytes) else values[i].encode(config['encoding']) for i in _texts]
+        try:
+            # 一批json文本拼成一个数组一次解析
+            for i, _obj in zip(_texts, codec.decode(b'[' + b','.join(_raw) + b']')):
+                _decoded[i] = (_obj, True)
+        except Exception:
+            for i, _data in zip(_texts, _raw):
+                try:
+                    _decoded[i] = (codec.decode(_data), True)
+                except Exception:
+                    _decoded[i] = (None, False)
+    return _decoded
+
+
+def _handle_batch(config, codec, values, loger):
+    '''
+    解码一批消息并逐条交给handler
+    :return: (编码后的结果列表, 失败数)
+    '''
+    _results = list()
+    _errors = 0
+    for _value, _ok in _decode_batch(config, codec, values):
+        if not _ok:
+            _errors += 1
+            continue
+        try:
+            _result = config['handler'](_value)
+        except Exception as e:
+            loger.error('回放处理消息出错：{}'.format(e))
+            _errors += 1
+            continue
+        if _result is None:
+            continue
+        if isinstance(_result, (dict, list)):
+            _result = _result if config['objects'] else Codec.encode(_result, codec)
+        elif not isinstance(_result, bytes):
+            _result = _result.encode(config['encoding'])
+        _results.append(_result)
+    return _results, _errors
+
+
+def _write_results(config, producer, file, results):
+    '''
+    输出一批结果，输出主题等待所有消息的发送确认，文件写入后刷新
+    '''
+    if producer is not None and results:
+        _pending = 0
+        for _result in results:
+            if isinstance(_result, bytes) and not Chunking.fits(len(_result), config['max_buf']):
+                _key, _chunks = Chunking.split(_result, config['max_buf'])
+                for _chunk in _chunks:
+                    producer.produce(_chunk, partition_key=_key)
+                    _pending += 1
+            else:
+                producer.produce(_result)
+                _pending += 1
+        for _ in range(_pending):
+            _msg, _exc = producer.get_delivery_report(block=True, timeout=30)
+            if _exc is not None:
+                raise _exc
+    if file is not None and results:
+        for _result in results:
+            file.write(_result if isinstance(_result, bytes) else json.dumps(_result).encode(config['encoding']))
+            file.write(b'\n')
+        file.flush()
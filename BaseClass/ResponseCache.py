@@ -0,0 +1,103 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# @File  : ResponseCache.py
+# @Author: Liaop
+# @Date  : 2018-11-19
+# @Desc  : 回复缓存，LRU淘汰，带过期时间和内存上限，重复投递的请求直接发送缓存的回复
+
+from collections import OrderedDict
+import threading
+import time
+
+
+class ResponseCache(object):
+    '''
+    回复缓存
+
+    key='sessionid'时按请求的sessionid缓存，key='content'时按请求原始内容的哈希缓存；
+    重启后重新投递的请求命中缓存时不再执行command，直接发送之前的回复。
+    条目数超过max_entries或者占用超过max_bytes时淘汰最久未使用的条目，超过ttl秒的条目视为不存在。
+    '''
+
+    def __init__(self, max_entries=10000, max_bytes=64 * 1024 * 1024, ttl=300, key='sessionid', memo_ttl=None):
+        '''
+        初始化
+
+        :param max_entries: 最多缓存的条目数
+        :param max_bytes: 缓存回复占用的最大字节数（按回复长度估算）
+        :param ttl: 回复的缓存时间（秒）
+        :param key: 'sessionid'或者'content'
+        :param memo_ttl: 纯函数指令（Kafka.pure_actions）结果的缓存时间（秒），默认与ttl相同
+        '''
+        if key not in ('sessionid', 'content'):
+            raise ValueError('未知的缓存键类型：{}'.format(key))
+        self.key = key
+        self.ttl = ttl
+        self.memo_ttl = ttl if memo_ttl is None else memo_ttl
+        self.__max_entries = max_entries
+        self.__max_bytes = max_bytes
+        self.__entries = OrderedDict()      # key -> (过期时间, 回复, 估算大小)
+        self.__bytes = 0
+        self.__lock = threading.Lock()
+        self.__hits = 0
+        self.__misses = 0
+        self.__evictions = 0
+
+    def get(self, key):
+        '''
+        获取缓存的回复
+        :param key: 缓存键
+        :return: 回复，没有或者已过期时返回None
+        '''
+        with self.__lock:
+            _entry = self.__entries.get(key)
+            if _entry is None:
+                self.__misses += 1
+                return None
+            if _entry[0] < time.time():
+                self.__remove(key)
+                self.__misses += 1
+                return None
+            self.__entries.move_to_end(key)
+            self.__hits += 1
+            return _entry[1]
+
+    def put(self, key, value, ttl=None):
+        '''
+        缓存回复
+        :param key: 缓存键
+        :param value: 回复（str/bytes/dict）
+        :param ttl: 缓存时间（秒），默认为初始化时的ttl
+        :return:
+        '''
+        _size = (len(value) if isinstance(value, (str, bytes)) else 256) + 64
+        if _size > self.__max_bytes:
+            return
+        _expire = time.time() + (self.ttl if ttl is None else ttl)
+        with self.__lock:
+            if key in self.__entries:
+                self.__remove(key)
+            self.__entries[key] = (_expire, value, _size)
+            self.__bytes += _size
+            while len(self.__entries) > self.__max_entries or self.__bytes > self.__max_bytes:
+                self.__remove(next(iter(self.__entries)))
+                self.__evictions += 1
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+            self.__bytes = 0
+
+    def stats(self):
+        '''
+        :return: {'entries', 'bytes', 'hits', 'misses', 'evictions'}
+        '''
+        return {'entries': len(self.__entries), 'bytes': self.__bytes, 'hits': self.__hits,
+                'misses': self.__misses, 'evictions': self.__evictions}
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def __remove(self, key):
+        _entry = self.__entries.pop(key)
+        self.__bytes -= _entry[2]
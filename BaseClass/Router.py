@@ -0,0 +1,125 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# @File  : Router.py
+# @Author: Liaop
+# @Date  : 2018-10-22
+# @Desc  : 回复路由，由后台线程统一读取回复主题，按sessionid分发给等待中的请求
+
+import threading
+from concurrent.futures import Future
+
+from BaseClass.Log import Loger
+
+
+class ReplyRouter(object):
+    '''
+    回复路由器
+
+    一个后台线程独占回复主题的consumer，将收到的回复按sessionid投递到对应的Future，
+    多个线程可以通过同一个Kafka实例同时发起请求，每个请求只会被自己的回复唤醒。
+    '''
+
+    def __init__(self, fetch, get_session, loger=None):
+        '''
+        初始化
+
+        :param fetch: 获取一条回复的函数，无信息或者超时返回None
+        :param get_session: 从回复中解析sessionid的函数
+        :param loger: 日志记录对象
+        '''
+        if loger:
+            self.loger = loger
+        else:
+            self.loger = Loger('ReplyRouter', 'debug')
+        self.__fetch = fetch
+        self.__get_session = get_session
+        self.__pending = dict()
+        self.__lock = threading.Lock()
+        self.__run = False
+        self.__thread = None
+
+    @property
+    def running(self):
+        return self.__run
+
+    def start(self):
+        '''
+        启动后台读取线程
+        :return: 如果成功返回True
+        '''
+        if self.__run:
+            self.loger.error('回复路由已经启动中.')
+            return False
+        self.__run = True
+        self.__thread = threading.Thread(target=self.__loop, name='ReplyRouter')
+        self.__thread.daemon = True
+        self.__thread.start()
+        return True
+
+    def stop(self, timeout=None):
+        '''
+        停止后台读取线程，所有等待中的请求将收到异常
+
+        :param timeout: 等待线程退出的时间（秒）
+        :return:
+        '''
+        self.__run = False
+        with self.__lock:
+            pending = self.__pending
+            self.__pending = dict()
+        for _future in pending.values():
+            if not _future.done():
+                _future.set_exception(RuntimeError('回复路由已停止'))
+        if self.__thread is not None and self.__thread is not threading.current_thread():
+            self.__thread.join(timeout)
+        self.__thread = None
+
+    def register(self, sessionid):
+        '''
+        登记一个等待回复的请求，必须在发送请求之前调用，避免回复先于登记到达
+
+        :param sessionid: 请求的sessionid
+        :return: 用于等待回复的Future，如果sessionid已在等待中返回None
+        '''
+        _future = Future()
+        with self.__lock:
+            if sessionid in self.__pending:
+                return None
+            self.__pending[sessionid] = _future
+        return _future
+
+    def cancel(self, sessionid):
+        '''
+        取消等待（超时或发送失败时调用），之后到达的回复将被丢弃
+
+        :param sessionid: 请求的sessionid
+        :return:
+        '''
+        with self.__lock:
+            _future = self.__pending.pop(sessionid, None)
+        if _future is not None:
+            _future.cancel()
+
+    def pending(self):
+        '''
+        当前等待中的请求数
+        '''
+        return len(self.__pending)
+
+    def __loop(self):
+        while self.__run:
+            try:
+                message = self.__fetch()
+            except Exception as e:
+                self.loger.error('回复路由接收信息出错：{}'.format(e))
+                continue
+            if message is None:
+                continue
+            sessionid = self.__get_session(message)
+            with self.__lock:
+                _future = self.__pending.pop(sessionid, None)
+            if _future is None:
+                self.loger.debug('丢弃无人等待的回复，sessionid:%s', sessionid)
+                continue
+            if _future.set_running_or_notify_cancel():
+                _future.set_result(message)
@@ -0,0 +1,341 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# @File  : ShmRing.py
+# @Author: Liaop
+# @Date  : 2018-11-12
+# @Desc  : 基于共享内存的环形缓冲区，进程之间直接传递原始消息bytes，不需要pickle和管道
+
+import copy
+import itertools
+import multiprocessing
+import os
+import struct
+import time
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+# 每条通道的头部：写进程和读进程修改的位置分别放在不同的缓存行，数据区从_DATA开始
+_HEAD = 0       # 已发布的写位置，只由写进程修改
+_PUT = 8        # 已写入的批次数，只由写进程修改
+_CLAIM = 64     # 下一批待领取的位置，读进程持通道的读锁修改
+_GOT = 72       # 已领取的批次数，读进程持通道的读锁修改
+_TAIL = 128     # 已经读完、可以覆盖的位置，读进程按领取的顺序修改
+_DATA = 192
+_POS = struct.Struct('<Q')
+# 一批记录的头部：整批占用的字节数（8字节对齐）、记录数，之后是各条记录的长度和依次拼接的原始bytes
+_BLOCK = struct.Struct('<II')
+# 特殊的记录数：结束标记；特殊的字节数：回绕标记（该位置之后到通道末尾不再有记录）
+_END = 0xFFFFFFFF
+_WRAP = 0xFFFFFFFE
+# 控制通道只传递结束标记
+_CONTROL_SIZE = 4096
+
+
+class ShmRing(object):
+    '''
+    共享内存环形缓冲区
+
+    每个写进程一条通道（单写多读），写进程不加锁；读进程持通道的读锁只领取一批记录的位置，
+    复制记录时不持锁，读完后按领取的顺序释放空间。一批记录在通道中连续存放，读取时一次解析所有长度。
+    读进程没有数据可读时等待信号量，写进程只在有读进程等待时才释放信号量。
+    结束标记放在单独的控制通道中，读进程在所有数据通道都读空之后才会读到结束标记。
+
+    put()/get()与KafkaServer.make_queue创建的队列接口相同：put放入一批bytes，
+    get取出一批bytes，put(None)放入一个结束标记，读到结束标记的get返回None。
+    有多个写进程时，每个写进程通过writer(i)取得自己通道的对象再调用put；
+    一批记录必须整批放进通道，超过通道大小一半的批次拆成几批写入，单条记录也不能超过通道大小的一半。
+    '''
+
+    def __init__(self, size=64 * 1024 * 1024, producers=1, multi_producer=False):
+        '''
+        初始化，在主进程中创建，然后作为参数传给读写进程
+
+        :param size: 每条数据通道的大小（字节）
+        :param producers: 写进程数，每个写进程一条数据通道
+        :param multi_producer: 为True时只有一条数据通道，写进程数不固定，写进程之间用一把锁互斥
+        '''
+        if shared_memory is None:
+            raise RuntimeError('当前Python版本不支持multiprocessing.shared_memory')
+        _lanes = 1 if multi_producer else max(1, producers)
+        _capacity = size - size % 8
+        self.__caps = [_capacity] * _lanes + [_CONTROL_SIZE]
+        self.__bases = list()
+        _offset = 0
+        for _cap in self.__caps:
+            self.__bases.append(_offset)
+            _offset += _DATA + _cap
+        self.__shm = shared_memory.SharedMemory(create=True, size=_offset)
+        self.__name = self.__shm.name
+        for _base in self.__bases:
+            self.__shm.buf[_base:_base + _DATA] = bytes(_DATA)
+        self.__lanes = _lanes
+        self.__lane = 0
+        self.__read_locks = [multiprocessing.Lock() for i in range(_lanes + 1)]
+        # 控制通道由主进程写入，数据通道只在multi_producer时加锁
+        self.__write_locks = [multiprocessing.Lock() if multi_producer else None for i in range(_lanes)]
+        self.__write_locks.append(multiprocessing.Lock())
+        self.__bell = multiprocessing.Semaphore(0)
+        self.__waiters = multiprocessing.Value('i', 0)
+        self.__owner = os.getpid()
+        self.__tails = [0] * (_lanes + 1)
+        self.__next = 0
+
+    def __getstate__(self):
+        _state = self.__dict__.copy()
+        _state['_ShmRing__shm'] = None
+        return _state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__shm = shared_memory.SharedMemory(name=self.__name)
+
+    @property
+    def capacity(self):
+        return self.__caps[0]
+
+    @property
+    def producers(self):
+        '''
+        数据通道数
+        '''
+        return self.__lanes
+
+    def writer(self, index):
+        '''
+        第index个写进程使用的对象，put写入该进程自己的通道，在主进程中取得后作为参数传给写进程
+        :param index: 写进程序号，0到producers-1
+        :return: ShmRing
+        '''
+        if not 0 <= index < self.__lanes:
+            raise ValueError('写进程序号{}超出范围，共{}条通道'.format(index, self.__lanes))
+        _ring = copy.copy(self)
+        _ring.__lane = index
+        _ring.__owner = None
+        return _ring
+
+    def put(self, batch, timeout=None):
+        '''
+        写入一批记录，超过通道大小一半的批次拆成几批写入
+
+        :param batch: bytes列表，为None时在控制通道写入一个结束标记
+        :param timeout: 通道已满时最长等待时间（秒），为None时一直等待
+        :return: 写入成功返回True，超时返回False（超时的那一批及之后的记录都没有写入）
+        :raise ValueError: 单条记录超过通道大小的一半，通道再空也放不下
+        '''
+        _lane = self.__lanes if batch is None else self.__lane
+        _parts = [(None, None)] if batch is None else self.__split(batch, self.__caps[_lane])
+        _deadline = None if timeout is None else time.time() + timeout
+        _lock = self.__write_locks[_lane]
+        if _lock is not None and not _lock.acquire(True, timeout):
+            return False
+        try:
+            for _part, _lens in _parts:
+                if not self.__write(_lane, _part, _lens, _deadline):
+                    return False
+        finally:
+            if _lock is not None:
+                _lock.release()
+        return True
+
+    @staticmethod
+    def __split(batch, capacity):
+        '''
+        把一批记录拆成不超过通道大小一半的几批：一批在通道中连续存放，写入位置要回绕时通道末尾不足一批的空间被跳过，
+        每批不超过一半时通道读空后总能放下
+        :return: [(记录列表, 各条记录的长度)]
+        '''
+        _limit = capacity // 2 - _BLOCK.size - 7
+        _lens = list(map(len, batch))
+        if 4 * len(_lens) + sum(_lens) <= _limit:
+            return [(batch, _lens)]
+        if 4 + max(_lens) > _limit:
+            raise ValueError('记录长度{}超过缓冲区大小{}的一半'.format(max(_lens), capacity))
+        _parts = list()
+        _begin = 0
+        _used = 0
+        for i, _len in enumerate(_lens):
+            if _used + 4 + _len > _limit:
+                _parts.append((batch[_begin:i], _lens[_begin:i]))
+                _begin, _used = i, 0
+            _used += 4 + _len
+        _parts.append((batch[_begin:], _lens[_begin:]))
+        return _parts
+
+    def get(self, block=True, timeout=None):
+        '''
+        取出一批记录，依次检查各数据通道，都没有记录时才检查控制通道
+
+        :param block: 没有记录时是否等待
+        :param timeout: 最长等待时间（秒）
+        :return: bytes列表；读到结束标记时返回None；没有记录时返回空列表
+        '''
+        _deadline = None if timeout is None else time.time() + timeout
+        while True:
+            _claimed = self.__claim_any()
+            if _claimed is not None:
+                return self.__read(*_claimed)
+            if not block:
+                return list()
+            _wait = None if _deadline is None else _deadline - time.time()
+            if _wait is not None and _wait <= 0:
+                return list()
+            self.__sleep(_wait)
+
+    def qsize(self):
+        '''
+        数据通道中未读取的批次数（近似值）
+        '''
+        _buf = self.__shm.buf
+        _count = 0
+        for _base in self.__bases[:self.__lanes]:
+            _count += _POS.unpack_from(_buf, _base + _PUT)[0] - _POS.unpack_from(_buf, _base + _GOT)[0]
+        return _count
+
+    def close(self):
+        '''
+        断开当前进程与共享内存的连接，创建者同时释放共享内存
+        '''
+        if self.__shm is None:
+            return
+        self.__shm.close()
+        if self.__owner == os.getpid():
+            self.__shm.unlink()
+        self.__shm = None
+
+    def __write(self, lane, batch, lens, deadline):
+        _buf = self.__shm.buf
+        _base = self.__bases[lane]
+        _cap = self.__caps[lane]
+        _head = _POS.unpack_from(_buf, _base + _HEAD)[0]
+        if batch is None:
+            _count, _lens, _data = _END, b'', b''
+        else:
+            _count = len(batch)
+            _lens = struct.pack('<{}I'.format(_count), *lens)
+            _data = b''.join(batch)
+        _size = (_BLOCK.size + len(_lens) + len(_data) + 7) // 8 * 8
+        _off = _head % _cap
+        _skip = 0 if _cap - _off >= _size else _cap - _off
+        if not self.__wait_space(lane, _head + _skip + _size, deadline):
+            return False
+        if _skip:
+            _BLOCK.pack_into(_buf, _base + _DATA + _off, _WRAP, 0)
+            _head += _skip
+            _off = 0
+        _pos = _base + _DATA + _off
+        _BLOCK.pack_into(_buf, _pos, _size, _count)
+        _pos += _BLOCK.size
+        _buf[_pos:_pos + len(_lens)] = _lens
+        _pos += len(_lens)
+        _buf[_pos:_pos + len(_data)] = _data
+        # 写完数据后再发布写位置，读进程才能领取这一批
+        _POS.pack_into(_buf, _base + _HEAD, _head + _size)
+        _POS.pack_into(_buf, _base + _PUT, _POS.unpack_from(_buf, _base + _PUT)[0] + 1)
+        _buf = None
+        if self.__waiters.value:
+            self.__bell.release()
+        return True
+
+    def __wait_space(self, lane, end, deadline):
+        '''
+        等待读进程释放空间，直到写入位置end不会覆盖未读完的数据
+        先用缓存的释放位置判断，不够时才读取共享的释放位置
+        '''
+        _cap = self.__caps[lane]
+        if end - self.__tails[lane] <= _cap:
+            return True
+        _pos = self.__bases[lane] + _TAIL
+        _sleep = 0.00005
+        while True:
+            self.__tails[lane] = _POS.unpack_from(self.__shm.buf, _pos)[0]
+            if end - self.__tails[lane] <= _cap:
+                return True
+            if deadline is not None and time.time() >= deadline:
+                return False
+            time.sleep(_sleep)
+            _sleep = min(_sleep * 2, 0.005)
+
+    def __claim_any(self):
+        '''
+        从下一条数据通道开始轮流领取，数据通道都为空时领取控制通道
+        :return: 领取的批次，见__claim，都为空时返回None
+        '''
+        for i in range(self.__lanes):
+            _lane = (self.__next + i) % self.__lanes
+            _claimed = self.__claim(_lane)
+            if _claimed is not None:
+                self.__next = _lane + 1
+                return _claimed
+        return self.__claim(self.__lanes)
+
+    def __claim(self, lane):
+        '''
+        持读锁领取通道中的下一批，只移动领取位置，不复制数据
+        :return: (通道, 开始位置, 结束位置, 数据区中的位置, 记录数)，通道为空时返回None
+        '''
+        _buf = self.__shm.buf
+        _base = self.__bases[lane]
+        # 先不加锁判断是否为空，空的通道不需要加锁
+        if _POS.unpack_from(_buf, _base + _CLAIM)[0] == _POS.unpack_from(_buf, _base + _HEAD)[0]:
+            return None
+        with self.__read_locks[lane]:
+            _start = _POS.unpack_from(_buf, _base + _CLAIM)[0]
+            if _start == _POS.unpack_from(_buf, _base + _HEAD)[0]:
+                return None
+            _cap = self.__caps[lane]
+            _off = _start % _cap
+            _size, _count = _BLOCK.unpack_from(_buf, _base + _DATA + _off)
+            _end = _start
+            if _size == _WRAP:
+                _end += _cap - _off
+                _off = 0
+                _size, _count = _BLOCK.unpack_from(_buf, _base + _DATA)
+            _end += _size
+            _POS.pack_into(_buf, _base + _CLAIM, _end)
+            _POS.pack_into(_buf, _base + _GOT, _POS.unpack_from(_buf, _base + _GOT)[0] + 1)
+        return lane, _start, _end, _base + _DATA + _off, _count
+
+    def __read(self, lane, start, end, pos, count):
+        '''
+        复制领取的一批记录，然后等前面领取的批次都释放后释放这一批占用的空间
+        '''
+        _buf = self.__shm.buf
+        if count == _END:
+            _batch = None
+        else:
+            _pos = pos + _BLOCK.size
+            _lens = struct.unpack_from('<{}I'.format(count), _buf, _pos)
+            _pos += 4 * count
+            _ends = list(itertools.accumulate(_lens))
+            _raw = bytes(_buf[_pos:_pos + (_ends[-1] if _ends else 0)])
+            _batch = [_raw[_begin:_end] for _begin, _end in zip([0] + _ends, _ends)]
+        _tail = self.__bases[lane] + _TAIL
+        while _POS.unpack_from(_buf, _tail)[0] != start:
+            time.sleep(0)
+        _POS.pack_into(_buf, _tail, end)
+        _buf = None
+        return _batch
+
+    def __sleep(self, timeout):
+        '''
+        没有可读的数据时等待写进程的通知，登记等待之后再检查一次，不会错过登记之前写入的批次
+        '''
+        with self.__waiters.get_lock():
+            self.__waiters.value += 1
+        try:
+            if not self.__empty():
+                return
+            self.__bell.acquire(True, timeout)
+        finally:
+            with self.__waiters.get_lock():
+                self.__waiters.value -= 1
+
+    def __empty(self):
+        _buf = self.__shm.buf
+        for _base in self.__bases:
+            if _POS.unpack_from(_buf, _base + _CLAIM)[0] != _POS.unpack_from(_buf, _base + _HEAD)[0]:
+                return False
+        return True
@@ -0,0 +1,67 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# @File  : SingleFlight.py
+# @Author: Liaop
+# @Date  : 2018-11-20
+# @Desc  : 相同请求合并：同一个键正在执行时，后来的调用等待并共用第一个调用的结果
+
+from concurrent.futures import Future
+import threading
+
+from BaseClass.ResponseCache import ResponseCache
+
+
+class SingleFlight(object):
+    '''
+    相同请求合并
+
+    同一个键同时只执行一次，执行期间的其他调用等待同一个结果；
+    设置ttl后，结果在ttl秒内继续被相同的调用直接使用。
+    '''
+
+    def __init__(self, ttl=0, max_entries=1000):
+        '''
+        初始化
+
+        :param ttl: 结果的缓存时间（秒），0表示只合并同时在执行的调用
+        :param max_entries: 最多缓存的结果数
+        '''
+        self.__lock = threading.Lock()
+        self.__calls = dict()       # 键 -> 正在执行的调用的Future
+        self.__results = ResponseCache(max_entries=max_entries, ttl=ttl) if ttl else None
+
+    def do(self, key, fn, cacheable=None):
+        '''
+        执行调用，相同键的调用正在执行或者结果还在缓存中时直接使用该结果
+
+        :param key: 调用的键
+        :param fn: 无参数的执行函数
+        :param cacheable: 判断结果能否缓存的函数，为None时都缓存
+        :return: (结果, 是否共用了其他调用的结果)
+        '''
+        with self.__lock:
+            if self.__results is not None:
+                _result = self.__results.get(key)
+                if _result is not None:
+                    return _result, True
+            _future = self.__calls.get(key)
+            _leader = _future is None
+            if _leader:
+                _future = Future()
+                self.__calls[key] = _future
+        if not _leader:
+            return _future.result(), True
+        try:
+            _result = fn()
+        except BaseException as e:
+            with self.__lock:
+                del self.__calls[key]
+            _future.set_exception(e)
+            raise
+        with self.__lock:
+            # 先放入缓存再移除，之后的调用不会在两者之间重新执行
+            if self.__results is not None and _result is not None and (cacheable is None or cacheable(_result)):
+                self.__results.put(key, _result)
+            del self.__calls[key]
+        _future.set_result(_result)
+        return _result, False
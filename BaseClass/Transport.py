@@ -0,0 +1,520 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# @File  : Transport.py
+# @Author: Liaop
+# @Date  : 2018-11-21
+# @Desc  : 传输层：Kafka和KafkaServer通过它创建producer和consumer，有pykafka和进程内存两种实现
+
+from collections import deque
+import itertools
+import queue
+import threading
+import time
+import zlib
+
+# 与pykafka.common.OffsetType的取值一致
+EARLIEST = -2
+LATEST = -1
+
+
+class Transport(object):
+    '''
+    传输层接口
+
+    producer: produce(value, partition_key=None)发送一条消息；stop()停止；
+              delivery_reports=True时get_delivery_report(block, timeout)返回(消息, 异常)，没有时抛出queue.Empty
+    consumer: consume(block=True)接收一条消息，超时返回None，也可以迭代；
+              commit_offsets(partition_offsets=None)提交offset（下一条要读的位置），默认提交当前位置；
+              reset_offsets(partition_offsets)定位，参数为[(分区, 最后已读的offset)]，offset可以是EARLIEST/LATEST；
+              stop()停止
+    消息对象: value、offset、partition、partition_id、partition_key
+    接口与pykafka的producer/consumer一致，pykafka实现直接返回pykafka的对象。
+    '''
+    # 为True时消息对象（dict/list）不编码，原样交给接收方
+    objects = False
+
+    def producer(self, topic, **kwargs):
+        '''
+        创建producer
+        :param topic: 主题名（bytes）
+        :param kwargs: max_request_size、compression、linger_ms、delivery_reports等参数
+        :return: producer
+        '''
+        raise NotImplementedError
+
+    def consumer(self, topic, consumer_group, consumer_timeout_ms=-1, balance=False, **kwargs):
+        '''
+        创建consumer
+        :param topic: 主题名（bytes）
+        :param consumer_group: 消费者组名（bytes）
+        :param consumer_timeout_ms: consume()等待的超时时间（毫秒），小于等于0时一直等待
+        :param balance: 是否与同组的其他consumer分配分区
+        :param kwargs: auto_offset_reset、partitions（只读取的分区号列表）等参数
+        :return: consumer
+        '''
+        raise NotImplementedError
+
+    def shared_producer(self, topic, **kwargs):
+        '''
+        获取同一进程内共享的producer，用于send_msg这类单次发送
+        '''
+        raise NotImplementedError
+
+    def shared_consumer(self, topic, consumer_group, **kwargs):
+        '''
+        获取同一进程内共享的consumer，用于get_msg这类单次接收
+        :return: (consumer, 锁)
+        '''
+        raise NotImplementedError
+
+    def latest_offsets(self, topic):
+        '''
+        各分区最新消息的下一个offset
+        :param topic: 主题名（bytes）
+        :return: {分区号: offset}
+        '''
+        raise NotImplementedError
+
+    def earliest_offsets(self, topic):
+        '''
+        各分区最早一条保留消息的offset
+        :param topic: 主题名（bytes）
+        :return: {分区号: offset}
+        '''
+        raise NotImplementedError
+
+    def offsets_for_time(self, topic, timestamp):
+        '''
+        各分区从指定时间开始读取的offset，该offset之前的消息都早于timestamp
+        :param topic: 主题名（bytes）
+        :param timestamp: 毫秒时间戳
+        :return: {分区号: offset}，pykafka实现按日志段定位，返回的offset可能早于timestamp，读取时需要按消息时间过滤
+        '''
+        raise NotImplementedError
+
+    def committed_offsets(self, topic, consumer_group):
+        '''
+        消费者组在各分区已提交的offset
+        :param topic: 主题名（bytes）
+        :param consumer_group: 消费者组名（bytes）
+        :return: {分区号: 下一条要读的offset}，没有提交过的分区为None
+        '''
+        raise NotImplementedError
+
+
+class PykafkaTransport(Transport):
+    '''
+    pykafka实现，KafkaClient和共享的producer/consumer来自连接池
+    '''
+
+    def __init__(self, hosts):
+        '''
+        :param hosts: kafka主机地址，多个主机用逗号隔开
+        '''
+        self.hosts = hosts
+        self.__lock = threading.Lock()
+        self.__offset_consumers = dict()    # (主题, 消费者组) -> 只用来查询offset、不启动的consumer
+
+    def producer(self, topic, **kwargs):
+        return self.__topic(topic).get_producer(**kwargs)
+
+    def consumer(self, topic, consumer_group, consumer_timeout_ms=-1, balance=False, **kwargs):
+        _topic = self.__topic(topic)
+        if kwargs.get('partitions') is not None:
+            kwargs['partitions'] = [_topic.partitions[getattr(p, 'id', p)] for p in kwargs['partitions']]
+        if balance:
+            return _topic.get_balanced_consumer(consumer_group=consumer_group, consumer_timeout_ms=consumer_timeout_ms,
+                                                managed=True, **kwargs)
+        return _topic.get_simple_consumer(consumer_group=consumer_group, consumer_timeout_ms=consumer_timeout_ms,
+                                          **kwargs)
+
+    def shared_producer(self, topic, **kwargs):
+        return _get_pool().get_producer(self.hosts, topic, **kwargs)
+
+    def shared_consumer(self, topic, consumer_group, **kwargs):
+        return _get_pool().get_consumer(self.hosts, topic, consumer_group, **kwargs)
+
+    def latest_offsets(self, topic):
+        return dict((_id, _res.offset[0]) for _id, _res in self.__topic(topic).latest_available_offsets().items())
+
+    def earliest_offsets(self, topic):
+        return dict((_id, _res.offset[0]) for _id, _res in self.__topic(topic).earliest_available_offsets().items())
+
+    def offsets_for_time(self, topic, timestamp):
+        _earliest = self.earliest_offsets(topic)
+        # ListOffsets按日志段返回timestamp之前最后一个日志段的起始offset，没有时从最早的消息开始
+        _limits = self.__topic(topic).fetch_offset_limits(timestamp, max_offsets=1)
+        return dict((_id, max(_limits[_id].offset[0], _offset) if _id in _limits and _limits[_id].offset else _offset)
+                    for _id, _offset in _earliest.items())
+
+    def committed_offsets(self, topic, consumer_group):
+        _key = (topic, consumer_group)
+        with self.__lock:
+            _consumer = self.__offset_consumers.get(_key)
+            if _consumer is None:
+                _consumer = self.__offset_consumers[_key] = self.__topic(topic).get_simple_consumer(
+                    consumer_group=consumer_group, auto_start=False)
+            return dict((_id, _res.offset if _res.offset >= 0 else None) for _id, _res in _consumer.fetch_offsets())
+
+    def __topic(self, topic):
+        return _get_pool().get_client(self.hosts).topics[topic]
+
+
+def _get_pool():
+    # 延迟导入，只使用内存实现时不需要安装pykafka
+    from BaseClass.Pool import get_pool
+    return get_pool()
+
+
+class MemoryPartition(object):
+    '''
+    内存主题的分区
+    '''
+    __slots__ = ('topic', 'id', 'messages', 'base')
+
+    def __init__(self, topic, partition_id):
+        self.topic = topic
+        self.id = partition_id
+        self.messages = deque()
+        self.base = 0           # messages[0]的offset
+
+    @property
+    def end(self):
+        '''
+        下一条消息的offset
+        '''
+        return self.base + len(self.messages)
+
+    def __repr__(self):
+        return 'MemoryPartition({}, {})'.format(self.topic, self.id)
+
+
+class MemoryMessage(object):
+    __slots__ = ('value', 'offset', 'partition', 'partition_key', 'timestamp')
+
+    def __init__(self, value, offset, partition, partition_key=None):
+        self.value = value
+        self.offset = offset
+        self.partition = partition
+        self.partition_key = partition_key
+        self.timestamp = int(time.time() * 1000)
+
+    @property
+    def partition_id(self):
+        return self.partition.id
+
+
+class MemoryBroker(object):
+    '''
+    进程内的消息代理
+
+    主题按需创建，每个分区保留最近max_messages条消息；消费者组的offset保存在代理中，
+    同组的均衡consumer按加入顺序轮流分配分区。所有操作在一个条件变量下进行，新消息到达时唤醒等待的consumer。
+    '''
+
+    def __init__(self, partitions=1, max_messages=100000):
+        '''
+        初始化
+
+        :param partitions: 新建主题的分区数
+        :param max_messages: 每个分区最多保留的消息数，超过时丢弃最早的消息
+        '''
+        self.cond = threading.Condition()
+        self.__partitions = partitions
+        self.__max_messages = max_messages
+        self.__topics = dict()      # 主题 -> [MemoryPartition, ...]
+        self.__offsets = dict()     # (消费者组, 主题, 分区号) -> 已提交的offset（下一条要读的位置）
+        self.__members = dict()     # (消费者组, 主题) -> [均衡consumer, ...]
+
+    def create_topic(self, topic, partitions=None):
+        '''
+        创建主题，已存在时返回现有的分区
+        :param topic: 主题名
+        :param partitions: 分区数，默认为初始化时的设置
+        :return: 分区列表
+        '''
+        topic = _name(topic)
+        with self.cond:
+            _partitions = self.__topics.get(topic)
+            if _partitions is None:
+                _partitions = self.__topics[topic] = [MemoryPartition(topic, i)
+                                                      for i in range(partitions or self.__partitions)]
+            return _partitions
+
+    def partitions(self, topic):
+        return self.__topics.get(_name(topic)) or self.create_topic(topic)
+
+    def append(self, partition, value, partition_key=None):
+        '''
+        在分区末尾追加一条消息，并唤醒等待的consumer
+        :return: 消息对象
+        '''
+        with self.cond:
+            _msg = MemoryMessage(value, partition.end, partition, partition_key)
+            partition.messages.append(_msg)
+            if len(partition.messages) > self.__max_messages:
+                partition.messages.popleft()
+                partition.base += 1
+            self.cond.notify_all()
+        return _msg
+
+    def committed(self, group, partition):
+        return self.__offsets.get((group, partition.topic, partition.id))
+
+    def commit(self, group, partition, offset):
+        self.__offsets[(group, partition.topic, partition.id)] = offset
+
+    def join(self, group, topic, consumer):
+        with self.cond:
+            self.__members.setdefault((group, _name(topic)), list()).append(consumer)
+
+    def leave(self, group, topic, consumer):
+        with self.cond:
+            _members = self.__members.get((group, _name(topic)), [])
+            if consumer in _members:
+                _members.remove(consumer)
+            self.cond.notify_all()
+
+    def assignment(self, group, topic, consumer):
+        '''
+        均衡consumer当前分配到的分区
+        '''
+        _members = self.__members.get((group, _name(topic)), [])
+        if consumer not in _members:
+            return []
+        _index = _members.index(consumer)
+        return [p for p in self.partitions(topic) if p.id % len(_members) == _index]
+
+
+class MemoryProducer(object):
+    def __init__(self, broker, topic, delivery_reports=False, **kwargs):
+        self.__broker = broker
+        self.__partitions = broker.partitions(topic)
+        self.__cycle = itertools.cycle(range(len(self.__partitions)))
+        self.__reports = queue.Queue() if delivery_reports else None
+
+    def produce(self, message, partition_key=None):
+        '''
+        发送一条消息，有partition_key时按键的哈希选择分区，否则轮流发送到各分区
+        :return: 消息对象
+        '''
+        if partition_key is None:
+            _partition = self.__partitions[next(self.__cycle)]
+        else:
+            _key = partition_key if isinstance(partition_key, bytes) else str(partition_key).encode('utf-8')
+            _partition = self.__partitions[zlib.crc32(_key) % len(self.__partitions)]
+        _msg = self.__broker.append(_partition, message, partition_key)
+        if self.__reports is not None:
+            self.__reports.put((_msg, None))
+        return _msg
+
+    def get_delivery_report(self, block=True, timeout=None):
+        if self.__reports is None:
+            raise queue.Empty()
+        return self.__reports.get(block, timeout)
+
+    def stop(self):
+        pass
+
+
+class MemoryConsumer(object):
+    def __init__(self, broker, topic, consumer_group, consumer_timeout_ms=-1, balance=False,
+                 auto_offset_reset=EARLIEST, reset_offset_on_start=False, partitions=None, **kwargs):
+        self.__broker = broker
+        self.__topic = topic
+        self.__group = consumer_group
+        self.__timeout = consumer_timeout_ms / 1000.0 if consumer_timeout_ms > 0 else None
+        self.__balance = balance
+        self.__reset = auto_offset_reset
+        self.__reset_on_start = reset_offset_on_start
+        # 只读取指定的分区（分区对象或者分区号）
+        self.__only = None if partitions is None else set(getattr(p, 'id', p) for p in partitions)
+        self.__positions = dict()   # 分区 -> 下一条要读的offset
+        self.__running = True
+        self.__next = 0
+        broker.create_topic(topic)
+        if balance:
+            broker.join(consumer_group, topic, self)
+
+    @property
+    def partitions(self):
+        return dict((p.id, p) for p in self.__owned())
+
+    def start(self):
+        pass
+
+    def consume(self, block=True):
+        '''
+        接收一条消息，轮流读取分配到的各分区
+        :param block: 没有消息时是否等待，等待consumer_timeout_ms后返回None
+        :return: 消息对象，没有时返回None
+        '''
+        _deadline = time.time() + self.__timeout if self.__timeout else None
+        with self.__broker.cond:
+            while self.__running:
+                _owned = self.__owned()
+                for i in range(len(_owned)):
+                    _partition = _owned[(self.__next + i) % len(_owned)]
+                    _offset = max(self.__position(_partition), _partition.base)
+                    if _offset < _partition.end:
+                        _msg = _partition.messages[_offset - _partition.base]
+                        self.__positions[_partition] = _offset + 1
+                        self.__next = (self.__next + i + 1) % len(_owned)
+                        return _msg
+                if not block:
+                    return None
+                _wait = _deadline - time.time() if _deadline else 1.0
+                if _wait <= 0:
+                    return None
+                self.__broker.cond.wait(_wait)
+        return None
+
+    def __iter__(self):
+        while True:
+            _msg = self.consume()
+            if _msg is None:
+                return
+            yield _msg
+
+    def commit_offsets(self, partition_offsets=None):
+        '''
+        提交offset
+        :param partition_offsets: [(分区, 下一条要读的offset)]，为None时提交各分区的当前位置
+        '''
+        with self.__broker.cond:
+            if partition_offsets is None:
+                partition_offsets = list(self.__positions.items())
+            for _partition, _offset in partition_offsets:
+                self.__broker.commit(self.__group, self.__partition(_partition), _offset)
+
+    def reset_offsets(self, partition_offsets=None):
+        '''
+        定位
+        :param partition_offsets: [(分区, 最后已读的offset)]，offset为EARLIEST/LATEST时定位到最早/最新，
+                                  为None时所有分区按auto_offset_reset定位
+        '''
+        with self.__broker.cond:
+            if partition_offsets is None:
+                partition_offsets = [(p, self.__reset) for p in self.__owned()]
+            for _partition, _offset in partition_offsets:
+                _partition = self.__partition(_partition)
+                if _offset == EARLIEST:
+                    self.__positions[_partition] = _partition.base
+                elif _offset == LATEST:
+                    self.__positions[_partition] = _partition.end
+                else:
+                    self.__positions[_partition] = _offset + 1
+
+    def stop(self):
+        self.__running = False
+        if self.__balance:
+            self.__broker.leave(self.__group, self.__topic, self)
+        else:
+            with self.__broker.cond:
+                self.__broker.cond.notify_all()
+
+    def __owned(self):
+        if self.__balance:
+            return self.__broker.assignment(self.__group, self.__topic, self)
+        if self.__only is not None:
+            return [p for p in self.__broker.partitions(self.__topic) if p.id in self.__only]
+        return self.__broker.partitions(self.__topic)
+
+    def __partition(self, partition):
+        if isinstance(partition, MemoryPartition):
+            return partition
+        return self.__broker.partitions(self.__topic)[partition]
+
+    def __position(self, partition):
+        _offset = self.__positions.get(partition)
+        if _offset is None:
+            # 新分配到的分区从已提交的offset开始，组内没有提交过时按auto_offset_reset
+            _offset = None if self.__reset_on_start else self.__broker.committed(self.__group, partition)
+            if _offset is None:
+                _offset = partition.base if self.__reset == EARLIEST else partition.end
+            self.__positions[partition] = _offset
+        return _offset
+
+
+class MemoryTransport(Transport):
+    '''
+    进程内存实现，同一进程内的Kafka/KafkaServer实例通过同一个MemoryBroker收发消息，
+    不经过网络、不压缩，objects为True时消息对象不编码直接传递
+    '''
+
+    def __init__(self, broker=None, objects=True):
+        '''
+        :param broker: 消息代理，默认为进程内共享的代理
+        :param objects: 是否直接传递消息对象（dict/list）
+        '''
+        self.broker = broker or get_broker()
+        self.objects = objects
+        self.__lock = threading.Lock()
+        self.__shared = dict()
+
+    def producer(self, topic, **kwargs):
+        return MemoryProducer(self.broker, topic, **kwargs)
+
+    def consumer(self, topic, consumer_group, consumer_timeout_ms=-1, balance=False, **kwargs):
+        return MemoryConsumer(self.broker, topic, consumer_group, consumer_timeout_ms, balance, **kwargs)
+
+    def shared_producer(self, topic, **kwargs):
+        with self.__lock:
+            _key = ('producer', _name(topic))
+            if _key not in self.__shared:
+                self.__shared[_key] = self.producer(topic)
+            return self.__shared[_key]
+
+    def shared_consumer(self, topic, consumer_group, **kwargs):
+        with self.__lock:
+            _key = ('consumer', _name(topic), consumer_group, tuple(sorted(kwargs.items())))
+            if _key not in self.__shared:
+                self.__shared[_key] = (self.consumer(topic, consumer_group, **kwargs), threading.Lock())
+            return self.__shared[_key]
+
+    def latest_offsets(self, topic):
+        with self.broker.cond:
+            return dict((p.id, p.end) for p in self.broker.partitions(topic))
+
+    def earliest_offsets(self, topic):
+        with self.broker.cond:
+            return dict((p.id, p.base) for p in self.broker.partitions(topic))
+
+    def offsets_for_time(self, topic, timestamp):
+        with self.broker.cond:
+            _offsets = dict()
+            for _partition in self.broker.partitions(topic):
+                # 消息按追加顺序带时间，二分查找第一条不早于timestamp的消息
+                _low, _high = 0, len(_partition.messages)
+                while _low < _high:
+                    _mid = (_low + _high) // 2
+                    if _partition.messages[_mid].timestamp < timestamp:
+                        _low = _mid + 1
+                    else:
+                        _high = _mid
+                _offsets[_partition.id] = _partition.base + _low
+            return _offsets
+
+    def committed_offsets(self, topic, consumer_group):
+        with self.broker.cond:
+            return dict((p.id, self.broker.committed(consumer_group, p)) for p in self.broker.partitions(topic))
+
+
+def _name(topic):
+    return topic.decode('utf-8') if isinstance(topic, bytes) else topic
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    '''
+    获取进程内共享的消息代理
+    '''
+    global _broker
+    if _broker is None:
+        with _broker_lock:
+            if _broker is None:
+                _broker = MemoryBroker()
+    return _broker
@@ -8,12 +8,16 @@
 from BaseClass.Daemon import Daemon
 from BaseClass.Log import Loger
 from BaseClass.Kafka import Kafka
-import json, sys
+import sys
 
 hosts = '192.168.100.70:9092,192.168.100.71:9092,192.168.100.72:9092'
 in_topic = 'tp.test.common'
 out_topic = 'tp.test.common.response'
 group_id = 'gp.test.common'
+# 回复缓存，默认不启用。请求方每次请求都使用新的sessionid时才可以按sessionid缓存，
+# 否则相同sessionid的新请求会收到旧的回复；需要时使用BaseClass.ResponseCache，如
+# ResponseCache(ttl=300, key='content')按请求原始内容判断重复
+response_cache = None
 
 
 class ServerKafka(Kafka):
@@ -21,13 +25,12 @@ class ServerKafka(Kafka):
     重载command方法来实现处理指令的业务逻辑
 
     '''
+    use_envelope = True
+
     def command(self, message):
         try:
-            self.loger.debug('收到信息：{}'.format(message))
-            if isinstance(message, bytes):
-                message = message.decode(self.__encoding)
-            message = message.replace("'", '"').replace('":,', '":"",')
-            _json_msg = json.loads(message)
+            self.loger.debug('收到信息：%s', message)
+            _json_msg = message.json
             _action = _json_msg.get('action')
             _sessionid = _json_msg.get('sessionid')
             _data = _json_msg.get('data')
@@ -37,11 +40,11 @@ class ServerKafka(Kafka):
                 _rt = {'code': 0, 'err': '[ServerKafka] {} 执行成功'.format(_action), 'sessionid': _sessionid, 'data': _data}
             else:
                 _rt = {'code': -2, 'err': '[ServerKafka] 未知指令 {}'.format(_action), 'sessionid': _sessionid, 'data': _data}
-            self.loger.debug('反馈信息：{}'.format(json.dumps(_rt)))
-            return json.dumps(_rt)
+            self.loger.debug('反馈信息：%s', _rt)
+            return self.dumps(_rt)
         except Exception as e:
             _rt = {'code': -3, 'err': '[ServerKafka] 未知异常 {}'.format(e), 'sessionid': None, 'data': None}
-            return json.dumps(_rt)
+            return self.dumps(_rt)
 
 
 class CommonServer(Daemon):
@@ -49,22 +52,29 @@ class CommonServer(Daemon):
     重载_run函数来实现服务成为守护进程
 
     '''
-    def __init__(self, pidfile, loger=None):
-        super(CommonServer, self).__init__(pidfile, loger)
-        self.__kafka = ServerKafka(hosts, loger, debug=True)
+    def __init__(self, pidfile, loger=None, **kwargs):
+        super(CommonServer, self).__init__(pidfile, loger, **kwargs)
+        # 配置回复缓存时，出错重启后重新投递的请求直接发送缓存的回复，不再重复执行command
+        self.__kafka = ServerKafka(hosts, loger, debug=True, response_cache=response_cache)
 
     def _run(self):
+        # consumer_timeout让空闲时waitForAction也能及时检查退出标记
         run = self.__kafka.start(in_topic=in_topic, out_topic=out_topic, consumer_group=group_id,
-                                 consumer_timeout=-1, balance=False)
-        while run:
+                                 consumer_timeout=1000, balance=False)
+        while run and not self.stopping:
             try:
                 self.__kafka.waitForAction()
             except Exception as e:
                 self.loger.error('Kafka出现错误，需要准备重启，原因: {}'.format(e))
             finally:
                 self.__kafka.stop()
-                run = self.__kafka.start(in_topic=in_topic, out_topic=out_topic, consumer_group=group_id,
-                                         consumer_timeout=-1, balance=False)
+                if not self.stopping:
+                    run = self.__kafka.start(in_topic=in_topic, out_topic=out_topic, consumer_group=group_id,
+                                             consumer_timeout=1000, balance=False)
+
+    def _drain(self):
+        # 处理完当前消息、提交offset后waitForAction返回，_run随之退出
+        self.__kafka.drain()
 
     def stop(self):
         self.__kafka.stop()
@@ -75,6 +85,8 @@ if __name__ == '__main__':
     # ====== Linux 下正式运行，使用该设置 =======
     # log = Loger('CommonServer', 'debug', '/tmp/daemon/log.txt')
     # daemon = CommonServer('/tmp/daemon/RUNNING.pid', loger=log)
+    # 多进程模式：每个CPU核一个工作进程，同属一个消费者组
+    # daemon = CommonServer('/tmp/daemon/RUNNING.pid', loger=log, prefork=True)
 
     # ====== Windows 下调试使用该设置 =======
     log = Loger('CommonServer', 'debug')
@@ -5,9 +5,6 @@
 # @Date  : 2018-10-16
 # @Desc  : 消息队列封装包测试
 
-from multiprocessing import Process, Queue
-import json
-
 from BaseClass.KafkaServer import KafkaServer
 
 hosts = '192.168.100.70:9092,192.168.100.71:9092,192.168.100.72:9092'
@@ -16,13 +13,12 @@ out_topic = 'tp.js.response'
 group_id = 'serverGroup'
 
 class CHandler(KafkaServer):
+    use_envelope = True
+
     # 重载处理函数
     def handler(self, message):
         try:
-            if isinstance(message, bytes):
-                message = message.decode()
-            message = message.replace("'", '"').replace('":,', '":"",')
-            _json_msg = json.loads(message)
+            _json_msg = message.json
             _action = _json_msg.get('action')
             _sessionid = _json_msg.get('sessionid')
             _data = _json_msg.get('data')
@@ -34,35 +30,21 @@ class CHandler(KafkaServer):
             else:
                 _rt = {'code': -2, 'err': '[ServerKafka] 未知指令 {}'.format(_action), 'sessionid': _sessionid,
                        'data': _data}
-            return json.dumps(_rt)
+            return _rt
         except Exception as e:
             _rt = {'code': -3, 'err': '[ServerKafka] 未知异常', 'sessionid': None, 'data': None}
-            return json.dumps(_rt)
+            return _rt
 
 
 
 
 if __name__ == '__main__':
-    my_que = Queue()
     kafka = CHandler(hosts=hosts, in_topic=in_topic, out_topic=out_topic, group_id=group_id)
-    # 接收和发送的进程数
+    # 接收、发送的进程数固定，处理进程数在min_handlers和max_handlers之间按积压自动增减；
+    # 设置shm_size时阶段之间改用共享内存环形缓冲区，如shm_size=64 * 1024 * 1024
     i_get = 2
-    i_send = 2
-    p_get = list()
-    p_send = list()
-    for i in range(i_get):
-        p_get.append(Process(target=kafka.get_process, args=(my_que, i)))
-    for j in range(i_send):
-        p_send.append(Process(target=kafka.send_process, args=(my_que, j)))
-
+    i_produce = 1
     print('begin..')
-    for i in range(i_get):
-        p_get[i].start()
-    for j in range(i_send):
-        p_send[j].start()
-
-    for i in range(i_get):
-        p_get[i].join()
-    for j in range(i_send):
-        p_send[j].join()
-    print('end..')
\ No newline at end of file
+    # Ctrl+C后接收进程提交offset退出，处理进程、发送进程处理完队列中的消息后退出
+    kafka.serve(i_get=i_get, i_produce=i_produce, min_handlers=2, max_handlers=8)
+    print('end..')
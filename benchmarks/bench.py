@@ -0,0 +1,338 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# @File  : bench.py
+# @Author: Liaop
+# @Date  : 2018-11-22
+# @Desc  : 吞吐量、延迟基准测试，使用本地broker替身，不需要kafka集群
+#
+# 用法：
+#   python benchmarks/bench.py                           # 全部测试，结果输出到终端
+#   python benchmarks/bench.py --quick --out base.json   # 小规模快速测试，结果写入json文件
+#   python benchmarks/bench.py rpc wait --sizes 100 10000 --compression none gzip
+#   python benchmarks/bench.py --out new.json --compare base.json
+#
+# 测试项：
+#   rpc     requestAndResponse往返（回复路由模式），并发数为客户端线程数
+#   wait    waitForAction顺序/批量/工作池模式的吞吐，并发数为同时在途的请求数
+#   server  KafkaServer处理进程流水线，按处理进程数和队列类型（multiprocessing.Queue/ShmRing）
+#   market  get_market，行情快照缓存和回溯查找两种方式
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from BaseClass import Pool
+from BaseClass.Kafka import Kafka
+from BaseClass.KafkaServer import KafkaServer
+from BaseClass.Compression import CompressionPolicy
+from BaseClass.Log import Loger
+from BaseClass.Metrics import Histogram, now_ns
+from benchmarks.broker import install
+
+HOSTS = 'bench.local:9092'
+SEED = 20181122
+_LOG = Loger('Bench', 'error')
+
+
+def payload(size):
+    '''
+    固定种子生成的测试数据，字母和数字随机组合，压缩率接近实际的行情、订单消息
+    '''
+    _rng = random.Random(SEED + size)
+    _words = [''.join(_rng.choice('abcdefghijklmnopqrstuvwxyz0123456789') for _ in range(_rng.randint(2, 8)))
+              for _ in range(64)]
+    _text = ''
+    while len(_text) < size:
+        _text += _rng.choice(_words) + ' '
+    return _text[:size]
+
+
+def merge(histograms):
+    _total = Histogram('total')
+    for _histogram in histograms:
+        _total.counts = [a + b for a, b in zip(_total.counts, _histogram.counts)]
+        _total.count += _histogram.count
+        _total.sum += _histogram.sum
+        _total.max = max(_total.max, _histogram.max)
+    return _total
+
+
+def result(bench, params, histogram, seconds):
+    _summary = histogram.summary()
+    return {'bench': bench,
+            'params': params,
+            'messages': histogram.count,
+            'seconds': round(seconds, 4),
+            'msgs_per_sec': round(histogram.count / seconds, 1) if seconds else 0,
+            'mean_us': round(_summary['mean'], 1),
+            'p50_us': _summary['p50'],
+            'p99_us': _summary['p99'],
+            'p999_us': _summary['p999'],
+            'max_us': _summary['max']}
+
+
+class EchoKafka(Kafka):
+    use_envelope = True
+
+    def command(self, message):
+        _json = message.json
+        return self.dumps({'code': 0, 'err': '', 'sessionid': _json.get('sessionid'),
+                           'data': _json.get('data'), 't': _json.get('t')})
+
+
+class EchoServer(KafkaServer):
+    use_envelope = True
+
+    def handler(self, message):
+        _json = message.json
+        return {'code': 0, 'err': '', 'sessionid': _json.get('sessionid'), 'data': _json.get('data'),
+                't': _json.get('t')}
+
+
+def bench_rpc(size, concurrency, compression, messages):
+    '''
+    requestAndResponse往返延迟，服务端为顺序模式的waitForAction
+    '''
+    install()
+    _server = EchoKafka(HOSTS, _LOG, compression=compression)
+    _server.start(in_topic='bench.req', out_topic='bench.resp', consumer_group='bench.server', consumer_timeout=100)
+    _thread = threading.Thread(target=_server.waitForAction)
+    _thread.start()
+    _client = Kafka(HOSTS, _LOG, compression=compression)
+    _client.start(in_topic='bench.resp', out_topic='bench.req', consumer_group='bench.client',
+                  consumer_timeout=100, router=True, reply_timeout=10)
+    _data = payload(size)
+    _per_thread = max(1, messages // concurrency)
+    _histograms = [Histogram('rpc') for i in range(concurrency)]
+
+    def _run(n, histogram, prefix):
+        for i in range(n):
+            _message = {'action': 'echo', 'sessionid': '{}-{}'.format(prefix, i), 'data': _data}
+            _begin = now_ns()
+            _client.requestAndResponse(_message)
+            if histogram is not None:
+                histogram.record_ns(now_ns() - _begin)
+
+    _run(min(100, _per_thread), None, 'warmup')
+    _threads = [threading.Thread(target=_run, args=(_per_thread, _histograms[i], 't{}'.format(i)))
+                for i in range(concurrency)]
+    _begin = time.perf_counter()
+    for _t in _threads:
+        _t.start()
+    for _t in _threads:
+        _t.join()
+    _seconds = time.perf_counter() - _begin
+    _server.drain()
+    _thread.join()
+    _client.stop()
+    _server.stop()
+    return result('rpc', {'size': size, 'concurrency': concurrency, 'compression': compression},
+                  merge(_histograms), _seconds)
+
+
+def bench_wait(size, concurrency, compression, mode, messages):
+    '''
+    waitForAction吞吐，同时保持concurrency个请求在途，延迟为请求发出到收到回复
+    '''
+    install()
+    _server = EchoKafka(HOSTS, _LOG, compression=compression)
+    _server.start(in_topic='bench.req', out_topic='bench.resp', consumer_group='bench.server', consumer_timeout=100)
+    _kwargs = {'seq': {}, 'batch': {'batch_size': 100, 'batch_wait_ms': 5}, 'pool': {'workers': 4}}[mode]
+    _thread = threading.Thread(target=_server.waitForAction, kwargs=_kwargs)
+    _thread.start()
+    _topics = Pool.get_pool().get_client(HOSTS).topics
+    _producer = _topics[b'bench.req'].get_producer(compression=CompressionPolicy.compression_type(compression))
+    _consumer = _topics[b'bench.resp'].get_simple_consumer(consumer_group=b'bench.client', consumer_timeout_ms=5000)
+    _data = payload(size)
+    _window = threading.Semaphore(concurrency)
+    _histogram = Histogram('wait')
+
+    def _collect():
+        for i in range(messages):
+            _msg = _consumer.consume()
+            if _msg is None:
+                break
+            _histogram.record_ns(now_ns() - json.loads(_msg.value)['t'])
+            _window.release()
+
+    _collector = threading.Thread(target=_collect)
+    _collector.start()
+    _begin = time.perf_counter()
+    for i in range(messages):
+        _window.acquire()
+        _producer.produce(json.dumps({'action': 'echo', 'sessionid': str(i), 'data': _data,
+                                      't': now_ns()}).encode('utf-8'))
+    _collector.join()
+    _seconds = time.perf_counter() - _begin
+    _server.drain()
+    _thread.join()
+    _server.stop()
+    return result('wait', {'size': size, 'concurrency': concurrency, 'compression': compression, 'mode': mode},
+                  _histogram, _seconds)
+
+
+def bench_server(size, processes, queue, messages):
+    '''
+    KafkaServer处理进程流水线：主进程按批放入请求，processes个handle_process处理，主进程收集结果
+    延迟为请求放入队列到从结果队列取出，包含两次跨进程传递
+    '''
+    _server = EchoServer(HOSTS, 'bench.req', 'bench.resp', 'bench.server', loger=_LOG)
+    _shm = 64 * 1024 * 1024 if queue == 'shm' else None
+    _in = KafkaServer.make_queue(1000, _shm)
+    _out = KafkaServer.make_queue(1000, _shm, producers=0)
+    _workers = [multiprocessing.Process(target=_server.handle_process, args=(_in, 'handler-{}'.format(i), None, _out))
+                for i in range(processes)]
+    for _worker in _workers:
+        _worker.start()
+    _data = payload(size)
+    _histogram = Histogram('server')
+
+    def _collect():
+        _count = 0
+        while _count < messages:
+            _batch = _out.get()
+            if not _batch:
+                continue
+            _now = now_ns()
+            for _value in _batch:
+                _histogram.record_ns(_now - json.loads(_value)['t'])
+            _count += len(_batch)
+
+    _collector = threading.Thread(target=_collect)
+    _collector.start()
+    _begin = time.perf_counter()
+    for i in range(0, messages, 100):
+        _in.put([json.dumps({'action': 'echo', 'sessionid': str(i + j), 'data': _data,
+                             't': now_ns()}).encode('utf-8') for j in range(min(100, messages - i))])
+    _collector.join()
+    _seconds = time.perf_counter() - _begin
+    KafkaServer.shutdown(_in, processes)
+    for _worker in _workers:
+        _worker.join()
+    if _shm:
+        _in.close()
+        _out.close()
+    return result('server', {'size': size, 'processes': processes, 'queue': queue}, _histogram, _seconds)
+
+
+def bench_market(cached, codes, lookups):
+    '''
+    get_market查询延迟，行情主题中每个合约有若干条历史行情
+    '''
+    install()
+    _topics = Pool.get_pool().get_client(HOSTS).topics
+    _producer = _topics[b'bench.quote'].get_producer()
+    for i in range(codes * 5):
+        _producer.produce(json.dumps({'code': 'C{:04d}'.format(i % codes), 'price': i,
+                                      'data': payload(200)}).encode('utf-8'))
+    _kafka = Kafka(HOSTS, _LOG)
+    if cached:
+        _kafka.start_market_cache('bench.quote', backfill=codes * 5).wait_ready(10)
+    _rng = random.Random(SEED)
+    _codes = ['C{:04d}'.format(_rng.randrange(codes)) for i in range(lookups)]
+    _histogram = Histogram('market')
+    _begin = time.perf_counter()
+    for _code in _codes:
+        _t = now_ns()
+        _kafka.get_market('bench.quote', _code)
+        _histogram.record_ns(now_ns() - _t)
+    _seconds = time.perf_counter() - _begin
+    _kafka.stop_market_cache()
+    return result('market', {'cached': cached, 'codes': codes}, _histogram, _seconds)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except Exception:
+        return None
+
+
+def compare(results, path):
+    '''
+    与之前的结果文件比较，按测试项和参数匹配，输出吞吐和p99的变化
+    '''
+    with open(path, encoding='utf-8') as f:
+        _old = dict((json.dumps([r['bench'], r['params']], sort_keys=True), r) for r in json.load(f)['results'])
+    print('\n与{}比较：'.format(path))
+    for _result in results:
+        _base = _old.get(json.dumps([_result['bench'], _result['params']], sort_keys=True))
+        if _base is None or not _base['msgs_per_sec']:
+            continue
+        print('{:<8} {:<70} msgs/s {:>+7.1%}  p99 {:>+7.1%}'.format(
+            _result['bench'], json.dumps(_result['params'], sort_keys=True),
+            _result['msgs_per_sec'] / _base['msgs_per_sec'] - 1,
+            (_result['p99_us'] / _base['p99_us'] - 1) if _base['p99_us'] else 0))
+
+
+def main():
+    _parser = argparse.ArgumentParser(description='BaseClass吞吐量、延迟基准测试')
+    _parser.add_argument('benches', nargs='*', default=['rpc', 'wait', 'server', 'market'],
+                         help='测试项：rpc、wait、server、market')
+    _parser.add_argument('--quick', action='store_true', help='小规模快速测试')
+    _parser.add_argument('--messages', type=int, help='每项测试的消息数')
+    _parser.add_argument('--sizes', type=int, nargs='+', help='消息大小（字节）')
+    _parser.add_argument('--concurrency', type=int, nargs='+', help='并发数')
+    _parser.add_argument('--compression', nargs='+', help='压缩方式')
+    _parser.add_argument('--processes', type=int, nargs='+', help='KafkaServer处理进程数')
+    _parser.add_argument('--out', help='结果json文件')
+    _parser.add_argument('--compare', help='与之前的结果json文件比较')
+    _args = _parser.parse_args()
+
+    _messages = _args.messages or (300 if _args.quick else 3000)
+    _sizes = _args.sizes or ([100, 10000] if _args.quick else [100, 1000, 10000])
+    _concurrency = _args.concurrency or ([1, 8] if _args.quick else [1, 8, 64])
+    _compression = _args.compression or ['none', 'gzip']
+    _processes = _args.processes or ([1, 2] if _args.quick else [1, 2, 4])
+
+    _cases = list()
+    if 'rpc' in _args.benches:
+        for _size, _c, _comp in itertools.product(_sizes, _concurrency, _compression):
+            _cases.append((bench_rpc, (_size, _c, _comp, _messages)))
+    if 'wait' in _args.benches:
+        for _size, _c, _comp, _mode in itertools.product(_sizes, _concurrency, _compression, ['seq', 'batch', 'pool']):
+            _cases.append((bench_wait, (_size, _c, _comp, _mode, _messages)))
+    if 'server' in _args.benches:
+        for _size, _p, _queue in itertools.product(_sizes, _processes, ['queue', 'shm']):
+            _cases.append((bench_server, (_size, _p, _queue, _messages * 10)))
+    if 'market' in _args.benches:
+        _cases.append((bench_market, (True, 1000, _messages * 10)))
+        _cases.append((bench_market, (False, 1000, max(10, _messages // 30))))
+
+    _results = list()
+    for _func, _params in _cases:
+        _result = _func(*_params)
+        _results.append(_result)
+        print('{:<8} {:<70} {:>10.1f} msgs/s  p50 {:>7}us  p99 {:>7}us  p999 {:>7}us'.format(
+            _result['bench'], json.dumps(_result['params'], sort_keys=True), _result['msgs_per_sec'],
+            _result['p50_us'], _result['p99_us'], _result['p999_us']))
+        sys.stdout.flush()
+
+    _report = {'meta': {'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                        'commit': git_commit(),
+                        'python': platform.python_version(),
+                        'platform': platform.platform(),
+                        'cpu_count': multiprocessing.cpu_count(),
+                        'argv': sys.argv[1:],
+                        'seed': SEED},
+               'results': _results}
+    if _args.out:
+        with open(_args.out, 'w', encoding='utf-8') as f:
+            json.dump(_report, f, ensure_ascii=False, indent=2)
+    if _args.compare:
+        compare(_results, _args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# @File  : broker.py
+# @Author: Liaop
+# @Date  : 2018-11-22
+# @Desc  : 基准测试用的本地broker：基于MemoryBroker的pykafka KafkaClient替身，按压缩类型实际压缩、解压消息
+
+from collections import namedtuple
+import gzip
+
+from BaseClass import Pool
+from BaseClass.Transport import MemoryBroker, MemoryConsumer, MemoryMessage, MemoryProducer
+
+try:
+    import snappy
+except ImportError:
+    snappy = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# pykafka.common.CompressionType -> (压缩, 解压)
+_CODECS = {
+    1: (gzip.compress, gzip.decompress),
+    2: (snappy.compress, snappy.decompress) if snappy else None,
+    3: (lz4.frame.compress, lz4.frame.decompress) if lz4 else None,
+}
+
+OffsetResponse = namedtuple('OffsetResponse', ['offset', 'err'])
+
+
+class FakeProducer(MemoryProducer):
+    '''
+    按compression压缩后放入代理，与pykafka一样由发送方承担压缩的CPU耗时
+    '''
+
+    def __init__(self, broker, topic, compression=0, **kwargs):
+        super(FakeProducer, self).__init__(broker, topic, **kwargs)
+        self.__codec = _CODECS.get(compression)
+
+    def produce(self, message, partition_key=None):
+        if self.__codec is not None:
+            message = (self.__codec, self.__codec[0](message))
+        return super(FakeProducer, self).produce(message, partition_key)
+
+
+class FakeConsumer(MemoryConsumer):
+    '''
+    接收时解压，返回新的消息对象，不修改代理中保存的消息
+    '''
+
+    def consume(self, block=True):
+        _msg = super(FakeConsumer, self).consume(block)
+        if _msg is None or not isinstance(_msg.value, tuple):
+            return _msg
+        _codec, _data = _msg.value
+        _copy = MemoryMessage(_codec[1](_data), _msg.offset, _msg.partition, _msg.partition_key)
+        _copy.timestamp = _msg.timestamp
+        return _copy
+
+
+class FakeTopic(object):
+    def __init__(self, broker, name):
+        self.__broker = broker
+        self.name = name
+        broker.create_topic(name)
+
+    @property
+    def partitions(self):
+        return dict((p.id, p) for p in self.__broker.partitions(self.name))
+
+    def get_producer(self, compression=0, delivery_reports=False, **kwargs):
+        return FakeProducer(self.__broker, self.name, compression=compression, delivery_reports=delivery_reports)
+
+    def get_simple_consumer(self, consumer_group=None, consumer_timeout_ms=-1, **kwargs):
+        return FakeConsumer(self.__broker, self.name, consumer_group, consumer_timeout_ms, False, **kwargs)
+
+    def get_balanced_consumer(self, consumer_group=None, consumer_timeout_ms=-1, managed=True, **kwargs):
+        return FakeConsumer(self.__broker, self.name, consumer_group, consumer_timeout_ms, True, **kwargs)
+
+    def latest_available_offsets(self):
+        return dict((p.id, OffsetResponse([p.end], 0)) for p in self.__broker.partitions(self.name))
+
+    def earliest_available_offsets(self):
+        return dict((p.id, OffsetResponse([p.base], 0)) for p in self.__broker.partitions(self.name))
+
+
+class _Topics(dict):
+    def __init__(self, broker):
+        super(_Topics, self).__init__()
+        self.__broker = broker
+
+    def __missing__(self, name):
+        _topic = self[name] = FakeTopic(self.__broker, name)
+        return _topic
+
+
+class FakeClient(object):
+    '''
+    pykafka.KafkaClient的替身，只实现本包用到的topics[...]接口
+    '''
+
+    def __init__(self, broker):
+        self.topics = _Topics(broker)
+
+
+def install(partitions=1, max_messages=1000000):
+    '''
+    把连接池中的KafkaClient换成使用本地代理的替身，之后Kafka、MarketCache等都连接到该代理
+    :param partitions: 新建主题的分区数
+    :param max_messages: 每个分区最多保留的消息数
+    :return: MemoryBroker
+    '''
+    _broker = MemoryBroker(partitions, max_messages)
+    Pool.get_pool().clear()
+    Pool.KafkaClient = lambda hosts=None, **kwargs: FakeClient(_broker)
+    return _broker